@@ -0,0 +1,38 @@
+"""Conversation summary
+
+Revision ID: 7d2f4b1c9e35
+Revises: 3445976fd759
+Create Date: 2026-10-18 10:00:00.000000
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '7d2f4b1c9e35'
+down_revision: Union[str, None] = '3445976fd759'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table('conversation_summary',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('user_id', sa.BigInteger(), nullable=False),
+    sa.Column('thread_id', sa.String(), nullable=False),
+    sa.Column('new_thread_id', sa.String(), nullable=False),
+    sa.Column('summary', sa.Text(), nullable=False),
+    sa.Column('context_tokens', sa.Integer(), nullable=False),
+    sa.Column('created_at', sa.DateTime(timezone=True), server_default=sa.text('now()'), nullable=True),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('new_thread_id')
+    )
+    op.create_index(op.f('ix_conversation_summary_user_id'), 'conversation_summary', ['user_id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_conversation_summary_user_id'), table_name='conversation_summary')
+    op.drop_table('conversation_summary')
@@ -0,0 +1,155 @@
+import asyncio
+import random
+from collections import deque
+from typing import Optional
+
+from loguru import logger
+
+from .sinks import AnalyticsSink
+from .types import AnalyticsEvent
+
+
+class AnalyticsPipeline:
+    """
+    AnalyticsPipeline buffers the tracked events in memory and sends them to a sink in batches
+    from a background task, so that tracking an event never waits for the sink.
+
+    The buffer is bounded. When it is full, the overflow policy decides which events are lost:
+    'drop_oldest' replaces the oldest buffered event, 'drop_newest' discards the new event,
+    and 'sample' keeps only a sample of the new events, each replacing the oldest buffered one.
+    """
+
+    overflow_policies = ("drop_oldest", "drop_newest", "sample")
+
+    def __init__(
+        self,
+        sink: AnalyticsSink,
+        capacity: int = 10000,
+        batch_size: int = 100,
+        flush_interval: float = 5.0,
+        overflow_policy: str = "drop_oldest",
+        sample_rate: float = 0.1,
+    ):
+        """
+        Initializes the pipeline.
+
+        Parameters:
+        - sink (AnalyticsSink): The destination of the events.
+        - capacity (int): The maximum number of buffered events.
+        - batch_size (int): The number of buffered events that triggers a flush, and the maximum size of a batch.
+        - flush_interval (float): The maximum number of seconds an event waits before it is flushed.
+        - overflow_policy (str): The policy applied to new events when the buffer is full.
+        - sample_rate (float): The share of new events kept when the buffer is full, for the 'sample' policy.
+
+        Raises:
+        - ValueError: If the overflow policy is unknown.
+        """
+
+        if overflow_policy not in self.overflow_policies:
+            raise ValueError(f"Unknown analytics overflow policy: {overflow_policy}")
+
+        self.sink = sink
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        self.sample_rate = sample_rate
+
+        self.buffer = deque()
+        self.dropped = 0
+        self.sent = 0
+        self._batch_ready = asyncio.Event()
+        self._is_closing = False
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        """
+        Starts the background task flushing the buffer.
+
+        Returns:
+        - None
+        """
+
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def put(self, event: AnalyticsEvent):
+        """
+        Buffers the event without waiting.
+
+        Parameters:
+        - event (AnalyticsEvent): The event.
+
+        Returns:
+        - None
+        """
+
+        if len(self.buffer) >= self.capacity:
+            self.dropped += 1
+            if self.dropped % 1000 == 1:
+                logger.warning(
+                    f"Analytics buffer is full, {self.dropped} events dropped so far"
+                )
+            if self.overflow_policy == "drop_newest" or (
+                self.overflow_policy == "sample" and random.random() >= self.sample_rate
+            ):
+                return
+            self.buffer.popleft()
+
+        self.buffer.append(event)
+        if len(self.buffer) >= self.batch_size:
+            self._batch_ready.set()
+
+    async def flush(self):
+        """
+        Sends all the buffered events.
+
+        Returns:
+        - None
+        """
+
+        while self.buffer:
+            batch = [
+                self.buffer.popleft()
+                for _ in range(min(self.batch_size, len(self.buffer)))
+            ]
+            try:
+                await self.sink.send(batch)
+                self.sent += len(batch)
+            except Exception as e:
+                self.dropped += len(batch)
+                logger.error(f"Error in AnalyticsPipeline while sending events: {e}")
+
+    async def close(self):
+        """
+        Stops the background task, sends all the buffered events and closes the sink.
+
+        Returns:
+        - None
+        """
+
+        # The task is woken up instead of cancelled, so that a batch being sent is not lost.
+        self._is_closing = True
+        self._batch_ready.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+        await self.flush()
+        await self.sink.close()
+        logger.info(
+            f"Analytics pipeline closed: {self.sent} events sent, {self.dropped} dropped"
+        )
+
+    async def _run(self):
+        """
+        Flushes the buffer whenever a batch is ready or the flush interval has passed.
+        """
+
+        while not self._is_closing:
+            try:
+                await asyncio.wait_for(self._batch_ready.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._batch_ready.clear()
+            await self.flush()
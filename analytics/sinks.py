@@ -0,0 +1,112 @@
+import abc
+import asyncio
+import json
+import os
+from typing import List
+
+import aiofiles
+from amplitude import Amplitude, BaseEvent
+from loguru import logger
+
+from .types import AnalyticsEvent
+
+
+class AnalyticsSink(abc.ABC):
+    """
+    AnalyticsSink is the base class of the destinations of the tracked events.
+    """
+
+    @abc.abstractmethod
+    async def send(self, events: List[AnalyticsEvent]):
+        """
+        Sends a batch of events.
+
+        Parameters:
+        - events (List[AnalyticsEvent]): The events, in the order they were tracked.
+
+        Returns:
+        - None
+        """
+
+    async def close(self):
+        """
+        Sends everything buffered by the sink and releases its resources.
+
+        Returns:
+        - None
+        """
+
+
+class AmplitudeSink(AnalyticsSink):
+    """
+    AmplitudeSink sends the events to Amplitude.
+    """
+
+    def __init__(self, api_key: str):
+        """
+        Initializes the Amplitude client.
+
+        Parameters:
+        - api_key (str): The Amplitude API key.
+        """
+
+        self.client = Amplitude(api_key)
+
+    async def send(self, events: List[AnalyticsEvent]):
+        # The client hands the events to its own worker threads, but takes locks while doing so.
+        await asyncio.to_thread(self._track, events)
+
+    async def close(self):
+        await asyncio.to_thread(self.client.shutdown)
+
+    def _track(self, events: List[AnalyticsEvent]):
+        """
+        Passes the events to the Amplitude client.
+        """
+
+        for event in events:
+            try:
+                self.client.track(
+                    BaseEvent(
+                        user_id=str(event.user_id),
+                        event_type=event.event_type,
+                        event_properties={"info": event.event_properties},
+                        time=event.time,
+                    )
+                )
+            except Exception as e:
+                logger.info(f"Error in amplitude logger: {e}")
+
+
+class FileSink(AnalyticsSink):
+    """
+    FileSink appends the events to a local file, one JSON object per line.
+    """
+
+    def __init__(self, path: str):
+        """
+        Initializes the sink.
+
+        Parameters:
+        - path (str): The path of the file.
+        """
+
+        self.path = path
+
+    async def send(self, events: List[AnalyticsEvent]):
+        if directory := os.path.dirname(self.path):
+            os.makedirs(directory, exist_ok=True)
+        lines = "".join(
+            json.dumps(event._asdict(), ensure_ascii=False) + "\n" for event in events
+        )
+        async with aiofiles.open(self.path, "a", encoding="utf-8") as file:
+            await file.write(lines)
+
+
+class NullSink(AnalyticsSink):
+    """
+    NullSink discards the events.
+    """
+
+    async def send(self, events: List[AnalyticsEvent]):
+        pass
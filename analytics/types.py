@@ -1,4 +1,5 @@
 from enum import Enum
+from typing import NamedTuple
 
 
 class EventType(Enum):
@@ -14,3 +15,15 @@ class EventType(Enum):
     GetSourcesCommand = "Get Sources Command"
     StartCommand = "Start Command"
     HelpCommand = "Help Command"
+
+
+class AnalyticsEvent(NamedTuple):
+    """
+    AnalyticsEvent represents a tracked event waiting to be sent to an analytics sink.
+    """
+
+    user_id: int
+    event_type: str
+    event_properties: str
+    # The time of the event, in milliseconds since the epoch.
+    time: int
@@ -0,0 +1,3 @@
+from .fake_openai import FakeOpenAI
+from .fake_telegram import FakeTelegram
+from .latency import Latency
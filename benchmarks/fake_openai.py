@@ -0,0 +1,930 @@
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+from aiohttp import web
+
+from .latency import Latency
+
+# Sentences the fake models answer with.
+SENTENCES = [
+    "Спасибо, что поделились этим со мной.",
+    "Расскажите, пожалуйста, что для вас сейчас важнее всего?",
+    "Похоже, семья и близкие люди играют в вашей жизни большую роль.",
+    "Тревога часто усиливается, когда мы не знаем, чего ожидать.",
+    "Попробуйте сделать несколько медленных вдохов и выдохов.",
+    "Что помогает вам почувствовать себя спокойнее в такие моменты?",
+    "Это совершенно нормальная реакция на стрессовую ситуацию.",
+    "Давайте подумаем, какие шаги вы могли бы сделать уже сегодня.",
+]
+
+# Requests of these paths are served by the models, so they are the ones that may be rate-limited.
+MODEL_PATHS = re.compile(
+    r"^/v1/(threads/[^/]+/runs(/[^/]+/submit_tool_outputs)?|audio/.+|chat/completions)$"
+)
+
+# The marker of a file citation in the text of an assistant message.
+CITATION_MARKER = "【4:0†source】"
+
+
+class FakeOpenAI:
+    """
+    A class for serving a local stand-in of the OpenAI API used by the services of the bot.
+
+    It covers the assistants, vector stores, files, threads, messages and runs (polled and streamed) of the
+    Assistants API, audio transcription and speech, and chat completions. Each kind of response is delayed
+    by a configurable latency distribution, and requests served by the models can be rejected
+    with 429 responses at a configurable rate.
+    """
+
+    # The latencies of the operations, in seconds.
+    default_latencies = {
+        # Every request, e.g. the network round trip.
+        "request": Latency(0.02, 0.3),
+        # A run waits in the queue, then generates its first token, then the rest of the tokens.
+        "run_queue": Latency(0.3, 0.5),
+        "first_token": Latency(0.8, 0.4),
+        "token_delta": Latency(0.04, 0.3),
+        "transcription": Latency(0.8, 0.4),
+        # The time to the first byte of speech, then between its chunks.
+        "speech": Latency(0.4, 0.4),
+        "speech_chunk": Latency(0.05, 0.3),
+        "chat": Latency(1.0, 0.4),
+    }
+
+    def __init__(
+        self,
+        latencies: Dict[str, Latency] = None,
+        rate_limit_rate: float = 0.0,
+        retry_after_ms: int = 500,
+        reply_sentences: int = 3,
+        words_per_delta: int = 3,
+        citation_rate: float = 0.2,
+        tool_call_rate: float = 0.0,
+        speech_bytes: int = 24000,
+        speech_chunk_size: int = 4096,
+    ):
+        """
+        Initializes the server.
+
+        Parameters:
+        - latencies (Dict[str, Latency]): The latencies overriding the default ones, by operation.
+        - rate_limit_rate (float): The share of the requests served by the models rejected with 429.
+        - retry_after_ms (int): The delay requested by the 'retry-after-ms' header of the 429 responses.
+        - reply_sentences (int): The number of sentences in the replies of the assistant.
+        - words_per_delta (int): The number of words in each streamed delta of a reply.
+        - citation_rate (float): The share of the replies citing an uploaded file.
+        - tool_call_rate (float): The share of the runs and the chat replies calling a function tool first.
+        - speech_bytes (int): The size of the synthesized speech.
+        - speech_chunk_size (int): The size of the chunks the speech is streamed in.
+        """
+
+        self.latencies = {**self.default_latencies, **(latencies or {})}
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after_ms = retry_after_ms
+        self.reply_sentences = reply_sentences
+        self.words_per_delta = words_per_delta
+        self.citation_rate = citation_rate
+        self.tool_call_rate = tool_call_rate
+        self.speech_audio = os.urandom(speech_bytes)
+        self.speech_chunk_size = speech_chunk_size
+
+        self.ids = itertools.count(1)
+        self.assistants = {}
+        self.vector_stores = {}
+        self.file_batches = {}
+        self.files = {}
+        # Maps thread IDs to their messages, oldest first.
+        self.threads: Dict[str, List[dict]] = {}
+        self.runs = {}
+        self.run_tasks = set()
+        self.cancelled_runs = set()
+        self.run_resumed: Dict[str, asyncio.Event] = {}
+
+        # The number of requests by route, and the number of rejected ones.
+        self.requests = Counter()
+        self.rate_limited = 0
+
+        self.runner: Optional[web.AppRunner] = None
+
+    def create_app(self) -> web.Application:
+        """
+        Creates the application serving the API under /v1.
+
+        Returns:
+        - web.Application: The application.
+        """
+
+        app = web.Application(middlewares=[self.simulate_network])
+        app.router.add_post("/v1/assistants", self.create_assistant)
+        app.router.add_get("/v1/assistants/{assistant_id}", self.retrieve_assistant)
+        app.router.add_post("/v1/assistants/{assistant_id}", self.update_assistant)
+        app.router.add_delete("/v1/assistants/{assistant_id}", self.delete_assistant)
+        app.router.add_post("/v1/vector_stores", self.create_vector_store)
+        app.router.add_get(
+            "/v1/vector_stores/{vector_store_id}", self.retrieve_vector_store
+        )
+        app.router.add_delete(
+            "/v1/vector_stores/{vector_store_id}", self.delete_vector_store
+        )
+        app.router.add_post(
+            "/v1/vector_stores/{vector_store_id}/file_batches", self.create_file_batch
+        )
+        app.router.add_get(
+            "/v1/vector_stores/{vector_store_id}/file_batches/{batch_id}",
+            self.retrieve_file_batch,
+        )
+        app.router.add_delete(
+            "/v1/vector_stores/{vector_store_id}/files/{file_id}",
+            self.delete_vector_store_file,
+        )
+        app.router.add_post("/v1/files", self.create_file)
+        app.router.add_get("/v1/files/{file_id}", self.retrieve_file)
+        app.router.add_delete("/v1/files/{file_id}", self.delete_file)
+        app.router.add_post("/v1/threads", self.create_thread)
+        app.router.add_post("/v1/threads/{thread_id}/messages", self.create_message)
+        app.router.add_get("/v1/threads/{thread_id}/messages", self.list_messages)
+        app.router.add_post("/v1/threads/{thread_id}/runs", self.create_run)
+        app.router.add_get("/v1/threads/{thread_id}/runs/{run_id}", self.retrieve_run)
+        app.router.add_post(
+            "/v1/threads/{thread_id}/runs/{run_id}/cancel", self.cancel_run
+        )
+        app.router.add_post(
+            "/v1/threads/{thread_id}/runs/{run_id}/submit_tool_outputs",
+            self.submit_tool_outputs,
+        )
+        app.router.add_post("/v1/audio/transcriptions", self.create_transcription)
+        app.router.add_post("/v1/audio/speech", self.create_speech)
+        app.router.add_post("/v1/chat/completions", self.create_chat_completion)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Starts the server.
+
+        Parameters:
+        - host (str): The host to listen on.
+        - port (int): The port to listen on, 0 for any free port.
+
+        Returns:
+        - str: The base URL of the API, to be used as OPENAI_BASE_URL.
+        """
+
+        self.runner = web.AppRunner(self.create_app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        return f"http://{host}:{port}/v1"
+
+    async def stop(self):
+        """
+        Stops the server and the simulated runs.
+
+        Returns:
+        - None
+        """
+
+        for task in self.run_tasks:
+            task.cancel()
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    @web.middleware
+    async def simulate_network(
+        self, request: web.Request, handler
+    ) -> web.StreamResponse:
+        """
+        Delays every request, counts it, and rejects a share of the requests served by the models.
+        """
+
+        self.requests[
+            f"{request.method} {request.match_info.route.resource.canonical}"
+        ] += 1
+        await self.latencies["request"].sleep()
+
+        if (
+            request.method == "POST"
+            and MODEL_PATHS.match(request.path)
+            and random.random() < self.rate_limit_rate
+        ):
+            self.rate_limited += 1
+            await request.read()
+            return web.json_response(
+                {
+                    "error": {
+                        "message": "Rate limit reached.",
+                        "type": "requests",
+                        "code": "rate_limit_exceeded",
+                    }
+                },
+                status=429,
+                headers={"retry-after-ms": str(self.retry_after_ms)},
+            )
+
+        return await handler(request)
+
+    def new_id(self, prefix: str) -> str:
+        return f"{prefix}_{next(self.ids):08d}"
+
+    def get_metrics(self) -> dict:
+        """
+        Returns the statistics of the server.
+
+        Returns:
+        - dict: The number of requests by route, the number of rate-limited requests and the number of runs.
+        """
+
+        return {
+            "requests": dict(self.requests),
+            "rate_limited": self.rate_limited,
+            "runs": len(self.runs),
+        }
+
+    # Assistants, vector stores and files.
+
+    async def create_assistant(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        assistant = {
+            "id": self.new_id("asst"),
+            "object": "assistant",
+            "created_at": int(time.time()),
+            "name": body.get("name"),
+            "description": body.get("description"),
+            "model": body["model"],
+            "instructions": body.get("instructions"),
+            "tools": body.get("tools", []),
+            "tool_resources": body.get("tool_resources"),
+            "metadata": body.get("metadata", {}),
+        }
+        self.assistants[assistant["id"]] = assistant
+        return web.json_response(assistant)
+
+    def get_object(self, objects: dict, object_id: str) -> dict:
+        if object_id not in objects:
+            raise web.HTTPNotFound(
+                text=json.dumps({"error": {"message": f"No such object: {object_id}"}}),
+                content_type="application/json",
+            )
+        return objects[object_id]
+
+    async def retrieve_assistant(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            self.get_object(self.assistants, request.match_info["assistant_id"])
+        )
+
+    async def update_assistant(self, request: web.Request) -> web.Response:
+        assistant = self.get_object(self.assistants, request.match_info["assistant_id"])
+        assistant.update(await request.json())
+        return web.json_response(assistant)
+
+    async def delete_assistant(self, request: web.Request) -> web.Response:
+        self.get_object(self.assistants, request.match_info["assistant_id"])
+        assistant_id = request.match_info["assistant_id"]
+        del self.assistants[assistant_id]
+        return web.json_response(
+            {"id": assistant_id, "object": "assistant.deleted", "deleted": True}
+        )
+
+    async def create_vector_store(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        vector_store = {
+            "id": self.new_id("vs"),
+            "object": "vector_store",
+            "created_at": int(time.time()),
+            "name": body.get("name"),
+            "status": "completed",
+            "usage_bytes": 0,
+            "file_counts": self.file_counts(0),
+            "metadata": {},
+        }
+        self.vector_stores[vector_store["id"]] = vector_store
+        return web.json_response(vector_store)
+
+    async def retrieve_vector_store(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            self.get_object(self.vector_stores, request.match_info["vector_store_id"])
+        )
+
+    async def delete_vector_store(self, request: web.Request) -> web.Response:
+        vector_store_id = request.match_info["vector_store_id"]
+        self.get_object(self.vector_stores, vector_store_id)
+        del self.vector_stores[vector_store_id]
+        return web.json_response(
+            {"id": vector_store_id, "object": "vector_store.deleted", "deleted": True}
+        )
+
+    @staticmethod
+    def file_counts(completed: int) -> dict:
+        return {
+            "in_progress": 0,
+            "completed": completed,
+            "failed": 0,
+            "cancelled": 0,
+            "total": completed,
+        }
+
+    async def create_file_batch(self, request: web.Request) -> web.Response:
+        vector_store = self.get_object(
+            self.vector_stores, request.match_info["vector_store_id"]
+        )
+        body = await request.json()
+        file_batch = {
+            "id": self.new_id("vsfb"),
+            "object": "vector_store.files_batch",
+            "created_at": int(time.time()),
+            "vector_store_id": vector_store["id"],
+            "status": "completed",
+            "file_counts": self.file_counts(len(body["file_ids"])),
+        }
+        self.file_batches[file_batch["id"]] = file_batch
+        return web.json_response(file_batch)
+
+    async def retrieve_file_batch(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            self.get_object(self.file_batches, request.match_info["batch_id"])
+        )
+
+    async def delete_vector_store_file(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "id": request.match_info["file_id"],
+                "object": "vector_store.file.deleted",
+                "deleted": True,
+            }
+        )
+
+    async def create_file(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        upload = form["file"]
+        file = {
+            "id": self.new_id("file"),
+            "object": "file",
+            "created_at": int(time.time()),
+            "bytes": len(upload.file.read()),
+            "filename": upload.filename,
+            "purpose": form.get("purpose", "assistants"),
+            "status": "processed",
+        }
+        self.files[file["id"]] = file
+        return web.json_response(file)
+
+    async def retrieve_file(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            self.get_object(self.files, request.match_info["file_id"])
+        )
+
+    async def delete_file(self, request: web.Request) -> web.Response:
+        self.get_object(self.files, request.match_info["file_id"])
+        file_id = request.match_info["file_id"]
+        del self.files[file_id]
+        return web.json_response({"id": file_id, "object": "file", "deleted": True})
+
+    # Threads, messages and runs.
+
+    async def create_thread(self, request: web.Request) -> web.Response:
+        thread_id = self.new_id("thread")
+        body = await request.json() if request.can_read_body else {}
+        self.threads[thread_id] = [
+            self.create_message_object(thread_id, message["role"], message["content"])
+            for message in body.get("messages") or []
+        ]
+        return web.json_response(
+            {
+                "id": thread_id,
+                "object": "thread",
+                "created_at": int(time.time()),
+                "metadata": {},
+                "tool_resources": None,
+            }
+        )
+
+    def create_message_object(
+        self,
+        thread_id: str,
+        role: str,
+        text: str,
+        run: dict = None,
+        annotations: List[dict] = None,
+        status: str = "completed",
+    ) -> dict:
+        return {
+            "id": self.new_id("msg"),
+            "object": "thread.message",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "role": role,
+            "status": status,
+            "content": [
+                {
+                    "type": "text",
+                    "text": {"value": text, "annotations": annotations or []},
+                }
+            ],
+            "assistant_id": run["assistant_id"] if run else None,
+            "run_id": run["id"] if run else None,
+            "attachments": [],
+            "metadata": {},
+        }
+
+    async def create_message(self, request: web.Request) -> web.Response:
+        thread = self.get_object(self.threads, request.match_info["thread_id"])
+        body = await request.json()
+        content = body["content"]
+        if not isinstance(content, str):
+            content = " ".join(part.get("text", "") for part in content)
+        message = self.create_message_object(
+            request.match_info["thread_id"], body.get("role", "user"), content
+        )
+        thread.append(message)
+        return web.json_response(message)
+
+    async def list_messages(self, request: web.Request) -> web.Response:
+        messages = list(self.get_object(self.threads, request.match_info["thread_id"]))
+        if request.query.get("order", "desc") == "desc":
+            messages.reverse()
+        messages = messages[: int(request.query.get("limit", 20))]
+        return web.json_response(
+            {
+                "object": "list",
+                "data": messages,
+                "first_id": messages[0]["id"] if messages else None,
+                "last_id": messages[-1]["id"] if messages else None,
+                "has_more": False,
+            }
+        )
+
+    def generate_reply(self, instructions: Optional[str] = None) -> dict:
+        """
+        Generates the text of a reply of the assistant, with its annotations.
+
+        Parameters:
+        - instructions (Optional[str]): The instructions of the reply, which may give it excerpts to cite.
+
+        Returns:
+        - dict: The text content of the message.
+        """
+
+        sentences = random.sample(SENTENCES, min(self.reply_sentences, len(SENTENCES)))
+        text = " ".join(sentences)
+        annotations = []
+        if instructions and "【1】" in instructions:
+            # The excerpts of the local retrieval are cited by their markers, without annotations.
+            if random.random() < self.citation_rate:
+                text = f"{sentences[0]}【1】{text[len(sentences[0]):]}"
+        elif self.files and random.random() < self.citation_rate:
+            start_index = len(sentences[0]) - 1
+            text = text[:start_index] + CITATION_MARKER + text[start_index:]
+            annotations.append(
+                {
+                    "type": "file_citation",
+                    "text": CITATION_MARKER,
+                    "start_index": start_index,
+                    "end_index": start_index + len(CITATION_MARKER),
+                    "file_citation": {
+                        "file_id": random.choice(list(self.files)),
+                        "quote": "",
+                    },
+                }
+            )
+        return {"value": text, "annotations": annotations}
+
+    def split_into_deltas(self, text: str) -> List[str]:
+        words = re.findall(r"\S+\s*", text)
+        return [
+            "".join(words[index : index + self.words_per_delta])
+            for index in range(0, len(words), self.words_per_delta)
+        ]
+
+    def create_tool_calls(self, run: dict) -> Optional[dict]:
+        """
+        Returns the action calling a random function tool of the assistant, at the configured rate.
+
+        Parameters:
+        - run (dict): The run.
+
+        Returns:
+        - Optional[dict]: The required action, or None if the run does not call a tool.
+        """
+
+        functions = [
+            tool["function"]
+            for tool in self.assistants.get(run["assistant_id"], {}).get("tools", [])
+            if tool["type"] == "function"
+        ]
+        if not functions or random.random() >= self.tool_call_rate:
+            return None
+
+        function = random.choice(functions)
+        return {
+            "type": "submit_tool_outputs",
+            "submit_tool_outputs": {
+                "tool_calls": [
+                    {
+                        "id": self.new_id("call"),
+                        "type": "function",
+                        "function": {
+                            "name": function["name"],
+                            "arguments": json.dumps(
+                                fake_arguments(function.get("parameters", {}))
+                            ),
+                        },
+                    }
+                ]
+            },
+        }
+
+    async def create_run(self, request: web.Request) -> web.StreamResponse:
+        thread_id = request.match_info["thread_id"]
+        self.get_object(self.threads, thread_id)
+        body = await request.json()
+
+        run = {
+            "id": self.new_id("run"),
+            "object": "thread.run",
+            "created_at": int(time.time()),
+            "thread_id": thread_id,
+            "assistant_id": body["assistant_id"],
+            "status": "queued",
+            "model": self.assistants.get(body["assistant_id"], {}).get("model"),
+            "instructions": body.get("instructions"),
+            "additional_instructions": body.get("additional_instructions"),
+            "tools": self.assistants.get(body["assistant_id"], {}).get("tools", []),
+            "started_at": None,
+            "completed_at": None,
+            "cancelled_at": None,
+            "failed_at": None,
+            "expires_at": None,
+            "last_error": None,
+            "required_action": None,
+            "usage": None,
+            "truncation_strategy": body.get("truncation_strategy"),
+            "metadata": {},
+        }
+        self.runs[run["id"]] = run
+
+        if body.get("stream"):
+            return await self.stream_run(request, run)
+
+        task = asyncio.create_task(self.simulate_run(run))
+        self.run_tasks.add(task)
+        task.add_done_callback(self.run_tasks.discard)
+        return web.json_response(run)
+
+    async def retrieve_run(self, request: web.Request) -> web.Response:
+        return web.json_response(
+            self.get_object(self.runs, request.match_info["run_id"])
+        )
+
+    async def cancel_run(self, request: web.Request) -> web.Response:
+        run = self.get_object(self.runs, request.match_info["run_id"])
+        if run["status"] in ("queued", "in_progress", "requires_action"):
+            self.cancelled_runs.add(run["id"])
+            run["status"] = "cancelling"
+            if run["id"] in self.run_resumed:
+                self.run_resumed[run["id"]].set()
+        return web.json_response(run)
+
+    async def submit_tool_outputs(self, request: web.Request) -> web.StreamResponse:
+        run = self.get_object(self.runs, request.match_info["run_id"])
+        body = await request.json()
+        run["status"] = "queued"
+        run["required_action"] = None
+
+        if body.get("stream"):
+            return await self.stream_run(request, run, allow_tool_calls=False)
+
+        self.run_resumed.pop(run["id"], asyncio.Event()).set()
+        return web.json_response(run)
+
+    def finish_run(self, run: dict, status: str):
+        run["status"] = status
+        run[f"{status}_at"] = int(time.time())
+        if status == "completed":
+            run["usage"] = self.count_usage(run)
+        self.cancelled_runs.discard(run["id"])
+
+    def count_usage(self, run: dict) -> dict:
+        """
+        Estimates the tokens of a completed run from the messages of its thread seen by the run,
+        so that the usage grows with the conversation as it does with the real API.
+
+        Parameters:
+        - run (dict): The run, whose reply is the last message of the thread.
+
+        Returns:
+        - dict: The usage of the run.
+        """
+
+        *context, reply = self.threads[run["thread_id"]] or [None]
+        truncation_strategy = run.get("truncation_strategy") or {}
+        if truncation_strategy.get("type") == "last_messages":
+            context = context[-truncation_strategy["last_messages"] :]
+
+        def count_tokens(message: Optional[dict]) -> int:
+            if message is None:
+                return 0
+            return 4 + len(message["content"][0]["text"]["value"]) // 4
+
+        # The instructions and the tools of the assistant.
+        prompt_tokens = 500 + sum(count_tokens(message) for message in context)
+        completion_tokens = count_tokens(reply)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        }
+
+    async def simulate_run(self, run: dict):
+        """
+        Advances a polled run through its statuses in the background.
+
+        Parameters:
+        - run (dict): The run.
+
+        Returns:
+        - None
+        """
+
+        allow_tool_calls = True
+        while True:
+            await self.latencies["run_queue"].sleep()
+            if run["id"] in self.cancelled_runs:
+                return self.finish_run(run, "cancelled")
+            run["status"] = "in_progress"
+            run["started_at"] = run["started_at"] or int(time.time())
+
+            await self.latencies["first_token"].sleep()
+            required_action = self.create_tool_calls(run) if allow_tool_calls else None
+            if required_action is None:
+                break
+
+            self.run_resumed[run["id"]] = asyncio.Event()
+            run["status"] = "requires_action"
+            run["required_action"] = required_action
+            await self.run_resumed[run["id"]].wait()
+            allow_tool_calls = False
+
+        content = self.generate_reply(run.get("additional_instructions"))
+        for _ in self.split_into_deltas(content["value"]):
+            await self.latencies["token_delta"].sleep()
+            if run["id"] in self.cancelled_runs:
+                return self.finish_run(run, "cancelled")
+
+        self.threads[run["thread_id"]].append(
+            self.create_message_object(
+                run["thread_id"],
+                "assistant",
+                content["value"],
+                run=run,
+                annotations=content["annotations"],
+            )
+        )
+        self.finish_run(run, "completed")
+
+    async def stream_run(
+        self, request: web.Request, run: dict, allow_tool_calls: bool = True
+    ) -> web.StreamResponse:
+        """
+        Advances a run while streaming its events to the client.
+
+        Parameters:
+        - request (web.Request): The request creating or resuming the run.
+        - run (dict): The run.
+        - allow_tool_calls (bool): Whether the run may call a tool.
+
+        Returns:
+        - web.StreamResponse: The stream of the events.
+        """
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(event: str, data):
+            payload = data if isinstance(data, str) else json.dumps(data)
+            await response.write(f"event: {event}\ndata: {payload}\n\n".encode("utf-8"))
+
+        if run["started_at"] is None:
+            await send("thread.run.created", run)
+        await send("thread.run.queued", run)
+
+        await self.latencies["run_queue"].sleep()
+        if run["id"] in self.cancelled_runs:
+            self.finish_run(run, "cancelled")
+            await send("thread.run.cancelled", run)
+            await send("done", "[DONE]")
+            return response
+
+        run["status"] = "in_progress"
+        run["started_at"] = run["started_at"] or int(time.time())
+        await send("thread.run.in_progress", run)
+
+        await self.latencies["first_token"].sleep()
+        required_action = self.create_tool_calls(run) if allow_tool_calls else None
+        if required_action is not None:
+            run["status"] = "requires_action"
+            run["required_action"] = required_action
+            await send("thread.run.requires_action", run)
+            await send("done", "[DONE]")
+            return response
+
+        content = self.generate_reply(run.get("additional_instructions"))
+        message = self.create_message_object(
+            run["thread_id"], "assistant", "", run=run, status="in_progress"
+        )
+        message["content"] = []
+        await send("thread.message.created", message)
+
+        for index, delta in enumerate(self.split_into_deltas(content["value"])):
+            if index:
+                await self.latencies["token_delta"].sleep()
+            if run["id"] in self.cancelled_runs:
+                self.finish_run(run, "cancelled")
+                await send("thread.run.cancelled", run)
+                await send("done", "[DONE]")
+                return response
+            await send(
+                "thread.message.delta",
+                {
+                    "id": message["id"],
+                    "object": "thread.message.delta",
+                    "delta": {
+                        "content": [
+                            {"index": 0, "type": "text", "text": {"value": delta}}
+                        ]
+                    },
+                },
+            )
+
+        message["status"] = "completed"
+        message["content"] = [{"type": "text", "text": content}]
+        self.threads[run["thread_id"]].append(message)
+        await send("thread.message.completed", message)
+
+        self.finish_run(run, "completed")
+        await send("thread.run.completed", run)
+        await send("done", "[DONE]")
+        return response
+
+    # Audio and chat completions.
+
+    async def create_transcription(self, request: web.Request) -> web.Response:
+        form = await request.post()
+        form["file"].file.read()
+        await self.latencies["transcription"].sleep()
+        text = " ".join(random.sample(SENTENCES, 2))
+        if form.get("response_format", "json") == "text":
+            return web.Response(text=text + "\n")
+        return web.json_response({"text": text})
+
+    async def create_speech(self, request: web.Request) -> web.StreamResponse:
+        await request.json()
+        await self.latencies["speech"].sleep()
+
+        response = web.StreamResponse(headers={"Content-Type": "audio/ogg"})
+        await response.prepare(request)
+        for start in range(0, len(self.speech_audio), self.speech_chunk_size):
+            if start:
+                await self.latencies["speech_chunk"].sleep()
+            await response.write(
+                self.speech_audio[start : start + self.speech_chunk_size]
+            )
+        await response.write_eof()
+        return response
+
+    async def create_chat_completion(self, request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        await self.latencies["chat"].sleep()
+
+        message = {"role": "assistant", "content": None}
+        tool_choice = body.get("tool_choice")
+        functions = [tool["function"] for tool in body.get("tools", [])]
+        function = None
+        if isinstance(tool_choice, dict):
+            function = next(
+                function
+                for function in functions
+                if function["name"] == tool_choice["function"]["name"]
+            )
+        elif (
+            functions
+            and tool_choice != "none"
+            and body["messages"][-1]["role"] == "user"
+            and random.random() < self.tool_call_rate
+        ):
+            # Like the runs, a reply to the user calls a tool first at the configured rate.
+            function = random.choice(functions)
+        if function is not None:
+            message["tool_calls"] = [
+                {
+                    "id": self.new_id("call"),
+                    "type": "function",
+                    "function": {
+                        "name": function["name"],
+                        "arguments": json.dumps(
+                            fake_arguments(function.get("parameters", {}))
+                        ),
+                    },
+                }
+            ]
+        else:
+            message["content"] = self.generate_reply(
+                body["messages"][0]["content"]
+                if body["messages"][0]["role"] == "system"
+                else None
+            )["value"]
+
+        completion = {
+            "id": self.new_id("chatcmpl"),
+            "created": int(time.time()),
+            "model": body["model"],
+        }
+        usage = {"prompt_tokens": 500, "completion_tokens": 50, "total_tokens": 550}
+
+        if not body.get("stream"):
+            return web.json_response(
+                {
+                    **completion,
+                    "object": "chat.completion",
+                    "choices": [
+                        {
+                            "index": 0,
+                            "message": message,
+                            "finish_reason": (
+                                "tool_calls" if message.get("tool_calls") else "stop"
+                            ),
+                        }
+                    ],
+                    "usage": usage,
+                }
+            )
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(delta: dict, finish_reason: str = None):
+            chunk = {
+                **completion,
+                "object": "chat.completion.chunk",
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+
+        if message.get("tool_calls"):
+            tool_call = message["tool_calls"][0]
+            await send({"role": "assistant", "tool_calls": [{"index": 0, **tool_call}]})
+            await send({}, "tool_calls")
+        else:
+            await send({"role": "assistant", "content": ""})
+            for delta in self.split_into_deltas(message["content"]):
+                await self.latencies["token_delta"].sleep()
+                await send({"content": delta})
+            await send({}, "stop")
+
+        if body.get("stream_options", {}).get("include_usage"):
+            chunk = {
+                **completion,
+                "object": "chat.completion.chunk",
+                "choices": [],
+                "usage": usage,
+            }
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+
+def fake_arguments(schema: dict):
+    """
+    Generates a value matching a JSON schema, used as the arguments of the fake tool calls.
+
+    Parameters:
+    - schema (dict): The JSON schema.
+
+    Returns:
+    - Any: The value.
+    """
+
+    if "enum" in schema:
+        return random.choice(schema["enum"])
+
+    schema_type = schema.get("type", "object")
+    if schema_type == "object":
+        return {
+            name: fake_arguments(property_schema)
+            for name, property_schema in schema.get("properties", {}).items()
+        }
+    if schema_type == "array":
+        return [fake_arguments(schema.get("items", {})) for _ in range(2)]
+    if schema_type == "boolean":
+        return True
+    if schema_type in ("integer", "number"):
+        return 1
+    return random.choice(["family", "health", "career"])
@@ -0,0 +1,277 @@
+import io
+import itertools
+import math
+import os
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+from aiohttp import web
+from PIL import Image
+
+from .latency import Latency
+
+
+class FakeTelegram:
+    """
+    A class for serving a local stand-in of the Telegram Bot API used by the handlers of the bot.
+
+    It answers the methods sending, editing and deleting messages and voice messages, and serves the files
+    of the synthetic updates: voice messages with tone bursts separated by pauses, and photos.
+    The calls are recorded by chat, so that the time of each reply can be measured.
+    """
+
+    # The latencies of the methods, in seconds.
+    default_latencies = {
+        "request": Latency(0.03, 0.3),
+        "send_voice": Latency(0.15, 0.4),
+        "download": Latency(0.05, 0.3),
+    }
+
+    bot_user = {
+        "id": 123456,
+        "is_bot": True,
+        "first_name": "Benchmark",
+        "username": "benchmark_bot",
+    }
+
+    def __init__(self, latencies: Dict[str, Latency] = None):
+        """
+        Initializes the server.
+
+        Parameters:
+        - latencies (Dict[str, Latency]): The latencies overriding the default ones, by operation.
+        """
+
+        self.latencies = {**self.default_latencies, **(latencies or {})}
+        self.message_ids = itertools.count(1_000_000)
+        # Maps chat IDs to the calls of the methods in the chat: (time of the call, method).
+        self.calls: Dict[int, List[Tuple[float, str]]] = defaultdict(list)
+        self.requests = Counter()
+        self.uploaded_bytes = 0
+        self.file_cache: Dict[str, bytes] = {}
+        self.webhook_url = ""
+        self.runner: Optional[web.AppRunner] = None
+
+    def create_app(self) -> web.Application:
+        """
+        Creates the application serving the Bot API methods and files.
+
+        Returns:
+        - web.Application: The application.
+        """
+
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.call_method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.download_file)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """
+        Starts the server.
+
+        Parameters:
+        - host (str): The host to listen on.
+        - port (int): The port to listen on, 0 for any free port.
+
+        Returns:
+        - str: The base URL of the API, to be used as TELEGRAM_API_URL.
+        """
+
+        self.runner = web.AppRunner(self.create_app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        return f"http://{host}:{port}"
+
+    async def stop(self):
+        """
+        Stops the server.
+
+        Returns:
+        - None
+        """
+
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    def get_calls(self, chat_id: int, since: float) -> List[Tuple[float, str]]:
+        """
+        Returns the calls of the methods in a chat made since a moment.
+
+        Parameters:
+        - chat_id (int): The ID of the chat.
+        - since (float): The moment, as returned by time.perf_counter().
+
+        Returns:
+        - List[Tuple[float, str]]: The times of the calls and their methods.
+        """
+
+        return [call for call in self.calls[chat_id] if call[0] >= since]
+
+    def get_metrics(self) -> dict:
+        """
+        Returns the statistics of the server.
+
+        Returns:
+        - dict: The number of calls by method and the number of bytes of the uploaded voice messages.
+        """
+
+        return {"requests": dict(self.requests), "uploaded_bytes": self.uploaded_bytes}
+
+    async def call_method(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.requests[method] += 1
+        await self.latencies["request"].sleep()
+
+        fields = await self.read_fields(request)
+        if method == "sendVoice":
+            await self.latencies["send_voice"].sleep()
+
+        chat_id = int(fields["chat_id"]) if "chat_id" in fields else None
+        if chat_id is not None:
+            self.calls[chat_id].append((time.perf_counter(), method))
+
+        if method == "getMe":
+            result = self.bot_user
+        elif method in ("sendMessage", "editMessageText", "sendVoice"):
+            result = {
+                "message_id": (
+                    int(fields["message_id"])
+                    if method == "editMessageText"
+                    else next(self.message_ids)
+                ),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": self.bot_user,
+            }
+            if method == "sendVoice":
+                result["voice"] = {
+                    "file_id": f"answer-{result['message_id']}",
+                    "file_unique_id": f"answer-{result['message_id']}",
+                    "duration": 1,
+                }
+            else:
+                result["text"] = fields.get("text", "")
+        elif method == "setWebhook":
+            self.webhook_url = fields["url"]
+            result = True
+        elif method == "getWebhookInfo":
+            result = {
+                "url": self.webhook_url,
+                "has_custom_certificate": False,
+                "pending_update_count": 0,
+            }
+        elif method == "getFile":
+            file_id = fields["file_id"]
+            result = {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": len(self.get_file(file_id)),
+                "file_path": f"files/{file_id}",
+            }
+        else:
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def read_fields(self, request: web.Request) -> Dict[str, str]:
+        """
+        Reads the fields of a method call, sent either URL-encoded or as multipart form data with the uploaded files.
+        The uploaded files are read as they are received and only counted.
+
+        Parameters:
+        - request (web.Request): The request.
+
+        Returns:
+        - Dict[str, str]: The fields other than the uploaded files.
+        """
+
+        if not request.content_type.startswith("multipart/"):
+            return dict(await request.post())
+
+        fields = {}
+        reader = await request.multipart()
+        async for part in reader:
+            if part.filename is None:
+                fields[part.name] = await part.text()
+                continue
+            while chunk := await part.read_chunk():
+                self.uploaded_bytes += len(chunk)
+        return fields
+
+    async def download_file(self, request: web.Request) -> web.Response:
+        self.requests["download"] += 1
+        await self.latencies["download"].sleep()
+        file_id = os.path.basename(request.match_info["path"])
+        return web.Response(body=self.get_file(file_id))
+
+    def get_file(self, file_id: str) -> bytes:
+        """
+        Returns the content of a file of the synthetic updates, generated on the first request.
+
+        The file ID tells the content: 'voice-<seconds>-<n>' is a voice message of the given length,
+        'photo-<side>-<n>' is a square photo with the given side.
+
+        Parameters:
+        - file_id (str): The file ID.
+
+        Returns:
+        - bytes: The content of the file.
+        """
+
+        kind, size, _ = file_id.split("-", 2)
+        key = f"{kind}-{size}"
+        if key not in self.file_cache:
+            if kind == "voice":
+                self.file_cache[key] = generate_voice(float(size))
+            else:
+                self.file_cache[key] = generate_photo(int(size))
+        return self.file_cache[key]
+
+
+def generate_voice(seconds: float, sample_rate: int = 16000) -> bytes:
+    """
+    Generates a voice message with tone bursts separated by short pauses, which is detected as speech.
+    Without PyAV, random bytes are returned, which the bot uploads for transcription as they are.
+
+    Parameters:
+    - seconds (float): The length of the voice message.
+    - sample_rate (int): The sample rate of the audio.
+
+    Returns:
+    - bytes: The OGG/Opus file.
+    """
+
+    # Imported here, as the utils depend on the settings, which are configured by the harness first.
+    from utils.audio_tools import encode_audio, is_audio_processing_available
+
+    if not is_audio_processing_available():
+        return os.urandom(int(seconds * 3000))
+
+    import numpy as np
+
+    time_axis = np.arange(int(seconds * sample_rate)) / sample_rate
+    tone = np.sin(2 * math.pi * 220 * time_axis) * 0.3
+    # Bursts of 0.7 seconds separated by 0.3 seconds of silence, like words and pauses.
+    envelope = (time_axis % 1.0) < 0.7
+    samples = (tone * envelope * 32767).astype(np.int16)
+    return encode_audio(samples, sample_rate).getvalue()
+
+
+def generate_photo(side: int) -> bytes:
+    """
+    Generates a photo with a gradient.
+
+    Parameters:
+    - side (int): The width and the height of the photo.
+
+    Returns:
+    - bytes: The JPEG file.
+    """
+
+    image = Image.linear_gradient("L").resize((side, side)).convert("RGB")
+    result = io.BytesIO()
+    image.save(result, format="JPEG", quality=85)
+    return result.getvalue()
@@ -0,0 +1,62 @@
+import asyncio
+import math
+import random
+
+
+class Latency:
+    """
+    A class for simulating the latency of a remote operation with a lognormal distribution,
+    which has the long right tail typical for network services.
+    """
+
+    def __init__(self, median: float, sigma: float = 0.0):
+        """
+        Initializes the distribution.
+
+        Parameters:
+        - median (float): The median latency, in seconds.
+        - sigma (float): The standard deviation of the logarithm of the latency. 0 makes the latency constant.
+        """
+
+        self.median = median
+        self.sigma = sigma
+
+    @classmethod
+    def parse(cls, spec: str) -> "Latency":
+        """
+        Parses a distribution given as '<median>' or '<median>:<sigma>', e.g. '0.8:0.4'.
+
+        Parameters:
+        - spec (str): The specification of the distribution.
+
+        Returns:
+        - Latency: The distribution.
+        """
+
+        median, _, sigma = spec.partition(":")
+        return cls(float(median), float(sigma or 0.0))
+
+    def sample(self) -> float:
+        """
+        Returns a random latency from the distribution.
+
+        Returns:
+        - float: The latency, in seconds.
+        """
+
+        if self.median <= 0:
+            return 0.0
+        return self.median * math.exp(random.gauss(0.0, self.sigma))
+
+    async def sleep(self):
+        """
+        Waits for a random latency from the distribution.
+
+        Returns:
+        - None
+        """
+
+        await asyncio.sleep(self.sample())
+
+    def __repr__(self) -> str:
+        return f"{self.median}:{self.sigma}"
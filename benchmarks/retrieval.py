@@ -0,0 +1,111 @@
+"""
+Measures the latency of the local retrieval: loading the index and searching it, uncached and cached.
+
+The passages of the knowledge files can be replicated to measure an index larger than the files at hand.
+Run it from the root of the repository, e.g.:
+
+    python -m benchmarks.retrieval --queries 10000 --scale 100 "knowledge/Statements about Anxiety/Anxiety.docx"
+"""
+
+import argparse
+import random
+import tempfile
+import time
+from typing import List
+
+from retrieval import Bm25Index, Passage, read_passages
+
+from .run import TEXTS, summarize
+
+
+def create_queries(passages: List[Passage], count: int) -> List[str]:
+    """
+    Creates queries: the texts of the synthetic users and random spans of the passages.
+
+    Parameters:
+    - passages (List[Passage]): The passages.
+    - count (int): The number of queries.
+
+    Returns:
+    - List[str]: The queries.
+    """
+
+    queries = []
+    for _ in range(count):
+        if random.random() < 0.5:
+            queries.append(random.choice(TEXTS))
+            continue
+        words = random.choice(passages).text.split()
+        start = random.randrange(max(len(words) - 8, 1))
+        queries.append(" ".join(words[start : start + random.randint(3, 8)]))
+    return queries
+
+
+def measure(search, queries: List[str]) -> dict:
+    latencies = []
+    for query in queries:
+        started_at = time.perf_counter()
+        search(query)
+        latencies.append((time.perf_counter() - started_at) * 1000)
+    return summarize(latencies)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measures the latency of the local retrieval."
+    )
+    parser.add_argument("files", nargs="+", help="Knowledge files: .docx, .txt or .md.")
+    parser.add_argument("--queries", type=int, default=10000, help="Queries to run.")
+    parser.add_argument(
+        "--scale",
+        type=int,
+        default=1,
+        help="Number of copies of the passages in the index.",
+    )
+    parser.add_argument("--top-k", type=int, default=3, help="Passages per query.")
+    parser.add_argument("--seed", type=int, help="Seed of the random generator.")
+    args = parser.parse_args()
+    if args.seed is not None:
+        random.seed(args.seed)
+
+    passages = [passage for path in args.files for passage in read_passages(path)]
+    queries = create_queries(passages, args.queries)
+
+    with tempfile.TemporaryDirectory() as directory:
+        index_path = Bm25Index.storage_path(directory, "benchmark")
+        started_at = time.perf_counter()
+        Bm25Index.build(passages * args.scale).save(index_path)
+        build_seconds = time.perf_counter() - started_at
+
+        started_at = time.perf_counter()
+        index = Bm25Index.load(index_path)
+        load_seconds = time.perf_counter() - started_at
+
+        # Imported here, as the services read the settings from the environment.
+        from services import RetrievalService
+
+        RetrievalService.indexes = {"benchmark": index}
+        RetrievalService.config["top_k"] = args.top_k
+        results = {
+            "index": measure(lambda query: index.search(query, args.top_k), queries),
+            "service": measure(RetrievalService.search, queries),
+        }
+
+    print(
+        f"\n{len(passages) * args.scale} passages, {len(index.terms)} terms, "
+        f"{len(index.weights)} postings: built in {build_seconds:.2f}s, loaded in {load_seconds * 1000:.1f}ms\n"
+    )
+    print(
+        f"{'search (ms)':<14}{'count':>7}{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}"
+    )
+    for name, stats in results.items():
+        print(
+            f"{name:<14}{stats['count']:>7}"
+            + "".join(
+                f"{stats[key]:>9.3f}" for key in ("mean", "p50", "p95", "p99", "max")
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,537 @@
+"""
+Runs the bot against local stand-ins of the OpenAI and Telegram APIs and reports its latency and throughput.
+
+The real dispatcher and routers of main.py handle synthetic text, voice and photo messages of concurrent users,
+so every change of the message handling can be measured without the live services. Run it from the root
+of the repository, e.g.:
+
+    python -m benchmarks.run --users 20 --messages 5 --mix text=0.6,voice=0.3,photo=0.1
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+from aiogram.types import Update
+from loguru import logger
+
+from .fake_openai import FakeOpenAI
+from .fake_telegram import FakeTelegram
+from .latency import Latency
+
+# The handler of each kind of synthetic message.
+HANDLERS = {
+    "start": "cmd_start",
+    "text": "text_message",
+    "voice": "voice_message",
+    "photo": "image",
+}
+
+# The sides of the sizes of the synthetic photos, as Telegram sends them.
+PHOTO_SIDES = [90, 320, 800, 1280]
+
+TEXTS = [
+    "Привет! Мне в последнее время очень тревожно.",
+    "Что мне делать, если я не могу уснуть из-за мыслей о работе?",
+    "Для меня важнее всего семья и здоровье.",
+    "Расскажи, как справляться со стрессом перед экзаменом.",
+]
+
+
+def percentile(values: List[float], share: float) -> float:
+    """
+    Returns the percentile of the values, interpolating between the closest ranks.
+
+    Parameters:
+    - values (List[float]): The values, sorted.
+    - share (float): The share of the values below the percentile, from 0 to 1.
+
+    Returns:
+    - float: The percentile.
+    """
+
+    if not values:
+        return float("nan")
+    position = (len(values) - 1) * share
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def summarize(values: List[float]) -> dict:
+    values = sorted(values)
+    return {
+        "count": len(values),
+        "mean": sum(values) / len(values) if values else float("nan"),
+        "p50": percentile(values, 0.5),
+        "p95": percentile(values, 0.95),
+        "p99": percentile(values, 0.99),
+        "max": values[-1] if values else float("nan"),
+    }
+
+
+class Benchmark:
+    """
+    A class for driving the dispatcher with the messages of concurrent synthetic users and recording the latencies.
+    """
+
+    def __init__(self, args: argparse.Namespace, fake_telegram: FakeTelegram):
+        """
+        Initializes the benchmark.
+
+        Parameters:
+        - args (argparse.Namespace): The command line arguments.
+        - fake_telegram (FakeTelegram): The Telegram stand-in the bot replies through.
+        """
+
+        self.args = args
+        self.fake_telegram = fake_telegram
+        self.mix = parse_mix(args.mix)
+        self.update_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+        # Maps the handlers to the latencies of the replies, by milestone.
+        self.latencies: Dict[str, Dict[str, List[float]]] = defaultdict(
+            lambda: defaultdict(list)
+        )
+        self.errors: Dict[str, int] = defaultdict(int)
+
+    def create_message(self, user_id: int, kind: str) -> dict:
+        """
+        Creates the message of a synthetic update.
+
+        Parameters:
+        - user_id (int): The ID of the user, also the ID of the private chat.
+        - kind (str): The kind of the message: 'start', 'text', 'voice' or 'photo'.
+
+        Returns:
+        - dict: The message, as sent by Telegram.
+        """
+
+        message = {
+            "message_id": next(self.update_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": f"User {user_id}"},
+        }
+        file_number = next(self.file_ids)
+        if kind == "start":
+            message["text"] = "/start"
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": 6}]
+        elif kind == "text":
+            message["text"] = random.choice(TEXTS)
+        elif kind == "voice":
+            seconds = self.args.voice_seconds
+            message["voice"] = {
+                "file_id": f"voice-{seconds:g}-{file_number}",
+                "file_unique_id": f"voice-{file_number}",
+                "duration": int(seconds),
+                "mime_type": "audio/ogg",
+            }
+        elif kind == "photo":
+            message["photo"] = [
+                {
+                    "file_id": f"photo-{side}-{file_number}",
+                    "file_unique_id": f"photo-{side}-{file_number}",
+                    "width": side,
+                    "height": side,
+                }
+                for side in PHOTO_SIDES
+            ]
+        return message
+
+    async def send(self, dp, bot, user_id: int, kind: str):
+        """
+        Feeds a synthetic update to the dispatcher and records the latencies of the reply.
+
+        Parameters:
+        - dp (Dispatcher): The dispatcher.
+        - bot (Bot): The bot.
+        - user_id (int): The ID of the user.
+        - kind (str): The kind of the message.
+
+        Returns:
+        - None
+        """
+
+        handler = HANDLERS[kind]
+        update = Update.model_validate(
+            {
+                "update_id": next(self.update_ids),
+                "message": self.create_message(user_id, kind),
+            },
+            context={"bot": bot},
+        )
+
+        started_at = time.perf_counter()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logger.error(f"Error in benchmark while handling {kind} message: {e}")
+            self.errors[handler] += 1
+            return
+        finished_at = time.perf_counter()
+
+        latencies = self.latencies[handler]
+        latencies["total"].append(finished_at - started_at)
+        calls = self.fake_telegram.get_calls(user_id, started_at)
+        # The reply to /start is a new message. The other replies edit the wait message, which is sent first,
+        # or follow it as new messages.
+        text_calls = [
+            call_time
+            for call_time, method in calls
+            if method in ("sendMessage", "editMessageText")
+        ][0 if kind == "start" else 1 :]
+        voice_calls = [
+            call_time for call_time, method in calls if method == "sendVoice"
+        ]
+        for milestone, times in (
+            ("first_text", text_calls),
+            ("first_voice", voice_calls),
+        ):
+            if times:
+                latencies[milestone].append(times[0] - started_at)
+
+        # Every reply except the one to /start ends with a voice message; the handlers log and swallow errors.
+        if kind != "start" and not voice_calls:
+            self.errors[handler] += 1
+
+    async def run_user(self, dp, bot, user_id: int):
+        """
+        Starts the conversation of a user and sends their messages one after another.
+
+        Parameters:
+        - dp (Dispatcher): The dispatcher.
+        - bot (Bot): The bot.
+        - user_id (int): The ID of the user.
+
+        Returns:
+        - None
+        """
+
+        await self.send(dp, bot, user_id, "start")
+        kinds, weights = zip(*self.mix.items())
+        for _ in range(self.args.messages):
+            if self.args.think_time:
+                await Latency(self.args.think_time, 0.5).sleep()
+            await self.send(dp, bot, user_id, random.choices(kinds, weights)[0])
+
+    async def run(self, dp, bot) -> float:
+        """
+        Runs the conversations of all users concurrently.
+
+        Parameters:
+        - dp (Dispatcher): The dispatcher.
+        - bot (Bot): The bot.
+
+        Returns:
+        - float: The duration of the run, in seconds.
+        """
+
+        started_at = time.perf_counter()
+        await asyncio.gather(
+            *(
+                self.run_user(dp, bot, user_id)
+                for user_id in range(1000, 1000 + self.args.users)
+            )
+        )
+        return time.perf_counter() - started_at
+
+    def report(self, duration: float) -> dict:
+        """
+        Summarizes the recorded latencies.
+
+        Parameters:
+        - duration (float): The duration of the run, in seconds.
+
+        Returns:
+        - dict: The latency percentiles by handler and milestone, the error counts and the throughput.
+        """
+
+        handlers = {}
+        for handler, milestones in self.latencies.items():
+            handlers[handler] = {
+                milestone: summarize(values) for milestone, values in milestones.items()
+            }
+            handlers[handler]["errors"] = self.errors.get(handler, 0)
+        messages = sum(len(m["total"]) for m in self.latencies.values())
+        return {
+            "users": self.args.users,
+            "duration": duration,
+            "messages": messages,
+            "throughput": messages / duration if duration else 0.0,
+            "handlers": handlers,
+        }
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    """
+    Parses the mix of message kinds, e.g. 'text=0.6,voice=0.3,photo=0.1'.
+
+    Parameters:
+    - spec (str): The specification of the mix.
+
+    Returns:
+    - Dict[str, float]: The weights of the kinds.
+    """
+
+    mix = {}
+    for part in spec.split(","):
+        kind, _, weight = part.partition("=")
+        if kind.strip() not in ("text", "voice", "photo"):
+            raise argparse.ArgumentTypeError(f"Unknown message kind: {kind}")
+        mix[kind.strip()] = float(weight or 1.0)
+    return mix
+
+
+def parse_latencies(specs: List[str]) -> Dict[str, Latency]:
+    """
+    Parses the latency overrides given as '<operation>=<median>[:<sigma>]', e.g. 'first_token=1.5:0.5'.
+
+    Parameters:
+    - specs (List[str]): The overrides.
+
+    Returns:
+    - Dict[str, Latency]: The latencies by operation.
+    """
+
+    latencies = {}
+    for spec in specs:
+        operation, _, latency = spec.partition("=")
+        latencies[operation] = Latency.parse(latency)
+    return latencies
+
+
+def configure_environment(openai_url: str, telegram_url: str, work_dir: str):
+    """
+    Points the settings of the bot to the stand-ins. Must be called before the settings are imported.
+
+    Parameters:
+    - openai_url (str): The base URL of the OpenAI stand-in.
+    - telegram_url (str): The base URL of the Telegram stand-in.
+    - work_dir (str): The directory for the caches of the run.
+
+    Returns:
+    - None
+    """
+
+    os.environ.update(
+        {
+            "OPENAI_BASE_URL": openai_url,
+            "TELEGRAM_API_URL": telegram_url,
+            "TTS_CACHE_DIR": os.path.join(work_dir, "tts"),
+            "MEDIA_SPOOL_DIR": os.path.join(work_dir, "media"),
+            "RETRIEVAL_INDEX_PATH": os.path.join(work_dir, "retrieval"),
+            "ANALYTICS_SINK": "null",
+            "METRICS_PORT": "0",
+        }
+    )
+    # The services need the credentials to be set, but the stand-ins do not check them.
+    for name, value in (
+        ("BOT_KEY", f"{FakeTelegram.bot_user['id']}:benchmark"),
+        ("OPENAI_KEY", "benchmark"),
+        ("AMPLITUDE_KEY", "benchmark"),
+        ("DATABASE_URL", "postgresql+asyncpg://benchmark@localhost/benchmark"),
+        ("REDISHOST", "NoValue"),
+        ("REDISPASSWORD", "NoValue"),
+        ("REDISPORT", "NoValue"),
+        ("REDISUSER", "NoValue"),
+    ):
+        os.environ.setdefault(name, value)
+
+
+def print_report(report: dict):
+    print(
+        f"\n{report['messages']} messages of {report['users']} users in {report['duration']:.1f}s "
+        f"({report['throughput']:.2f} messages/s)\n"
+    )
+    print(
+        f"{'handler':<14}{'milestone':<13}{'count':>7}{'errors':>8}"
+        f"{'mean':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}"
+    )
+    for handler, milestones in sorted(report["handlers"].items()):
+        for milestone in ("total", "first_text", "first_voice"):
+            if milestone not in milestones:
+                continue
+            stats = milestones[milestone]
+            errors = milestones["errors"] if milestone == "total" else ""
+            print(
+                f"{handler:<14}{milestone:<13}{stats['count']:>7}{errors:>8}"
+                + "".join(
+                    f"{stats[key]:>9.3f}"
+                    for key in ("mean", "p50", "p95", "p99", "max")
+                )
+            )
+
+    openai_metrics = report["openai"]
+    print(f"\nOpenAI requests (429 injected: {openai_metrics['rate_limited']}):")
+    for route, count in sorted(openai_metrics["requests"].items()):
+        print(f"  {count:>7}  {route}")
+    telegram_metrics = report["telegram"]
+    print(
+        f"\nTelegram requests (voice uploaded: {telegram_metrics['uploaded_bytes']} bytes):"
+    )
+    for method, count in sorted(telegram_metrics["requests"].items()):
+        print(f"  {count:>7}  {method}")
+
+
+async def run(args: argparse.Namespace) -> dict:
+    """
+    Starts the stand-ins and the services of the bot, runs the benchmark and reports the results.
+
+    Parameters:
+    - args (argparse.Namespace): The command line arguments.
+
+    Returns:
+    - dict: The report.
+    """
+
+    latencies = parse_latencies(args.latency)
+    fake_openai = FakeOpenAI(
+        latencies={
+            operation: latency
+            for operation, latency in latencies.items()
+            if operation in FakeOpenAI.default_latencies
+        },
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after_ms=args.retry_after_ms,
+        reply_sentences=args.reply_sentences,
+        tool_call_rate=args.tool_call_rate,
+    )
+    fake_telegram = FakeTelegram(
+        latencies={
+            operation[len("telegram_") :]: latency
+            for operation, latency in latencies.items()
+            if operation.startswith("telegram_")
+        }
+    )
+    openai_url = await fake_openai.start()
+    telegram_url = await fake_telegram.start()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        configure_environment(openai_url, telegram_url, work_dir)
+
+        # Imported here, as the settings are read from the environment configured above.
+        from aiogram.fsm.storage.memory import MemoryStorage
+
+        import main
+        from config import settings
+        from services import TtsService
+
+        dp = main.create_dispatcher(storage=MemoryStorage())
+        bot = settings.bot
+        await main.initialize_services(settings.async_client)
+
+        try:
+            if not args.no_prewarm:
+                await TtsService.prewarm()
+            # The synthetic files are generated before the run, so that it does not measure their generation.
+            fake_telegram.get_file(f"voice-{args.voice_seconds:g}-0")
+            fake_telegram.get_file(f"photo-{PHOTO_SIDES[2]}-0")
+
+            benchmark = Benchmark(args, fake_telegram)
+            report = benchmark.report(await benchmark.run(dp, bot))
+            report["openai"] = fake_openai.get_metrics()
+            report["telegram"] = fake_telegram.get_metrics()
+        finally:
+            await main.shutdown_services()
+            await bot.session.close()
+            await fake_openai.stop()
+            await fake_telegram.stop()
+
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as file:
+            json.dump(report, file, indent=2, ensure_ascii=False)
+    return report
+
+
+def parse_args(argv: List[str] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the bot against local stand-ins of the OpenAI and Telegram APIs."
+    )
+    parser.add_argument("--users", type=int, default=10, help="Concurrent users.")
+    parser.add_argument(
+        "--messages",
+        type=int,
+        default=5,
+        help="Messages sent by each user after /start.",
+    )
+    parser.add_argument(
+        "--mix",
+        default="text=0.6,voice=0.3,photo=0.1",
+        help="Weights of the message kinds, e.g. 'text=0.6,voice=0.3,photo=0.1'.",
+    )
+    parser.add_argument(
+        "--think-time",
+        type=float,
+        default=0.0,
+        help="Median pause of a user between receiving a reply and sending the next message, in seconds.",
+    )
+    parser.add_argument(
+        "--voice-seconds", type=float, default=8.0, help="Length of the voice messages."
+    )
+    parser.add_argument(
+        "--reply-sentences",
+        type=int,
+        default=3,
+        help="Sentences in the replies of the assistant.",
+    )
+    parser.add_argument(
+        "--latency",
+        action="append",
+        default=[],
+        metavar="OPERATION=MEDIAN[:SIGMA]",
+        help=(
+            "Overrides a lognormal latency, in seconds. OpenAI operations: "
+            + ", ".join(FakeOpenAI.default_latencies)
+            + "; Telegram operations, prefixed with 'telegram_': "
+            + ", ".join(FakeTelegram.default_latencies)
+            + "."
+        ),
+    )
+    parser.add_argument(
+        "--rate-limit-rate",
+        type=float,
+        default=0.0,
+        help="Share of the model requests rejected with 429.",
+    )
+    parser.add_argument(
+        "--retry-after-ms",
+        type=int,
+        default=500,
+        help="Delay requested by the 429 responses.",
+    )
+    parser.add_argument(
+        "--tool-call-rate",
+        type=float,
+        default=0.0,
+        help="Share of the runs calling a tool first. The tool saves the values in the database, which must be running.",
+    )
+    parser.add_argument(
+        "--no-prewarm",
+        action="store_true",
+        help="Do not synthesize the constant phrases before the run.",
+    )
+    parser.add_argument("--seed", type=int, help="Seed of the random generators.")
+    parser.add_argument("--output", help="Path of a JSON file to write the report to.")
+    parser.add_argument(
+        "--log-level", default="WARNING", help="Level of the logs of the bot."
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    if arguments.seed is not None:
+        random.seed(arguments.seed)
+    logger.remove()
+    logger.add(sys.stderr, level=arguments.log_level)
+    asyncio.run(run(arguments))
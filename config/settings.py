@@ -1,10 +1,15 @@
+import hashlib
 import os
-from concurrent.futures import ThreadPoolExecutor
+import tempfile
+from typing import Optional
 
 from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from openai import AsyncOpenAI
 from pydantic import Field
 from pydantic_settings import BaseSettings
+from redis.asyncio import BlockingConnectionPool, Redis
 
 
 class Settings(BaseSettings):
@@ -20,45 +25,173 @@ class Settings(BaseSettings):
     REDISPASSWORD: str = Field(env="REDISPASSWORD")
     REDISPORT: str = Field(env="REDISPORT")
     REDISUSER: str = Field(env="REDISUSER")
+    # The connection pool of the Redis client, shared by the FSM storage, the locks and the job queue.
+    REDIS_MAX_CONNECTIONS: int = Field(default=64, env="REDIS_MAX_CONNECTIONS")
+    REDIS_POOL_TIMEOUT: float = Field(default=5.0, env="REDIS_POOL_TIMEOUT")
+    REDIS_SOCKET_TIMEOUT: Optional[float] = Field(
+        default=None, env="REDIS_SOCKET_TIMEOUT"
+    )
+    REDIS_SOCKET_CONNECT_TIMEOUT: float = Field(
+        default=5.0, env="REDIS_SOCKET_CONNECT_TIMEOUT"
+    )
+    REDIS_HEALTH_CHECK_INTERVAL: int = Field(
+        default=30, env="REDIS_HEALTH_CHECK_INTERVAL"
+    )
+    FSM_CACHE_SIZE: int = Field(default=10000, env="FSM_CACHE_SIZE")
+    FSM_CACHE_TTL: float = Field(default=300.0, env="FSM_CACHE_TTL")
+    # The number of tokens of the context of a conversation above which it is rolled over with a summary.
+    CONTEXT_MAX_TOKENS: int = Field(default=8000, env="CONTEXT_MAX_TOKENS")
+    CONTEXT_SUMMARY_MODEL: str = Field(
+        default="gpt-3.5-turbo", env="CONTEXT_SUMMARY_MODEL"
+    )
+    # How the assistant answers: "assistants" for the Assistants API, or "chat" for chat completions.
+    CONVERSATION_BACKEND: str = Field(default="assistants", env="CONVERSATION_BACKEND")
+    CHAT_HISTORY_MESSAGES: int = Field(default=40, env="CHAT_HISTORY_MESSAGES")
+    # The directory of the knowledge files, with a subdirectory per vector storage, scanned for changes periodically.
+    KNOWLEDGE_DIR: str = Field(default="knowledge", env="KNOWLEDGE_DIR")
+    KNOWLEDGE_POLL_INTERVAL: float = Field(default=30.0, env="KNOWLEDGE_POLL_INTERVAL")
+    KNOWLEDGE_MAX_CONCURRENT_UPLOADS: int = Field(
+        default=4, env="KNOWLEDGE_MAX_CONCURRENT_UPLOADS"
+    )
+    # How the knowledge files are searched: "file_search" in the vector storages, or "local" in local indexes.
+    KNOWLEDGE_RETRIEVAL: str = Field(default="file_search", env="KNOWLEDGE_RETRIEVAL")
+    RETRIEVAL_INDEX_PATH: str = Field(
+        default=".cache/retrieval", env="RETRIEVAL_INDEX_PATH"
+    )
+    RETRIEVAL_TOP_K: int = Field(default=3, env="RETRIEVAL_TOP_K")
+    STREAM_RESPONSES: bool = Field(default=True, env="STREAM_RESPONSES")
+    STREAM_EDIT_INTERVAL: float = Field(default=1.5, env="STREAM_EDIT_INTERVAL")
+    STREAM_VOICE: bool = Field(default=True, env="STREAM_VOICE")
+    MEDIA_SPOOL_DIR: str = Field(
+        default=os.path.join(tempfile.gettempdir(), "ai-voice-assistant"),
+        env="MEDIA_SPOOL_DIR",
+    )
+    MEDIA_SPOOL_THRESHOLD: int = Field(
+        default=5 * 1024 * 1024, env="MEDIA_SPOOL_THRESHOLD"
+    )
+    TTS_CACHE_DIR: str = Field(default=".cache/tts", env="TTS_CACHE_DIR")
+    TTS_CACHE_MEMORY_SIZE: int = Field(
+        default=32 * 1024 * 1024, env="TTS_CACHE_MEMORY_SIZE"
+    )
+    TTS_CACHE_DISK_SIZE: int = Field(
+        default=512 * 1024 * 1024, env="TTS_CACHE_DISK_SIZE"
+    )
+    ANALYTICS_SINK: str = Field(default="amplitude", env="ANALYTICS_SINK")
+    ANALYTICS_FILE_PATH: str = Field(
+        default="analytics_events.jsonl", env="ANALYTICS_FILE_PATH"
+    )
+    ANALYTICS_BUFFER_SIZE: int = Field(default=10000, env="ANALYTICS_BUFFER_SIZE")
+    ANALYTICS_BATCH_SIZE: int = Field(default=100, env="ANALYTICS_BATCH_SIZE")
+    ANALYTICS_FLUSH_INTERVAL: float = Field(default=5.0, env="ANALYTICS_FLUSH_INTERVAL")
+    ANALYTICS_OVERFLOW_POLICY: str = Field(
+        default="drop_oldest", env="ANALYTICS_OVERFLOW_POLICY"
+    )
+    ANALYTICS_SAMPLE_RATE: float = Field(default=0.1, env="ANALYTICS_SAMPLE_RATE")
+    METRICS_HOST: str = Field(default="0.0.0.0", env="METRICS_HOST")
+    METRICS_PORT: int = Field(default=9090, env="METRICS_PORT")
+    # How the updates are received: "polling", or "webhook" to run several replicas behind a load balancer.
+    BOT_MODE: str = Field(default="polling", env="BOT_MODE")
+    WEBHOOK_URL: Optional[str] = Field(default=None, env="WEBHOOK_URL")
+    WEBHOOK_PATH: str = Field(default="/webhook", env="WEBHOOK_PATH")
+    WEBHOOK_SECRET: Optional[str] = Field(default=None, env="WEBHOOK_SECRET")
+    WEBHOOK_HOST: str = Field(default="0.0.0.0", env="WEBHOOK_HOST")
+    WEBHOOK_PORT: int = Field(default=8080, env="WEBHOOK_PORT")
+    WEBHOOK_MAX_CONNECTIONS: int = Field(default=40, env="WEBHOOK_MAX_CONNECTIONS")
+    WEBHOOK_DRAIN_TIMEOUT: float = Field(default=30.0, env="WEBHOOK_DRAIN_TIMEOUT")
+    # The part of the work done by the process: "all", or "ingress" to enqueue the updates for the "worker" processes.
+    PROCESS_ROLE: str = Field(default="all", env="PROCESS_ROLE")
+    JOB_QUEUE_SHARDS: int = Field(default=16, env="JOB_QUEUE_SHARDS")
+    JOB_QUEUE_MAX_BACKLOG: int = Field(default=1000, env="JOB_QUEUE_MAX_BACKLOG")
+    JOB_MAX_ATTEMPTS: int = Field(default=3, env="JOB_MAX_ATTEMPTS")
+    JOB_LEASE_TIMEOUT: int = Field(default=60, env="JOB_LEASE_TIMEOUT")
+    WORKER_CONCURRENCY: int = Field(default=32, env="WORKER_CONCURRENCY")
+    # Alternative API servers, e.g. the local stand-ins of the benchmark harness.
+    OPENAI_BASE_URL: Optional[str] = Field(default=None, env="OPENAI_BASE_URL")
+    TELEGRAM_API_URL: Optional[str] = Field(default=None, env="TELEGRAM_API_URL")
 
     @property
     def bot(self) -> Bot:
         """
         Returns an instance of the Bot class, initialized with the BOT_KEY environment variable.
+        With TELEGRAM_API_URL, the bot talks to that Bot API server instead of the official one.
 
         Returns:
         - Bot: An instance of the Bot class.
         """
 
         if not hasattr(self, "_bot"):
-            self._bot = Bot(token=self.BOT_KEY)
+            session = None
+            if self.TELEGRAM_API_URL:
+                session = AiohttpSession(
+                    api=TelegramAPIServer.from_base(self.TELEGRAM_API_URL)
+                )
+            self._bot = Bot(token=self.BOT_KEY, session=session)
         return self._bot
 
+    @property
+    def webhook_secret(self) -> str:
+        """
+        Returns the secret token of the webhook. Without WEBHOOK_SECRET, it is derived from the bot token,
+        so that all replicas use the same one.
+
+        Returns:
+        - str: The secret token.
+        """
+
+        if self.WEBHOOK_SECRET:
+            return self.WEBHOOK_SECRET
+        return hashlib.sha256(f"webhook:{self.BOT_KEY}".encode("utf-8")).hexdigest()
+
     @property
     def async_client(self) -> AsyncOpenAI:
         """
         Returns an instance of the AsyncOpenAI class, initialized with the OPENAI_KEY environment variable.
+        All requests of the client are sent through the OpenAIScheduler, which also makes the retries.
 
         Returns:
         - AsyncOpenAI: An instance of the AsyncOpenAI class.
         """
 
         if not hasattr(self, "_async_client"):
-            self._async_client = AsyncOpenAI(api_key=self.OPENAI_KEY)
+            # Imported here, as the services depend on the settings.
+            from services.openai_scheduler import OpenAIScheduler
+
+            self._async_client = AsyncOpenAI(
+                api_key=self.OPENAI_KEY,
+                base_url=self.OPENAI_BASE_URL,
+                max_retries=0,
+                http_client=OpenAIScheduler.create_http_client(),
+            )
         return self._async_client
 
     @property
-    def thread_executor(self) -> ThreadPoolExecutor:
+    def redis(self) -> Redis:
         """
-        Returns a ThreadPoolExecutor instance for concurrent task execution.
+        Returns an instance of the Redis client, initialized with the REDIS* environment variables.
+        When all connections of the pool are in use, the commands wait for a free one up to REDIS_POOL_TIMEOUT.
 
         Returns:
-        - ThreadPoolExecutor: An instance of ThreadPoolExecutor configured with 5 worker threads.
+        - Redis: An instance of the Redis client.
         """
 
-        if not hasattr(self, "_thread_executor"):
-            self._thread_executor = ThreadPoolExecutor(max_workers=5)
-        return self._thread_executor
+        if not hasattr(self, "_redis"):
+            pool = BlockingConnectionPool(
+                host=self.REDISHOST if self.REDISHOST != "NoValue" else "redis",
+                username=self.REDISUSER if self.REDISUSER != "NoValue" else None,
+                password=(
+                    self.REDISPASSWORD if self.REDISPASSWORD != "NoValue" else None
+                ),
+                port=self.REDISPORT if self.REDISPORT != "NoValue" else 6379,
+                max_connections=self.REDIS_MAX_CONNECTIONS,
+                timeout=self.REDIS_POOL_TIMEOUT,
+                # The blocking reads of the job queue need no socket timeout, or a longer one.
+                socket_timeout=self.REDIS_SOCKET_TIMEOUT,
+                socket_connect_timeout=self.REDIS_SOCKET_CONNECT_TIMEOUT,
+                socket_keepalive=True,
+                health_check_interval=self.REDIS_HEALTH_CHECK_INTERVAL,
+            )
+            self._redis = Redis(connection_pool=pool)
+        return self._redis
 
     class Config:
         """
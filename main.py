@@ -1,19 +1,31 @@
 import asyncio
+import signal
 from asyncio.exceptions import CancelledError
 
-from aiogram import Dispatcher
-from aiogram.fsm.storage.redis import RedisStorage
+from aiogram import Bot, Dispatcher
+from aiogram.fsm.storage.base import BaseStorage
+from aiogram.types import Update
 from loguru import logger
+from openai import AsyncOpenAI
 from redis.asyncio import Redis
 
 from config import settings
+from monitoring import start_metrics_server
+from repositories import AssistantRegistryRepository
 from services import (
+    AnalyticsService,
     AssistantService,
+    ContextService,
+    ConversationScheduler,
     EmotionService,
+    JobQueue,
+    KnowledgeService,
+    RunPoller,
     SttService,
     TtsService,
     ValidateService,
 )
+from tg.middlewares import JobQueueMiddleware, MetricsMiddleware
 from tg.routers import (
     clear_command_router,
     get_sources_router,
@@ -23,34 +35,32 @@ from tg.routers import (
     text_message_router,
     voice_message_router,
 )
+from tg.storage import CachedRedisStorage
+from tg.utils import ReplyDelivery
+from tg.webhook import WebhookServer
 
 
-async def main():
+def create_dispatcher(storage: BaseStorage = None) -> Dispatcher:
     """
-    Initializes the bot, sets up routers for handling different types of messages and commands,
-    and starts the bot's polling loop.
+    Creates the dispatcher with the middlewares and the routers handling different types of messages and commands.
+
+    Parameters:
+    - storage (BaseStorage): The FSM storage, by default the Redis storage with a local cache.
 
     Returns:
-    - None
+    - Dispatcher: The dispatcher.
     """
 
-    redis = Redis(
-        host=settings.REDISHOST if settings.REDISHOST != "NoValue" else "redis",
-        username=settings.REDISUSER if settings.REDISUSER != "NoValue" else None,
-        password=settings.REDISPASSWORD if settings.REDISPASSWORD != "NoValue" else None,
-        port=settings.REDISPORT if settings.REDISPORT != "NoValue" else 6379,
+    dp = Dispatcher(
+        storage=storage
+        or CachedRedisStorage(
+            redis=settings.redis,
+            cache_size=settings.FSM_CACHE_SIZE,
+            cache_ttl=settings.FSM_CACHE_TTL,
+        )
     )
-    dp = Dispatcher(storage=RedisStorage(redis=redis))
 
-    bot = settings.bot
-    async_client = settings.async_client
-
-    # Initialize services with the async client.
-    await AssistantService.initialize(async_client=async_client)
-    ValidateService.initialize(async_client=async_client)
-    SttService.initialize(async_client=async_client)
-    TtsService.initialize(async_client=async_client)
-    EmotionService.initialize(async_client=async_client)
+    dp.message.middleware(MetricsMiddleware())
 
     # Include routers for handling different types of messages and commands.
     dp.include_router(get_sources_router)
@@ -61,10 +71,205 @@ async def main():
     dp.include_router(text_message_router)
     dp.include_router(voice_message_router)
 
-    logger.info("Bot started")
+    return dp
 
-    # Start the bot's polling loop.
-    await dp.start_polling(bot)
+
+async def initialize_services(
+    async_client: AsyncOpenAI,
+    registry: AssistantRegistryRepository = None,
+    redis: Redis = None,
+    history_redis: Redis = None,
+):
+    """
+    Initializes the services with the async client.
+
+    Parameters:
+    - async_client (AsyncOpenAI): An instance of AsyncOpenAI to use for making requests.
+    - registry (AssistantRegistryRepository): The registry of the remote resources of the assistant.
+    - redis (Redis): A Redis client shared by the replicas of the bot, if there may be several of them.
+    - history_redis (Redis): A Redis client keeping the conversations of the chat backend, or None to keep them in memory.
+
+    Returns:
+    - None
+    """
+
+    AnalyticsService.initialize()
+    KnowledgeService.initialize()
+
+    await AssistantService.initialize(
+        async_client=async_client, registry=registry, history_redis=history_redis
+    )
+    KnowledgeService.start(AssistantService.sync_knowledge)
+    ConversationScheduler.initialize(async_client=async_client, redis=redis)
+    ContextService.initialize(async_client=async_client)
+    RunPoller.initialize(async_client=async_client)
+    ValidateService.initialize(async_client=async_client)
+    SttService.initialize(async_client=async_client)
+    TtsService.initialize(async_client=async_client)
+    EmotionService.initialize(async_client=async_client)
+
+
+async def shutdown_services():
+    """
+    Stops the background tasks of the services.
+
+    Returns:
+    - None
+    """
+
+    await RunPoller.shutdown()
+    await KnowledgeService.shutdown()
+    # Send the events tracked before the shutdown.
+    await AnalyticsService.shutdown()
+
+
+def create_stop_event() -> asyncio.Event:
+    """
+    Creates an event set when the process is interrupted or terminated.
+
+    Returns:
+    - asyncio.Event: The event.
+    """
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stopped.set)
+    return stopped
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, handle_in_background: bool = True):
+    """
+    Receives the updates through the webhook until the process is interrupted or terminated.
+
+    Parameters:
+    - dp (Dispatcher): The dispatcher handling the updates.
+    - bot (Bot): The bot.
+    - handle_in_background (bool): Whether Telegram is answered before the updates are handled.
+
+    Returns:
+    - None
+    """
+
+    if not settings.WEBHOOK_URL:
+        raise ValueError("WEBHOOK_URL must be set to run the bot in the webhook mode.")
+
+    server = WebhookServer(
+        dp,
+        bot,
+        redis=settings.redis,
+        url=settings.WEBHOOK_URL,
+        path=settings.WEBHOOK_PATH,
+        secret_token=settings.webhook_secret,
+        max_connections=settings.WEBHOOK_MAX_CONNECTIONS,
+        drain_timeout=settings.WEBHOOK_DRAIN_TIMEOUT,
+        handle_in_background=handle_in_background,
+    )
+
+    stopped = create_stop_event()
+    await server.start(settings.WEBHOOK_HOST, settings.WEBHOOK_PORT)
+    try:
+        await stopped.wait()
+    finally:
+        await server.stop()
+
+
+async def run_worker(dp: Dispatcher, bot: Bot):
+    """
+    Handles the updates enqueued by the ingress processes until the process is interrupted or terminated.
+
+    Parameters:
+    - dp (Dispatcher): The dispatcher handling the updates.
+    - bot (Bot): The bot.
+
+    Returns:
+    - None
+    """
+
+    async def handle_update(payload: str):
+        update = Update.model_validate_json(payload, context={"bot": bot})
+        await dp.feed_update(bot, update)
+
+    # Failed updates are raised to the job queue, which retries them.
+    ReplyDelivery.propagate_errors = True
+    stopped = create_stop_event()
+    JobQueue.start(handle_update)
+    try:
+        await stopped.wait()
+    finally:
+        # Let the jobs being handled finish and hand the shards over to the other workers.
+        await JobQueue.shutdown()
+
+
+async def main():
+    """
+    Initializes the bot, sets up routers for handling different types of messages and commands,
+    and starts receiving the updates by polling or through the webhook, depending on BOT_MODE.
+
+    With PROCESS_ROLE set to 'ingress' or 'worker', the updates are passed from the ingress processes
+    to the worker processes through the job queue.
+
+    Returns:
+    - None
+
+    Raises:
+    - ValueError: If PROCESS_ROLE is not 'all', 'ingress' or 'worker'.
+    """
+
+    role = settings.PROCESS_ROLE
+    if role not in ("all", "ingress", "worker"):
+        raise ValueError(f"Unknown process role: {role}")
+    dp = create_dispatcher()
+    if role == "ingress":
+        # Enqueue the updates instead of handling them.
+        dp.update.outer_middleware(JobQueueMiddleware())
+    if role != "all":
+        JobQueue.initialize(settings.redis)
+
+    bot = settings.bot
+    async_client = settings.async_client
+
+    # Expose the metrics, unless disabled with METRICS_PORT=0.
+    metrics_runner = None
+    if settings.METRICS_PORT:
+        metrics_runner = await start_metrics_server(
+            settings.METRICS_HOST, settings.METRICS_PORT
+        )
+
+    is_webhook = settings.BOT_MODE == "webhook"
+    prewarm_task = None
+    if role != "ingress":
+        await initialize_services(
+            async_client,
+            registry=AssistantRegistryRepository(redis=settings.redis),
+            # Replicas serving the webhook and workers may receive the messages of the same user.
+            redis=settings.redis if is_webhook or role == "worker" else None,
+            history_redis=settings.redis,
+        )
+
+        # Synthesize the constant phrases in the background, so that startup is not delayed.
+        prewarm_task = asyncio.create_task(TtsService.prewarm())
+
+    logger.info(f"Bot started ({role})")
+
+    try:
+        if role == "worker":
+            await run_worker(dp, bot)
+        elif is_webhook:
+            # Telegram redelivers the updates the ingress failed to enqueue.
+            await run_webhook(dp, bot, handle_in_background=role == "all")
+        else:
+            # Updates cannot be polled while a webhook is registered, e.g. after running in the webhook mode.
+            await bot.delete_webhook()
+            # Start the bot's polling loop. The ingress enqueues the updates one by one,
+            # so that polling slows down when the queue is full.
+            await dp.start_polling(bot, handle_as_tasks=role != "ingress")
+    finally:
+        if prewarm_task is not None:
+            prewarm_task.cancel()
+            await shutdown_services()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
 
 
 if __name__ == "__main__":
@@ -1 +1,2 @@
 from .user_model import UserModel
+from .conversation_summary_model import ConversationSummaryModel
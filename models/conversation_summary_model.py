@@ -0,0 +1,28 @@
+from sqlalchemy import BigInteger, Column, DateTime, Integer, String, Text, func
+
+from utils.repository import Base
+
+
+class ConversationSummaryModel(Base):
+    """
+    Represents the structure of the 'conversation_summary' table in the database.
+    Each record holds the summary a conversation thread was rolled over with once its context grew too large.
+    """
+
+    __tablename__ = "conversation_summary"
+
+    id = Column(Integer, primary_key=True)
+
+    # The Telegram ID of the user, which does not fit into a 32-bit integer.
+    user_id = Column(BigInteger, index=True, nullable=False)
+
+    # The thread that was summarized and the new thread seeded with the summary.
+    thread_id = Column(String, nullable=False)
+    new_thread_id = Column(String, unique=True, nullable=False)
+
+    summary = Column(Text, nullable=False)
+
+    # The number of tokens of the context of the summarized thread.
+    context_tokens = Column(Integer, nullable=False)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -0,0 +1,2 @@
+from .metrics import *
+from .server import handle_metrics, start_metrics_server
@@ -0,0 +1,204 @@
+import functools
+import inspect
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# The buckets of the latency histograms, in seconds, from a Redis call to a long assistant run.
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128)
+
+STAGE_DURATION = Histogram(
+    "bot_stage_duration_seconds",
+    "The duration of the stages of handling a message.",
+    ["stage", "model"],
+    buckets=LATENCY_BUCKETS,
+)
+STAGE_FIRST_ITEM = Histogram(
+    "bot_stage_first_item_seconds",
+    "The time until a streaming stage produces its first item.",
+    ["stage", "model"],
+    buckets=LATENCY_BUCKETS,
+)
+STAGE_ERRORS = Counter(
+    "bot_stage_errors_total",
+    "The number of failed stages of handling a message.",
+    ["stage", "model"],
+)
+STAGE_IN_FLIGHT = Gauge(
+    "bot_stage_in_flight",
+    "The number of stages of handling a message in progress.",
+    ["stage"],
+)
+
+UPDATE_DURATION = Histogram(
+    "bot_update_duration_seconds",
+    "The duration of handling a message.",
+    ["handler"],
+    buckets=LATENCY_BUCKETS,
+)
+UPDATE_ERRORS = Counter(
+    "bot_update_errors_total",
+    "The number of messages whose handling failed.",
+    ["handler"],
+)
+UPDATES_IN_FLIGHT = Gauge(
+    "bot_updates_in_flight",
+    "The number of messages being handled.",
+)
+
+OPENAI_QUEUE_WAIT = Histogram(
+    "openai_queue_wait_seconds",
+    "The time OpenAI requests wait for the concurrency and rate limit budgets.",
+    ["service"],
+    buckets=LATENCY_BUCKETS,
+)
+OPENAI_RETRIES = Counter(
+    "openai_retries_total",
+    "The number of retried OpenAI requests.",
+    ["service", "status"],
+)
+
+ASSISTANT_RUN_PHASE = Histogram(
+    "assistant_run_phase_seconds",
+    "The time assistant runs spend queued and in progress.",
+    ["phase"],
+    buckets=LATENCY_BUCKETS,
+)
+ASSISTANT_RUN_POLLS = Counter(
+    "assistant_run_polls_total",
+    "The number of status polls of assistant runs.",
+)
+ASSISTANT_RUN_TOKENS = Histogram(
+    "assistant_run_tokens",
+    "The number of tokens used by finished assistant runs.",
+    ["kind"],
+    buckets=(250, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000, 128000),
+)
+CONTEXT_ROLLOVERS = Counter(
+    "context_rollovers_total",
+    "The number of conversation threads rolled over into new threads with a summary.",
+)
+
+RETRIEVAL_SEARCH_DURATION = Histogram(
+    "retrieval_search_seconds",
+    "The duration of the searches of the local knowledge index that were not cached.",
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.1),
+)
+RETRIEVAL_SEARCHES = Counter(
+    "retrieval_searches_total",
+    "The number of searches of the local knowledge index, by whether they were cached.",
+    ["result"],
+)
+
+JOBS = Counter(
+    "jobs_total",
+    "The number of jobs of the job queue, by what happened to them.",
+    ["result"],
+)
+JOB_QUEUE_WAIT = Histogram(
+    "job_queue_wait_seconds",
+    "The time jobs wait in the job queue before a worker starts handling them.",
+    buckets=LATENCY_BUCKETS,
+)
+JOBS_IN_FLIGHT = Gauge(
+    "jobs_in_flight",
+    "The number of jobs read by the worker and not handled yet.",
+)
+JOB_SHARDS_LEASED = Gauge(
+    "job_shards_leased",
+    "The number of shards of the job queue leased by the worker.",
+)
+
+
+@contextmanager
+def track_stage(stage: str, model: str = ""):
+    """
+    Records the duration, the failure and the concurrency of the code in the context as a stage.
+
+    Parameters:
+    - stage (str): The name of the stage.
+    - model (str): The model used by the stage, if any.
+
+    Returns:
+    - None
+    """
+
+    STAGE_IN_FLIGHT.labels(stage).inc()
+    started_at = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        STAGE_ERRORS.labels(stage, model).inc()
+        raise
+    finally:
+        STAGE_DURATION.labels(stage, model).observe(time.perf_counter() - started_at)
+        STAGE_IN_FLIGHT.labels(stage).dec()
+
+
+def instrument(stage: str) -> Callable:
+    """
+    Decorates a coroutine or async generator method of a service so that its calls are recorded as a stage.
+
+    The model label is taken from the 'model' option of the service's config.
+    For async generators, the time until the first item is recorded as well.
+
+    Parameters:
+    - stage (str): The name of the stage.
+
+    Returns:
+    - Callable: The decorator.
+    """
+
+    def decorator(function: Callable) -> Callable:
+        def get_model(args) -> str:
+            config = getattr(args[0], "config", None) if args else None
+            return config.get("model", "") if isinstance(config, dict) else ""
+
+        if inspect.isasyncgenfunction(function):
+
+            @functools.wraps(function)
+            async def generator_wrapper(*args, **kwargs):
+                model = get_model(args)
+                with track_stage(stage, model):
+                    started_at = time.perf_counter()
+                    is_first = True
+                    async for item in function(*args, **kwargs):
+                        if is_first:
+                            STAGE_FIRST_ITEM.labels(stage, model).observe(
+                                time.perf_counter() - started_at
+                            )
+                            is_first = False
+                        yield item
+
+            return generator_wrapper
+
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            with track_stage(stage, get_model(args)):
+                return await function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def observe_run(run):
+    """
+    Records the time a finished assistant run spent queued and in progress.
+
+    Parameters:
+    - run (Run): The finished run.
+
+    Returns:
+    - None
+    """
+
+    finished_at = run.completed_at or run.failed_at or run.cancelled_at
+    if run.started_at:
+        ASSISTANT_RUN_PHASE.labels("queued").observe(run.started_at - run.created_at)
+        if finished_at:
+            ASSISTANT_RUN_PHASE.labels("in_progress").observe(
+                finished_at - run.started_at
+            )
@@ -0,0 +1,41 @@
+from aiohttp import web
+from loguru import logger
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, generate_latest
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """
+    Returns the metrics in the Prometheus text format.
+
+    Parameters:
+    - request (web.Request): The HTTP request.
+
+    Returns:
+    - web.Response: The metrics.
+    """
+
+    return web.Response(
+        body=generate_latest(REGISTRY), headers={"Content-Type": CONTENT_TYPE_LATEST}
+    )
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    """
+    Starts an HTTP server exposing the metrics on /metrics.
+
+    Parameters:
+    - host (str): The host to listen on.
+    - port (int): The port to listen on.
+
+    Returns:
+    - web.AppRunner: The runner of the server, to be cleaned up on shutdown.
+    """
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Metrics are exposed on http://{host}:{port}/metrics")
+    return runner
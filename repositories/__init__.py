@@ -1 +1,3 @@
 from .user_repository import UserRepository
+from .assistant_registry_repository import AssistantRegistryRepository
+from .conversation_summary_repository import ConversationSummaryRepository
@@ -0,0 +1,166 @@
+import json
+from typing import Dict, Optional
+
+from redis.asyncio import Redis
+from redis.asyncio.lock import Lock
+
+
+class AssistantRegistryRepository:
+    """
+    AssistantRegistryRepository is a class responsible for persisting the IDs of the remote assistant resources
+    (the assistant, its vector stores and their files) in Redis, keyed by the content hashes they were created from.
+    It allows restarts to reuse unchanged resources instead of recreating them.
+    """
+
+    key_prefix = "assistant_registry"
+
+    def __init__(self, redis: Redis):
+        """
+        Initializes the repository with a Redis client.
+
+        Parameters:
+        - redis (Redis): The Redis client.
+        """
+
+        self.redis = redis
+
+    def lock(self) -> Lock:
+        """
+        Returns a lock that serializes the synchronization of the resources between several bot instances.
+
+        Returns:
+        - Lock: The Redis lock.
+        """
+
+        return self.redis.lock(
+            f"{self.key_prefix}:lock", timeout=600, blocking_timeout=600
+        )
+
+    async def get_assistant(self) -> Optional[Dict[str, str]]:
+        """
+        Returns the registered assistant.
+
+        Returns:
+        - Optional[Dict[str, str]]: The 'assistant_id' and the 'config_hash' it was created from, or None.
+        """
+
+        record = await self.redis.hgetall(f"{self.key_prefix}:assistant")
+        if not record:
+            return None
+        return {key.decode(): value.decode() for key, value in record.items()}
+
+    async def set_assistant(self, assistant_id: str, config_hash: str):
+        """
+        Registers the assistant.
+
+        Parameters:
+        - assistant_id (str): The ID of the assistant.
+        - config_hash (str): The hash of the configuration the assistant was created from.
+
+        Returns:
+        - None
+        """
+
+        await self.redis.hset(
+            f"{self.key_prefix}:assistant",
+            mapping={"assistant_id": assistant_id, "config_hash": config_hash},
+        )
+
+    async def get_vector_store_id(self, name: str) -> Optional[str]:
+        """
+        Returns the ID of the registered vector store.
+
+        Parameters:
+        - name (str): The name of the vector store.
+
+        Returns:
+        - Optional[str]: The ID of the vector store, or None.
+        """
+
+        vector_store_id = await self.redis.hget(
+            f"{self.key_prefix}:vector_stores", name
+        )
+        return vector_store_id.decode() if vector_store_id else None
+
+    async def set_vector_store_id(self, name: str, vector_store_id: str):
+        """
+        Registers the vector store.
+
+        Parameters:
+        - name (str): The name of the vector store.
+        - vector_store_id (str): The ID of the vector store.
+
+        Returns:
+        - None
+        """
+
+        await self.redis.hset(f"{self.key_prefix}:vector_stores", name, vector_store_id)
+
+    async def get_files(self, name: str) -> Dict[str, Dict[str, str]]:
+        """
+        Returns the files registered in the vector store.
+
+        Parameters:
+        - name (str): The name of the vector store.
+
+        Returns:
+        - Dict[str, Dict[str, str]]: Maps content hashes of the files to their 'file_id' and 'file_name'.
+        """
+
+        records = await self.redis.hgetall(f"{self.key_prefix}:files:{name}")
+        return {
+            content_hash.decode(): json.loads(record)
+            for content_hash, record in records.items()
+        }
+
+    async def set_file(
+        self, name: str, content_hash: str, file_id: str, file_name: str
+    ):
+        """
+        Registers a file in the vector store.
+
+        Parameters:
+        - name (str): The name of the vector store.
+        - content_hash (str): The hash of the content of the file.
+        - file_id (str): The ID of the uploaded file.
+        - file_name (str): The name of the file.
+
+        Returns:
+        - None
+        """
+
+        await self.redis.hset(
+            f"{self.key_prefix}:files:{name}",
+            content_hash,
+            json.dumps({"file_id": file_id, "file_name": file_name}),
+        )
+
+    async def delete_file(self, name: str, content_hash: str):
+        """
+        Removes a file from the registry of the vector store.
+
+        Parameters:
+        - name (str): The name of the vector store.
+        - content_hash (str): The hash of the content of the file.
+
+        Returns:
+        - None
+        """
+
+        await self.redis.hdel(f"{self.key_prefix}:files:{name}", content_hash)
+
+    async def delete_vector_store(self, name: str):
+        """
+        Removes the vector store and its files from the registry.
+
+        Parameters:
+        - name (str): The name of the vector store.
+
+        Returns:
+        - None
+        """
+
+        async with self.redis.pipeline(transaction=True) as pipeline:
+            pipeline.hdel(f"{self.key_prefix}:vector_stores", name)
+            pipeline.delete(f"{self.key_prefix}:files:{name}")
+            await pipeline.execute()
@@ -0,0 +1,45 @@
+from models import ConversationSummaryModel
+from utils.repository import async_session
+
+
+class ConversationSummaryRepository:
+    """
+    ConversationSummaryRepository is a class responsible for handling operations related to the ConversationSummaryModel.
+    It persists the summaries the conversations are rolled over with.
+    """
+
+    model = ConversationSummaryModel
+
+    async def save_summary(
+        self,
+        user_id: int,
+        thread_id: str,
+        new_thread_id: str,
+        summary: str,
+        context_tokens: int,
+    ):
+        """
+        Asynchronously saves the summary of a thread to the database.
+
+        Parameters:
+        - user_id (int): The unique identifier for the user.
+        - thread_id (str): The ID of the summarized thread.
+        - new_thread_id (str): The ID of the thread seeded with the summary.
+        - summary (str): The summary.
+        - context_tokens (int): The number of tokens of the context of the summarized thread.
+
+        Returns:
+        - None
+        """
+
+        async with async_session() as session:
+            async with session.begin():
+                session.add(
+                    self.model(
+                        user_id=user_id,
+                        thread_id=thread_id,
+                        new_thread_id=new_thread_id,
+                        summary=summary,
+                        context_tokens=context_tokens,
+                    )
+                )
@@ -0,0 +1,9 @@
+from .bm25_index import Bm25Index
+from .documents import (
+    SUPPORTED_EXTENSIONS,
+    Passage,
+    hash_sources,
+    read_paragraphs,
+    read_passages,
+    split_into_passages,
+)
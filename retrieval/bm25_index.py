@@ -0,0 +1,308 @@
+import fcntl
+import json
+import math
+import os
+import re
+import shutil
+import tempfile
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from .documents import Passage, hash_sources, read_passages
+
+
+class Bm25Index:
+    """
+    A BM25 index of the passages of the knowledge files, stored on disk and memory-mapped when loaded.
+
+    The BM25 weight of every term in every passage is computed when the index is built, so a query only sums
+    the weights of the postings of its terms. The postings of all terms are stored in two flat arrays,
+    the passage numbers and the weights, and each term maps to its range in them. The arrays are memory-mapped,
+    so the index loads instantly, is shared by the processes reading the same files, and is paged in on demand.
+
+    The words are stemmed by truncation, which is crude but needs no dictionary and suits Russian well enough.
+    """
+
+    # The version of the layout of the files, increased on incompatible changes.
+    format_version = 1
+
+    def __init__(
+        self,
+        passages: List[Passage],
+        terms: Dict[str, Tuple[int, int]],
+        passage_ids: np.ndarray,
+        weights: np.ndarray,
+        stem_length: int = 5,
+        source_hashes: Optional[Dict[str, str]] = None,
+    ):
+        """
+        Initializes the index.
+
+        Parameters:
+        - passages (List[Passage]): The indexed passages.
+        - terms (Dict[str, Tuple[int, int]]): Maps the terms to the ranges of their postings.
+        - passage_ids (np.ndarray): The numbers of the passages of the postings.
+        - weights (np.ndarray): The BM25 weights of the postings.
+        - stem_length (int): The length the words are truncated to.
+        - source_hashes (Optional[Dict[str, str]]): Maps the file names of the sources to the hashes of their content.
+        """
+
+        self.passages = passages
+        self.terms = terms
+        self.passage_ids = passage_ids
+        self.weights = weights
+        self.stem_length = stem_length
+        self.source_hashes = source_hashes or {}
+
+    @staticmethod
+    def storage_path(index_path: str, name: str) -> str:
+        """
+        Returns the directory of the index of a vector storage.
+
+        Parameters:
+        - index_path (str): The directory of the indexes.
+        - name (str): The name of the vector storage.
+
+        Returns:
+        - str: The directory of its index.
+        """
+
+        return os.path.join(index_path, re.sub(r"\W+", "_", name).strip("_").lower())
+
+    @staticmethod
+    def tokenize(text: str, stem_length: int = 5) -> List[str]:
+        """
+        Splits a text into terms: lowercase words truncated to stem_length characters.
+
+        Parameters:
+        - text (str): The text.
+        - stem_length (int): The length the words are truncated to.
+
+        Returns:
+        - List[str]: The terms, in order.
+        """
+
+        return [
+            word[:stem_length]
+            for word in re.findall(r"\w+", text.lower().replace("ё", "е"))
+            if len(word) > 1 or word.isdigit()
+        ]
+
+    @classmethod
+    def build(
+        cls,
+        passages: List[Passage],
+        k1: float = 1.2,
+        b: float = 0.75,
+        stem_length: int = 5,
+        source_hashes: Optional[Dict[str, str]] = None,
+    ) -> "Bm25Index":
+        """
+        Builds an index of passages in memory.
+
+        Parameters:
+        - passages (List[Passage]): The passages.
+        - k1 (float): The BM25 term frequency saturation.
+        - b (float): The BM25 length normalization.
+        - stem_length (int): The length the words are truncated to.
+        - source_hashes (Optional[Dict[str, str]]): Maps the file names of the sources to the hashes of their content.
+
+        Returns:
+        - Bm25Index: The index.
+        """
+
+        term_counts = [
+            Counter(cls.tokenize(passage.text, stem_length)) for passage in passages
+        ]
+        lengths = [sum(counts.values()) for counts in term_counts]
+        average_length = sum(lengths) / len(lengths) if lengths else 0.0
+
+        postings: Dict[str, List[Tuple[int, float]]] = defaultdict(list)
+        for passage_id, counts in enumerate(term_counts):
+            norm = k1 * (1 - b + b * lengths[passage_id] / (average_length or 1.0))
+            for term, count in counts.items():
+                postings[term].append((passage_id, count * (k1 + 1) / (count + norm)))
+
+        terms = {}
+        passage_ids = []
+        weights = []
+        for term in sorted(postings):
+            term_postings = postings[term]
+            idf = math.log(
+                1
+                + (len(passages) - len(term_postings) + 0.5)
+                / (len(term_postings) + 0.5)
+            )
+            terms[term] = (len(passage_ids), len(passage_ids) + len(term_postings))
+            for passage_id, weight in term_postings:
+                passage_ids.append(passage_id)
+                weights.append(idf * weight)
+
+        return cls(
+            passages=passages,
+            terms=terms,
+            passage_ids=np.array(passage_ids, dtype=np.int32),
+            weights=np.array(weights, dtype=np.float32),
+            stem_length=stem_length,
+            source_hashes=source_hashes,
+        )
+
+    @classmethod
+    def from_files(
+        cls, file_paths: List[str], max_words: int = 120, stem_length: int = 5
+    ) -> "Bm25Index":
+        """
+        Builds an index of the passages of the knowledge files.
+
+        Parameters:
+        - file_paths (List[str]): The paths to the files.
+        - max_words (int): The maximum number of words in a passage.
+        - stem_length (int): The length the words are truncated to.
+
+        Returns:
+        - Bm25Index: The index.
+        """
+
+        passages = [
+            passage
+            for path in file_paths
+            for passage in read_passages(path, max_words=max_words)
+        ]
+        return cls.build(
+            passages, stem_length=stem_length, source_hashes=hash_sources(file_paths)
+        )
+
+    def save(self, path: str):
+        """
+        Writes the index to a directory, replacing the index already there.
+
+        The path is a symbolic link to a uniquely named directory next to it. The files are written to a new
+        directory and the link is replaced at once, so a process loading the index never sees a partial one,
+        and the processes that mapped the old files keep reading them. The processes saving the same index
+        take turns, so that each of them removes the directories left by the previous ones.
+
+        Parameters:
+        - path (str): The path to the directory.
+
+        Returns:
+        - None
+        """
+
+        path = os.path.normpath(path)
+        parent, name = os.path.split(path)
+        parent = parent or "."
+        os.makedirs(parent, exist_ok=True)
+
+        with open(f"{path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+
+            new_path = tempfile.mkdtemp(prefix=f"{name}.", dir=parent)
+            try:
+                self._write(new_path)
+                os.chmod(new_path, 0o755)
+                link_path = f"{new_path}.link"
+                os.symlink(os.path.basename(new_path), link_path)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    # An index written before the directories were versioned.
+                    shutil.rmtree(path)
+                os.replace(link_path, path)
+            except BaseException:
+                shutil.rmtree(new_path, ignore_errors=True)
+                raise
+
+            # The directories of the replaced indexes and the leftovers of interrupted saves.
+            kept_names = (os.path.basename(new_path), f"{name}.lock")
+            for entry in os.scandir(parent):
+                if not entry.name.startswith(f"{name}.") or entry.name in kept_names:
+                    continue
+                if entry.is_dir(follow_symlinks=False):
+                    shutil.rmtree(entry.path, ignore_errors=True)
+                else:
+                    os.remove(entry.path)
+
+    def _write(self, path: str):
+        """
+        Writes the files of the index to an existing directory.
+        """
+
+        np.save(os.path.join(path, "passage_ids.npy"), self.passage_ids)
+        np.save(os.path.join(path, "weights.npy"), self.weights)
+        with open(os.path.join(path, "index.json"), "w", encoding="utf-8") as file:
+            json.dump(
+                {
+                    "format_version": self.format_version,
+                    "stem_length": self.stem_length,
+                    "source_hashes": self.source_hashes,
+                    "terms": self.terms,
+                    "passages": [list(passage) for passage in self.passages],
+                },
+                file,
+                ensure_ascii=False,
+            )
+
+    @classmethod
+    def load(cls, path: str) -> "Bm25Index":
+        """
+        Loads an index from a directory, memory-mapping its postings.
+
+        Parameters:
+        - path (str): The path to the directory.
+
+        Returns:
+        - Bm25Index: The index.
+
+        Raises:
+        - ValueError: If the index was written in another format.
+        """
+
+        with open(os.path.join(path, "index.json"), encoding="utf-8") as file:
+            meta = json.load(file)
+        if meta["format_version"] != cls.format_version:
+            raise ValueError(
+                f"Index {path} has format {meta['format_version']}, expected {cls.format_version}; rebuild it."
+            )
+
+        # An empty file cannot be mapped.
+        mmap_mode = "r" if meta["terms"] else None
+        return cls(
+            passages=[Passage(*passage) for passage in meta["passages"]],
+            terms={term: tuple(span) for term, span in meta["terms"].items()},
+            passage_ids=np.load(
+                os.path.join(path, "passage_ids.npy"), mmap_mode=mmap_mode
+            ),
+            weights=np.load(os.path.join(path, "weights.npy"), mmap_mode=mmap_mode),
+            stem_length=meta["stem_length"],
+            source_hashes=meta["source_hashes"],
+        )
+
+    def search(self, query: str, top_k: int = 3) -> List[Tuple[Passage, float]]:
+        """
+        Returns the passages that match a query best.
+
+        Parameters:
+        - query (str): The query.
+        - top_k (int): The maximum number of passages.
+
+        Returns:
+        - List[Tuple[Passage, float]]: The passages sharing terms with the query and their scores, best first.
+        """
+
+        scores = np.zeros(len(self.passages), dtype=np.float32)
+        for term, count in Counter(self.tokenize(query, self.stem_length)).items():
+            span = self.terms.get(term)
+            if span is None:
+                continue
+            start, end = span
+            # The passages of the postings of a term are distinct, so they can be added to at once.
+            scores[self.passage_ids[start:end]] += self.weights[start:end] * count
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > top_k:
+            matched = matched[np.argpartition(-scores[matched], top_k)[:top_k]]
+        matched = matched[np.argsort(-scores[matched], kind="stable")]
+        return [
+            (self.passages[passage_id], float(scores[passage_id]))
+            for passage_id in matched
+        ]
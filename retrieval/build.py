@@ -0,0 +1,51 @@
+"""
+Builds the local retrieval index of the files of a vector storage. Run it from the root of the repository, e.g.:
+
+    python -m retrieval.build --storage "Statements about Anxiety" "knowledge/Statements about Anxiety/Anxiety.docx"
+
+The bot builds the missing and out-of-date indexes on startup, so this only saves the time it takes.
+"""
+
+import argparse
+import time
+
+from .bm25_index import Bm25Index
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("files", nargs="+", help="Knowledge files: .docx, .txt or .md.")
+    parser.add_argument(
+        "--storage", required=True, help="Name of the vector storage of the files."
+    )
+    parser.add_argument(
+        "--index-path",
+        default=".cache/retrieval",
+        help="Directory of the indexes, RETRIEVAL_INDEX_PATH.",
+    )
+    parser.add_argument(
+        "--max-words", type=int, default=120, help="Maximum words in a passage."
+    )
+    parser.add_argument(
+        "--stem-length",
+        type=int,
+        default=5,
+        help="Length the words are truncated to.",
+    )
+    args = parser.parse_args()
+
+    started_at = time.perf_counter()
+    index = Bm25Index.from_files(
+        args.files, max_words=args.max_words, stem_length=args.stem_length
+    )
+    path = Bm25Index.storage_path(args.index_path, args.storage)
+    index.save(path)
+    print(
+        f"Indexed {len(index.passages)} passages of {len(args.files)} files "
+        f"with {len(index.terms)} terms and {len(index.weights)} postings "
+        f"in {time.perf_counter() - started_at:.2f}s into {path}"
+    )
+
+
+if __name__ == "__main__":
+    main()
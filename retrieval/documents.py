@@ -0,0 +1,144 @@
+import hashlib
+import os
+import re
+import zipfile
+from typing import Dict, List, NamedTuple
+from xml.etree import ElementTree
+
+# The namespace of the elements of the main part of a .docx file.
+WORD_NAMESPACE = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+# The extensions of the files that can be indexed.
+SUPPORTED_EXTENSIONS = (".docx", ".txt", ".md")
+
+
+class Passage(NamedTuple):
+    """
+    Passage represents a chunk of a knowledge file, the unit that is indexed and retrieved.
+    """
+
+    # The file name of the source, shown in the citations.
+    source: str
+    text: str
+
+
+def read_paragraphs(path: str) -> List[str]:
+    """
+    Reads the non-empty paragraphs of a knowledge file.
+
+    A .docx file is read as a zip archive of XML parts, so no library is needed to parse it.
+    Text and Markdown files are split into paragraphs on blank lines.
+
+    Parameters:
+    - path (str): The path to the file.
+
+    Returns:
+    - List[str]: The paragraphs, in order.
+
+    Raises:
+    - ValueError: If the file type is not supported.
+    """
+
+    extension = os.path.splitext(path)[1].lower()
+    if extension == ".docx":
+        with zipfile.ZipFile(path) as archive:
+            root = ElementTree.fromstring(archive.read("word/document.xml"))
+        paragraphs = []
+        for paragraph in root.iter(f"{WORD_NAMESPACE}p"):
+            parts = []
+            for element in paragraph.iter():
+                if element.tag == f"{WORD_NAMESPACE}t":
+                    parts.append(element.text or "")
+                elif element.tag == f"{WORD_NAMESPACE}tab":
+                    parts.append("\t")
+                elif element.tag in (f"{WORD_NAMESPACE}br", f"{WORD_NAMESPACE}cr"):
+                    parts.append("\n")
+            paragraphs.append("".join(parts))
+    elif extension in (".txt", ".md"):
+        with open(path, encoding="utf-8") as file:
+            paragraphs = re.split(r"\n\s*\n", file.read())
+    else:
+        raise ValueError(f"Unsupported knowledge file type: {path}")
+
+    return [
+        " ".join(paragraph.split()) for paragraph in paragraphs if paragraph.strip()
+    ]
+
+
+def split_into_passages(
+    source: str, paragraphs: List[str], max_words: int = 120, overlap_words: int = 30
+) -> List[Passage]:
+    """
+    Groups consecutive paragraphs into passages of up to max_words words.
+
+    A paragraph longer than that is split into windows overlapping by overlap_words words,
+    so that a sentence at the border of two windows is found in either of them.
+
+    Parameters:
+    - source (str): The file name of the source.
+    - paragraphs (List[str]): The paragraphs of the file, in order.
+    - max_words (int): The maximum number of words in a passage.
+    - overlap_words (int): The number of words shared by the consecutive windows of a long paragraph.
+
+    Returns:
+    - List[Passage]: The passages, in order.
+    """
+
+    passages = []
+    words: List[str] = []
+    for paragraph in paragraphs:
+        paragraph_words = paragraph.split()
+        if words and len(words) + len(paragraph_words) > max_words:
+            passages.append(Passage(source, " ".join(words)))
+            words = []
+
+        if len(paragraph_words) <= max_words:
+            words += paragraph_words
+            continue
+
+        step = max(max_words - overlap_words, 1)
+        for start in range(0, len(paragraph_words) - overlap_words, step):
+            passages.append(
+                Passage(source, " ".join(paragraph_words[start : start + max_words]))
+            )
+
+    if words:
+        passages.append(Passage(source, " ".join(words)))
+    return passages
+
+
+def read_passages(path: str, max_words: int = 120) -> List[Passage]:
+    """
+    Reads a knowledge file and splits it into passages.
+
+    Parameters:
+    - path (str): The path to the file.
+    - max_words (int): The maximum number of words in a passage.
+
+    Returns:
+    - List[Passage]: The passages, in order.
+    """
+
+    return split_into_passages(
+        os.path.basename(path), read_paragraphs(path), max_words=max_words
+    )
+
+
+def hash_sources(file_paths: List[str]) -> Dict[str, str]:
+    """
+    Computes the hashes of the content of the knowledge files.
+
+    Parameters:
+    - file_paths (List[str]): The paths to the files.
+
+    Returns:
+    - Dict[str, str]: Maps the file names to the SHA-256 hex digests of their content.
+    """
+
+    source_hashes = {}
+    for path in file_paths:
+        with open(path, "rb") as file:
+            source_hashes[os.path.basename(path)] = hashlib.sha256(
+                file.read()
+            ).hexdigest()
+    return source_hashes
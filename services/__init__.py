@@ -1,6 +1,14 @@
 from .analytics_service import AnalyticsService
 from .assistant_service import AssistantService
+from .context_service import ContextService
+from .conversation_backend import ChatCompletionsBackend, ConversationBackend
+from .conversation_scheduler import ConversationScheduler, RunCancelledError
 from .emotion_service import EmotionService
+from .job_queue import JobQueue, PermanentJobError
+from .knowledge_service import KnowledgeService
+from .openai_scheduler import OpenAIScheduler, Priority
+from .retrieval_service import RetrievalService
+from .run_poller import RunPoller
 from .stt_service import SttService
 from .tts_service import TtsService
 from .validate_service import ValidateService
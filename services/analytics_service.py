@@ -1,20 +1,67 @@
-from analytics.amplitude_logger import AmplitudeLogger
+import time
+from enum import Enum
+
+from analytics.pipeline import AnalyticsPipeline
+from analytics.sinks import AmplitudeSink, AnalyticsSink, FileSink, NullSink
+from analytics.types import AnalyticsEvent
 from config import settings
 
 
 class AnalyticsService:
     """
-    Manages assistant operations with Amplitude analytics using a thread pool.
+    Manages assistant operations with analytics, sending the tracked events in batches from a background task.
     """
 
-    executor = settings.thread_executor
+    # The pipeline buffering the events until they are sent to the sink.
+    pipeline = None
+
+    @classmethod
+    def create_sink(cls) -> AnalyticsSink:
+        """
+        Creates the sink selected by the ANALYTICS_SINK environment variable.
+
+        Returns:
+        - AnalyticsSink: The sink.
+
+        Raises:
+        - ValueError: If the sink is unknown.
+        """
 
-    tracker = AmplitudeLogger()
+        if settings.ANALYTICS_SINK == "amplitude":
+            return AmplitudeSink(settings.AMPLITUDE_KEY)
+        elif settings.ANALYTICS_SINK == "file":
+            return FileSink(settings.ANALYTICS_FILE_PATH)
+        elif settings.ANALYTICS_SINK == "null":
+            return NullSink()
+        raise ValueError(f"Unknown analytics sink: {settings.ANALYTICS_SINK}")
+
+    @classmethod
+    def initialize(cls, sink: AnalyticsSink = None):
+        """
+        Initializes the AnalyticsService and starts sending the tracked events.
+        Must be called from a running event loop.
+
+        Parameters:
+        - sink (AnalyticsSink): The destination of the events. Defaults to the sink selected by ANALYTICS_SINK.
+
+        Returns:
+        - None
+        """
+
+        cls.pipeline = AnalyticsPipeline(
+            sink=sink or cls.create_sink(),
+            capacity=settings.ANALYTICS_BUFFER_SIZE,
+            batch_size=settings.ANALYTICS_BATCH_SIZE,
+            flush_interval=settings.ANALYTICS_FLUSH_INTERVAL,
+            overflow_policy=settings.ANALYTICS_OVERFLOW_POLICY,
+            sample_rate=settings.ANALYTICS_SAMPLE_RATE,
+        )
+        cls.pipeline.start()
 
     @classmethod
     def track_event(cls, user_id: int, event_type: str, event_properties: str = ""):
         """
-        Asynchronously tracks an event in Amplitude using the executor.
+        Tracks an event. The event is buffered and sent later, so this never waits.
 
         Args:
             user_id (int): User ID.
@@ -23,8 +70,34 @@ class AnalyticsService:
 
         Returns:
         - None
+
+        Raises:
+        - ValueError: If the service is not initialized before calling this method.
         """
 
-        cls.executor.submit(
-            cls.tracker.track_event, user_id, event_type, event_properties
+        if cls.pipeline is None:
+            raise ValueError("pipeline must be initialized before calling track_event.")
+
+        if isinstance(event_type, Enum):
+            event_type = event_type.value
+
+        cls.pipeline.put(
+            AnalyticsEvent(
+                user_id=user_id,
+                event_type=event_type,
+                event_properties=event_properties,
+                time=int(time.time() * 1000),
+            )
         )
+
+    @classmethod
+    async def shutdown(cls):
+        """
+        Sends all the buffered events and closes the sink.
+
+        Returns:
+        - None
+        """
+
+        if cls.pipeline is not None:
+            await cls.pipeline.close()
@@ -1,14 +1,31 @@
+import asyncio
+import hashlib
 import json
 import os
+import re
+from contextlib import nullcontext
+from typing import AsyncIterator, Iterable, List, Optional
 
 from loguru import logger
-from openai import AsyncOpenAI
+from openai import AsyncOpenAI, NotFoundError
+from openai.types import FileObject
+from openai.types.beta import Assistant
+from openai.types.beta.threads import Message, Run
+from redis.asyncio import Redis
 
 from analytics.types import EventType
-from repositories import UserRepository
+from config import settings
+from monitoring import instrument, observe_run
+from repositories import AssistantRegistryRepository, UserRepository
 from utils import Strings
 
 from .analytics_service import AnalyticsService
+from .context_service import ContextService
+from .conversation_backend import ChatCompletionsBackend, ConversationBackend
+from .conversation_scheduler import ConversationScheduler, RunCancelledError
+from .knowledge_service import KnowledgeService
+from .retrieval_service import RetrievalService
+from .run_poller import RunPoller
 from .validate_service import ValidateService
 
 
@@ -33,10 +50,15 @@ class AssistantService:
             self.file_paths = []
             self.name = ""
             self.instructions = ""
+            # Maps the content hashes of the files in the vector store to their 'file_id' and 'file_name'.
+            self.files = {}
 
         async def initialization(self, name, file_paths, instructions):
             """
-            Initializes the vector storage manager with specific configurations and uploads files.
+            Initializes the vector storage manager with specific configurations and synchronizes its files.
+
+            With a registry, the vector store and the files registered under the same name and content hashes
+            are reused, only new or changed files are uploaded, and files that are no longer listed are deleted.
 
             Parameters:
             - name (str): The name of the vector store to create.
@@ -51,38 +73,233 @@ class AssistantService:
             """
 
             self.name = name
-            self.file_paths = file_paths
             self.instructions = instructions
 
-            self.vector_store = (
-                await AssistantService.async_client.beta.vector_stores.create(
+            registry = AssistantService.registry
+            async_client = AssistantService.async_client
+
+            self.vector_store = None
+            if registry is not None:
+                vector_store_id = await registry.get_vector_store_id(self.name)
+                if vector_store_id is not None:
+                    try:
+                        self.vector_store = (
+                            await async_client.beta.vector_stores.retrieve(
+                                vector_store_id
+                            )
+                        )
+                    except NotFoundError:
+                        logger.info(f"Vector store {vector_store_id} is gone")
+
+            is_new_vector_store = self.vector_store is None
+            if is_new_vector_store:
+                self.vector_store = await async_client.beta.vector_stores.create(
                     name=self.name
                 )
+                if registry is not None:
+                    await registry.set_vector_store_id(self.name, self.vector_store.id)
+
+            await self.sync(file_paths, attach_registered=is_new_vector_store)
+
+        async def sync(self, file_paths, attach_registered=False):
+            """
+            Synchronizes the files of the vector store with the listed ones, comparing their content hashes:
+            new and changed files are uploaded, with bounded concurrency, and removed ones are deleted.
+
+            Parameters:
+            - file_paths (list[str]): A list of file paths the vector store should contain.
+            - attach_registered (bool): Whether the files that are already uploaded are attached as well,
+              e.g. to a new vector store.
+
+            Returns:
+            None
+
+            Raises:
+            - ValueError: If the file batch upload does not complete successfully or if the number of uploaded files does not match the expected count.
+              The files uploaded by the failed synchronization are deleted.
+            """
+
+            registry = AssistantService.registry
+            async_client = AssistantService.async_client
+
+            # Another instance may have synchronized the files in the meantime.
+            if registry is not None:
+                self.files = await registry.get_files(self.name)
+
+            content_hashes = {
+                path: await asyncio.to_thread(self.hash_file, path)
+                for path in file_paths
+            }
+
+            # A file is uploaded once, even if several paths have the same content.
+            paths_by_hash = {}
+            for path, content_hash in content_hashes.items():
+                if content_hash not in self.files:
+                    paths_by_hash.setdefault(content_hash, path)
+            new_paths = list(paths_by_hash.values())
+            semaphore = asyncio.Semaphore(
+                AssistantService.config["max_concurrent_uploads"]
             )
 
-            file_streams = [open(path, "rb") for path in self.file_paths]
+            async def upload_file(path: str) -> FileObject:
+                async with semaphore:
+                    return await self.upload_file(path)
 
-            self.file_batch = await AssistantService.async_client.beta.vector_stores.file_batches.upload_and_poll(
-                vector_store_id=self.vector_store.id, files=file_streams
+            # Every upload is awaited, so that the files uploaded before a failure are known and deleted.
+            results = await asyncio.gather(
+                *(upload_file(path) for path in new_paths), return_exceptions=True
             )
+            uploaded_files = [
+                result for result in results if not isinstance(result, BaseException)
+            ]
 
-            AssistantService.assistant = (
-                await AssistantService.async_client.beta.assistants.update(
-                    assistant_id=AssistantService.assistant.id,
-                    tool_resources={
-                        "file_search": {"vector_store_ids": [self.vector_store.id]}
-                    },
+            try:
+                for result in results:
+                    if isinstance(result, BaseException):
+                        raise result
+
+                attached_file_ids = [
+                    uploaded_file.id for uploaded_file in uploaded_files
+                ]
+                if attach_registered:
+                    attached_file_ids += [
+                        self.files[content_hash]["file_id"]
+                        for content_hash in set(content_hashes.values())
+                        if content_hash in self.files
+                    ]
+
+                if attached_file_ids:
+                    self.file_batch = await async_client.beta.vector_stores.file_batches.create_and_poll(
+                        vector_store_id=self.vector_store.id,
+                        file_ids=attached_file_ids,
+                    )
+
+                    if not (
+                        self.file_batch.status == "completed"
+                        and self.file_batch.file_counts.completed
+                        == len(attached_file_ids)
+                    ):
+                        raise ValueError(
+                            f"Something went wrong when uploading files to vector storage with name: {self.name} in assistant."
+                        )
+            except Exception:
+                # The new files are not registered yet, so they would be uploaded again by the next attempt.
+                for uploaded_file in uploaded_files:
+                    try:
+                        await self.delete_file(uploaded_file.id)
+                    except Exception as e:
+                        logger.error(
+                            f"Error while deleting file {uploaded_file.id} of a failed upload: {e}"
+                        )
+                raise
+
+            for path, uploaded_file in zip(new_paths, uploaded_files):
+                self.files[content_hashes[path]] = {
+                    "file_id": uploaded_file.id,
+                    "file_name": uploaded_file.filename,
+                }
+                if registry is not None:
+                    await registry.set_file(
+                        self.name,
+                        content_hashes[path],
+                        uploaded_file.id,
+                        uploaded_file.filename,
+                    )
+
+            current_hashes = set(content_hashes.values())
+            for content_hash, record in list(self.files.items()):
+                if content_hash in current_hashes:
+                    AssistantService.file_names[record["file_id"]] = record["file_name"]
+                else:
+                    await self.delete_file(record["file_id"])
+                    del self.files[content_hash]
+                    if registry is not None:
+                        await registry.delete_file(self.name, content_hash)
+
+            self.file_paths = file_paths
+            if new_paths:
+                logger.info(
+                    f"Uploaded {len(new_paths)} files to vector storage {self.name}"
                 )
-            )
 
-            if not (
-                self.file_batch.status == "completed"
-                and self.file_batch.file_counts.completed == len(self.file_paths)
-            ):
-                raise ValueError(
-                    f"Something went wrong when uploading files to vector storage with name: {self.name} in assistant."
+        async def delete(self):
+            """
+            Deletes the vector store and its files, e.g. once its directory is removed.
+
+            Returns:
+            - None
+            """
+
+            for record in self.files.values():
+                await self.delete_file(record["file_id"])
+            self.files = {}
+            try:
+                await AssistantService.async_client.beta.vector_stores.delete(
+                    self.vector_store.id
+                )
+            except NotFoundError:
+                pass
+            if AssistantService.registry is not None:
+                await AssistantService.registry.delete_vector_store(self.name)
+            logger.info(f"Deleted vector storage {self.name}")
+
+        async def upload_file(self, path: str) -> FileObject:
+            """
+            Uploads a file to be used by the assistant.
+
+            Parameters:
+            - path (str): The path to the file.
+
+            Returns:
+            - FileObject: The uploaded file.
+            """
+
+            with open(path, "rb") as file:
+                return await AssistantService.async_client.files.create(
+                    file=(os.path.basename(path), file.read()), purpose="assistants"
                 )
 
+        async def delete_file(self, file_id: str):
+            """
+            Detaches a superseded file from the vector store and deletes it.
+
+            Parameters:
+            - file_id (str): The ID of the file.
+
+            Returns:
+            - None
+            """
+
+            async_client = AssistantService.async_client
+            try:
+                await async_client.beta.vector_stores.files.delete(
+                    file_id, vector_store_id=self.vector_store.id
+                )
+            except NotFoundError:
+                pass
+            try:
+                await async_client.files.delete(file_id)
+            except NotFoundError:
+                pass
+            logger.info(
+                f"Deleted superseded file {file_id} of vector storage {self.name}"
+            )
+
+        @staticmethod
+        def hash_file(path: str) -> str:
+            """
+            Computes the hash of the content of a file.
+
+            Parameters:
+            - path (str): The path to the file.
+
+            Returns:
+            - str: The SHA-256 hex digest of the content.
+            """
+
+            with open(path, "rb") as file:
+                return hashlib.file_digest(file, "sha256").hexdigest()
+
     # A dictionary containing configuration options for the speech service, such as the model to use.
     config = {
         "name": "Voice AI Assistant",
@@ -96,6 +313,8 @@ class AssistantService:
             "patterns or recurring themes that reflect the user's life values."
         ),
         "run_instructions": "",
+        # The maximum number of knowledge files uploaded at a time.
+        "max_concurrent_uploads": 4,
         "tools": [
             {"type": "file_search"},
             {
@@ -131,45 +350,260 @@ class AssistantService:
 
     assistant = None
 
+    # A registry of the remote resources, which allows reusing them after a restart.
+    registry = None
+
+    # The backend answering the user instead of the Assistants API, selected by CONVERSATION_BACKEND.
+    backend: Optional[ConversationBackend] = None
+
     vector_storages = []
 
+    # Serializes the synchronizations of the knowledge files.
+    knowledge_lock = asyncio.Lock()
+
+    # Maps IDs of the files cited by the assistant to their file names.
+    file_names = {}
+
+    # Matches the raw citation markers (e.g. '【4:0†source】') that appear in streamed text deltas.
+    annotation_pattern = re.compile(r"【[^】]*】")
+
     @classmethod
-    async def initialize(cls, async_client: AsyncOpenAI):
+    async def initialize(
+        cls,
+        async_client: AsyncOpenAI,
+        registry: Optional[AssistantRegistryRepository] = None,
+        history_redis: Optional[Redis] = None,
+    ):
         """
         Initializes the AssistantService with an instance of AsyncOpenAI and creates an assistant.
 
+        With a registry, the assistant and the vector storages created by a previous run are reused
+        as long as their configuration and files have not changed, and superseded ones are deleted.
+        With another conversation backend, no assistant is created.
+        With the local retrieval, the knowledge files are indexed locally instead of in the vector storages.
+
         Parameters:
         - async_client (AsyncOpenAI): An instance of AsyncOpenAI to use for making requests to the assistant service.
+        - registry (Optional[AssistantRegistryRepository]): The registry of the remote resources.
+        - history_redis (Optional[Redis]): The Redis client keeping the conversations of the chat backend.
 
         Returns:
         - None
         """
 
         cls.async_client = async_client
+        cls.registry = registry
+        cls.config["max_concurrent_uploads"] = settings.KNOWLEDGE_MAX_CONCURRENT_UPLOADS
+
+        if settings.KNOWLEDGE_RETRIEVAL == "local":
+            cls.config["tools"] = [
+                tool for tool in cls.config["tools"] if tool["type"] != "file_search"
+            ]
+        elif settings.KNOWLEDGE_RETRIEVAL != "file_search":
+            raise ValueError(
+                f"Unknown knowledge retrieval: {settings.KNOWLEDGE_RETRIEVAL}"
+            )
+
+        cls.backend = cls.create_backend(history_redis)
+        if cls.backend is None:
+            async with registry.lock() if registry is not None else nullcontext():
+                cls.assistant = await cls.load_assistant()
+
+        try:
+            await cls.sync_knowledge(await asyncio.to_thread(KnowledgeService.load))
+        except ValueError as e:
+            logger.error(f"Error in AssistantService: {e}")
+            # The bot starts with the storages that did synchronize, and the watcher retries the others.
+            KnowledgeService.fingerprint = None
+
+    @classmethod
+    @instrument("assistant.sync_knowledge")
+    async def sync_knowledge(cls, sources: List[dict]):
+        """
+        Synchronizes the vector storages with the knowledge files, or the local indexes with the local retrieval.
+
+        Only the new and changed files are uploaded or indexed, the removed ones are deleted,
+        as well as the vector storages that are no longer listed.
+
+        Parameters:
+        - sources (List[dict]): The 'name', 'file_paths' and 'instructions' of the vector storages.
+
+        Returns:
+        - None
+
+        Raises:
+        - ValueError: If any of the vector storages failed to synchronize, after the others are synchronized.
+        """
+
+        failed_names = []
+        async with cls.knowledge_lock:
+            if settings.KNOWLEDGE_RETRIEVAL == "local":
+                await RetrievalService.initialize(
+                    {source["name"]: source["file_paths"] for source in sources}
+                )
+                return
+            # Without the Assistants API, the vector storages cannot be searched.
+            if cls.assistant is None:
+                return
+
+            registry = cls.registry
+            async with registry.lock() if registry is not None else nullcontext():
+                removed_storages = {vs.name: vs for vs in cls.vector_storages}
+                vector_storages = []
+                for source in sources:
+                    vector_storage = removed_storages.pop(source["name"], None)
+                    try:
+                        if vector_storage is None:
+                            vector_storage = cls.AssistantServiceVectorStorage()
+                            await vector_storage.initialization(**source)
+                        else:
+                            vector_storage.instructions = source["instructions"]
+                            await vector_storage.sync(source["file_paths"])
+                    except Exception as e:
+                        logger.error(
+                            f"Error while synchronizing vector storage {source['name']}: {e}"
+                        )
+                        failed_names.append(source["name"])
+                    # A storage that failed to synchronize keeps its previous files.
+                    if vector_storage.vector_store is not None:
+                        vector_storages.append(vector_storage)
+
+                for vector_storage in removed_storages.values():
+                    await vector_storage.delete()
+                cls.vector_storages = vector_storages
+                await cls.attach_vector_storages()
+
+            cls.config["run_instructions"] = "\n".join(
+                [vs.instructions for vs in cls.vector_storages]
+            )
 
-        cls.assistant = await cls.async_client.beta.assistants.create(
+        if failed_names:
+            raise ValueError(
+                f"Failed to synchronize vector storages: {', '.join(failed_names)}"
+            )
+
+    @classmethod
+    async def attach_vector_storages(cls):
+        """
+        Attaches the vector stores of the vector storages to the assistant for the file search.
+
+        Returns:
+        - None
+        """
+
+        vector_store_ids = [vs.vector_store.id for vs in cls.vector_storages]
+        if len(vector_store_ids) > 1:
+            # The Assistants API searches a single vector store per assistant.
+            logger.warning(
+                f"Only vector storage {cls.vector_storages[0].name} of {len(vector_store_ids)} is searched; "
+                "use the local retrieval to search all of them"
+            )
+            vector_store_ids = vector_store_ids[:1]
+
+        if vector_store_ids != cls.vector_store_ids():
+            cls.assistant = await cls.async_client.beta.assistants.update(
+                assistant_id=cls.assistant.id,
+                tool_resources={"file_search": {"vector_store_ids": vector_store_ids}},
+            )
+
+    @classmethod
+    def create_backend(
+        cls, history_redis: Optional[Redis] = None
+    ) -> Optional[ConversationBackend]:
+        """
+        Creates the conversation backend selected by the CONVERSATION_BACKEND environment variable.
+
+        Parameters:
+        - history_redis (Optional[Redis]): The Redis client keeping the conversations, or None to keep them in memory.
+
+        Returns:
+        - Optional[ConversationBackend]: The backend, or None for the Assistants API.
+
+        Raises:
+        - ValueError: If the backend is unknown.
+        """
+
+        if settings.CONVERSATION_BACKEND == "assistants":
+            return None
+        elif settings.CONVERSATION_BACKEND == "chat":
+            return ChatCompletionsBackend(
+                async_client=cls.async_client,
+                model=cls.config["model"],
+                instructions=cls.config["assistant_instructions"],
+                tools=cls.config["tools"],
+                call_tool=cls.call_tool,
+                redis=history_redis,
+                max_history_messages=settings.CHAT_HISTORY_MESSAGES,
+            )
+        raise ValueError(
+            f"Unknown conversation backend: {settings.CONVERSATION_BACKEND}"
+        )
+
+    @classmethod
+    async def load_assistant(cls) -> Assistant:
+        """
+        Returns the registered assistant if it was created from the current configuration,
+        otherwise creates a new one and deletes the superseded one.
+
+        Returns:
+        - Assistant: The assistant.
+        """
+
+        assistant_config = {
+            key: cls.config[key]
+            for key in ("name", "model", "assistant_instructions", "tools")
+        }
+        config_hash = hashlib.sha256(
+            json.dumps(assistant_config, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+        record = await cls.registry.get_assistant() if cls.registry else None
+        if record is not None and record["config_hash"] == config_hash:
+            try:
+                return await cls.async_client.beta.assistants.retrieve(
+                    record["assistant_id"]
+                )
+            except NotFoundError:
+                logger.info(f"Assistant {record['assistant_id']} is gone")
+
+        assistant = await cls.async_client.beta.assistants.create(
             name=cls.config["name"],
             instructions=cls.config["assistant_instructions"],
             model=cls.config["model"],
             tools=cls.config["tools"],
         )
 
-        try:
-            anxiety_storage = cls.AssistantServiceVectorStorage()
-            await anxiety_storage.initialization(
-                name="Statements about Anxiety",
-                file_paths=[".//.//Anxiety.docx"],
-                instructions="If the user asks a question on the topic of Anxiety, try to look for the answer in the files.",
-            )
-            cls.vector_storages.append(anxiety_storage)
-        except ValueError as ve:
-            logger.info(f"Error: {ve}")
+        if cls.registry is not None:
+            await cls.registry.set_assistant(assistant.id, config_hash)
+            if record is not None and record["assistant_id"] != assistant.id:
+                try:
+                    await cls.async_client.beta.assistants.delete(
+                        record["assistant_id"]
+                    )
+                    logger.info(
+                        f"Deleted superseded assistant {record['assistant_id']}"
+                    )
+                except NotFoundError:
+                    pass
 
-        cls.config["run_instructions"] += "\n".join(
-            [vs.instructions for vs in cls.vector_storages]
-        )
+        return assistant
+
+    @classmethod
+    def vector_store_ids(cls) -> List[str]:
+        """
+        Returns the IDs of the vector stores attached to the assistant.
+
+        Returns:
+        - List[str]: The IDs of the vector stores.
+        """
+
+        tool_resources = cls.assistant.tool_resources
+        if tool_resources is None or tool_resources.file_search is None:
+            return []
+        return tool_resources.file_search.vector_store_ids or []
 
     @classmethod
+    @instrument("assistant.create_thread")
     async def create_thread(cls, user_id: int) -> str:
         """
         Creates a new thread for a user or conversation.
@@ -181,10 +615,14 @@ class AssistantService:
         - str: The thread ID.
         """
 
+        if cls.backend is not None:
+            return await cls.backend.create_thread(user_id)
+
         thread = await cls.async_client.beta.threads.create()
         return thread.id
 
     @classmethod
+    @instrument("assistant.request")
     async def request(cls, user_id: int, thread_id: str, prompt: str) -> str:
         """
         Sends a prompt to the assistant and retrieves the response.
@@ -205,69 +643,277 @@ class AssistantService:
                 "async_client must be initialized before calling speech_to_text."
             )
 
+        passages = RetrievalService.search(prompt)
+
+        if cls.backend is not None:
+            response = await cls.backend.request(
+                user_id,
+                thread_id,
+                prompt,
+                instructions=RetrievalService.format_instructions(passages),
+            )
+            return RetrievalService.format_citations(response, passages)
+
         user_message = await cls.async_client.beta.threads.messages.create(
             thread_id=thread_id, role="user", content=prompt
         )
 
-        run = await cls.async_client.beta.threads.runs.create_and_poll(
+        run = await cls.async_client.beta.threads.runs.create(
             thread_id=thread_id,
             assistant_id=cls.assistant.id,
             instructions=cls.config["run_instructions"],
+            **ContextService.run_options(thread_id),
+            **RetrievalService.run_options(passages),
         )
+        ConversationScheduler.bind_run(user_id, thread_id, run.id)
+        run = await RunPoller.wait(thread_id, run.id)
 
         if run.status == "requires_action":
-            tool_outputs = []
-            for tool in run.required_action.submit_tool_outputs.tool_calls:
-                if tool.function.name == "save_values":
-                    is_saved = await cls.save_values(
-                        user_id=user_id,
-                        key_values=", ".join(
-                            json.loads(tool.function.arguments)["key_values"]
-                        ),
-                    )
-
-                    if is_saved:
-                        output = Strings.KEY_VALUES_ARE_DEFINED
-                    else:
-                        output = Strings.KEY_VALUES_ARE_NOT_DEFINED
-
-                    tool_outputs.append(
-                        {
-                            "tool_call_id": tool.id,
-                            "output": output,
-                        }
-                    )
+            tool_outputs = await cls.handle_tool_calls(user_id=user_id, run=run)
 
-                run = await cls.async_client.beta.threads.runs.submit_tool_outputs_and_poll(
-                    thread_id=thread_id, run_id=run.id, tool_outputs=tool_outputs
-                )
+            run = await cls.async_client.beta.threads.runs.submit_tool_outputs(
+                thread_id=thread_id, run_id=run.id, tool_outputs=tool_outputs
+            )
+            run = await RunPoller.wait(thread_id, run.id)
+        observe_run(run)
+        ContextService.record_usage(run)
 
-        if run.status == "completed":
+        if run.status == "cancelled":
+            raise RunCancelledError(f"Run {run.id} was cancelled.")
+        elif run.status == "completed":
             messages = await cls.async_client.beta.threads.messages.list(
                 thread_id=thread_id
             )
 
             if messages.data and messages.data[0].role == "assistant":
-                message_content = messages.data[0].content[0].text
-                citations = []
-                annotations = message_content.annotations
-                for index, annotation in enumerate(annotations):
-                    if file_citation := getattr(annotation, "file_citation", None):
-                        cited_file = await cls.async_client.files.retrieve(
-                            file_citation.file_id
-                        )
-                        citations.append(cited_file.filename)
-                    if index < len(citations):
-                        message_content.value = message_content.value.replace(
-                            annotation.text, f" [Источник: {citations[index]}]"
-                        )
-                ans = message_content.value
-                return ans
+                return RetrievalService.format_citations(
+                    await cls.format_message(messages.data[0]), passages
+                )
             else:
                 raise ValueError("No assistant message found")
         else:
             raise ValueError(f'Run status is not <completed>, it\'s "{run.status}".')
 
+    @classmethod
+    @instrument("assistant.request_stream")
+    async def request_stream(
+        cls, user_id: int, thread_id: str, prompt: str
+    ) -> AsyncIterator[str]:
+        """
+        Sends a prompt to the assistant and streams the response as it is generated.
+
+        Every yielded value is the whole text generated so far, with raw citation markers stripped.
+        The last yielded value is the final response formatted in the same way as by `request`.
+
+        Parameters:
+        - user_id (int): A unique identifier for the user or conversation.
+        - thread_id (str): The thread ID of the conversation.
+        - prompt (str): The text prompt to send to the assistant.
+
+        Returns:
+        - AsyncIterator[str]: The assistant's response text accumulated so far.
+
+        Raises:
+        - Exception: If the run does not complete or if no assistant message is found.
+        """
+
+        if cls.async_client is None:
+            raise ValueError(
+                "async_client must be initialized before calling request_stream."
+            )
+
+        passages = RetrievalService.search(prompt)
+
+        if cls.backend is not None:
+            text = ""
+            async for text in cls.backend.request_stream(
+                user_id,
+                thread_id,
+                prompt,
+                instructions=RetrievalService.format_instructions(passages),
+            ):
+                yield cls.annotation_pattern.sub("", text)
+            yield RetrievalService.format_citations(text, passages)
+            return
+
+        await cls.async_client.beta.threads.messages.create(
+            thread_id=thread_id, role="user", content=prompt
+        )
+
+        stream_manager = cls.async_client.beta.threads.runs.stream(
+            thread_id=thread_id,
+            assistant_id=cls.assistant.id,
+            instructions=cls.config["run_instructions"],
+            **ContextService.run_options(thread_id),
+            **RetrievalService.run_options(passages),
+        )
+
+        text = ""
+        final_message = None
+        while stream_manager is not None:
+            async with stream_manager as stream:
+                stream_manager = None
+                async for event in stream:
+                    if event.event == "thread.run.created":
+                        ConversationScheduler.bind_run(
+                            user_id, thread_id, event.data.id
+                        )
+                    elif event.event == "thread.message.created":
+                        text = ""
+                    elif event.event == "thread.message.delta":
+                        for block in event.data.delta.content or []:
+                            if block.type == "text" and block.text and block.text.value:
+                                text += block.text.value
+                                yield cls.annotation_pattern.sub("", text)
+                    elif event.event == "thread.message.completed":
+                        final_message = event.data
+                    elif event.event == "thread.run.requires_action":
+                        tool_outputs = await cls.handle_tool_calls(
+                            user_id=user_id, run=event.data
+                        )
+                        stream_manager = cls.async_client.beta.threads.runs.submit_tool_outputs_stream(
+                            thread_id=thread_id,
+                            run_id=event.data.id,
+                            tool_outputs=tool_outputs,
+                        )
+                    elif event.event == "thread.run.completed":
+                        observe_run(event.data)
+                        ContextService.record_usage(event.data)
+                    elif event.event == "thread.run.cancelled":
+                        raise RunCancelledError(f"Run {event.data.id} was cancelled.")
+                    elif event.event in ("thread.run.failed", "thread.run.expired"):
+                        raise ValueError(
+                            f'Run status is not <completed>, it\'s "{event.data.status}".'
+                        )
+
+        if final_message is None or final_message.role != "assistant":
+            raise ValueError("No assistant message found")
+
+        yield RetrievalService.format_citations(
+            await cls.format_message(final_message), passages
+        )
+
+    @classmethod
+    @instrument("assistant.tool_calls")
+    async def handle_tool_calls(cls, user_id: int, run: Run) -> List[dict]:
+        """
+        Executes the tool calls required by a run and collects their outputs.
+
+        Parameters:
+        - user_id (int): A unique identifier for the user or conversation.
+        - run (Run): The run in the 'requires_action' status.
+
+        Returns:
+        - List[dict]: The tool outputs to submit back to the run.
+        """
+
+        tool_outputs = []
+        for tool in run.required_action.submit_tool_outputs.tool_calls:
+            output = await cls.call_tool(
+                user_id, tool.function.name, tool.function.arguments
+            )
+            if output is not None:
+                tool_outputs.append(
+                    {
+                        "tool_call_id": tool.id,
+                        "output": output,
+                    }
+                )
+        return tool_outputs
+
+    @classmethod
+    async def call_tool(cls, user_id: int, name: str, arguments: str) -> Optional[str]:
+        """
+        Calls a function tool of the assistant.
+
+        Parameters:
+        - user_id (int): A unique identifier for the user or conversation.
+        - name (str): The name of the function.
+        - arguments (str): The arguments of the function, in JSON.
+
+        Returns:
+        - Optional[str]: The output of the function, or None if the function is unknown.
+        """
+
+        if name == "save_values":
+            is_saved = await cls.save_values(
+                user_id=user_id,
+                key_values=", ".join(json.loads(arguments)["key_values"]),
+            )
+
+            if is_saved:
+                return Strings.KEY_VALUES_ARE_DEFINED
+            else:
+                return Strings.KEY_VALUES_ARE_NOT_DEFINED
+        return None
+
+    @classmethod
+    async def format_message(cls, message: Message) -> str:
+        """
+        Extracts the text of an assistant message and replaces its file citations with source names.
+
+        Parameters:
+        - message (Message): The assistant message to format.
+
+        Returns:
+        - str: The message text with citations in the form ' [Источник: <file name>]'.
+        """
+
+        message_content = message.content[0].text
+        annotations = sorted(
+            message_content.annotations, key=lambda annotation: annotation.start_index
+        )
+
+        await cls.resolve_file_names(
+            {
+                file_citation.file_id
+                for annotation in annotations
+                if (file_citation := getattr(annotation, "file_citation", None))
+            }
+        )
+
+        parts = []
+        position = 0
+        for annotation in annotations:
+            file_citation = getattr(annotation, "file_citation", None)
+            if file_citation is None or annotation.start_index < position:
+                continue
+            parts.append(message_content.value[position : annotation.start_index])
+            file_name = cls.file_names.get(file_citation.file_id, file_citation.file_id)
+            parts.append(f" [Источник: {file_name}]")
+            position = annotation.end_index
+        parts.append(message_content.value[position:])
+        return "".join(parts)
+
+    @classmethod
+    @instrument("assistant.citations")
+    async def resolve_file_names(cls, file_ids: Iterable[str]):
+        """
+        Retrieves the names of the files that are not cached yet, concurrently.
+        A file that cannot be retrieved is not cached, so it is named by its ID until a later retrieval succeeds.
+
+        Parameters:
+        - file_ids (Iterable[str]): IDs of the files.
+
+        Returns:
+        - None
+        """
+
+        unknown_file_ids = [
+            file_id for file_id in file_ids if file_id not in cls.file_names
+        ]
+        files = await asyncio.gather(
+            *(cls.async_client.files.retrieve(file_id) for file_id in unknown_file_ids),
+            return_exceptions=True,
+        )
+        for file_id, file in zip(unknown_file_ids, files):
+            if isinstance(file, Exception):
+                logger.error(
+                    f"Error while retrieving the name of file {file_id}: {file}"
+                )
+            else:
+                cls.file_names[file_id] = file.filename
+
     @classmethod
     async def save_values(cls, user_id: int, key_values: str) -> bool:
         """
@@ -328,28 +974,36 @@ class AssistantService:
         - str: A formatted string listing all vector storages and their file names.
         """
 
-        ans = f"There are <b>{len(cls.vector_storages)}</b> vector storages:\n"
-        for vs in cls.vector_storages:
+        storages = [(vs.name, vs.file_paths) for vs in cls.vector_storages]
+        # With the local retrieval, the indexes take the place of the vector storages.
+        storages += [
+            (name, list(index.source_hashes))
+            for name, index in RetrievalService.indexes.items()
+        ]
+
+        ans = f"There are <b>{len(storages)}</b> vector storages:\n"
+        for name, file_paths in storages:
             file_names = "\n\t".join(
-                [
-                    f"'<i>{os.path.basename(file_path)}</i>'"
-                    for file_path in vs.file_paths
-                ]
+                [f"'<i>{os.path.basename(file_path)}</i>'" for file_path in file_paths]
             )
-            ans += f"name: '<i>{vs.name}</i>'\n\t" + file_names
+            ans += f"name: '<i>{name}</i>'\n\t" + file_names + "\n"
         return ans
 
     @classmethod
-    async def clear_context(cls, user_id: int):
+    async def clear_context(cls, user_id: int, thread_id: Optional[str]) -> str:
         """
-        Deletes a thread for a user or conversation.
+        Starts a new conversation for a user, with an empty context.
+
+        The old thread is not deleted, as a run may still be in progress on it.
 
         Parameters:
         - user_id (int): A unique identifier for the user or conversation.
+        - thread_id (Optional[str]): The thread ID of the current conversation, if any.
 
         Returns:
-        - None
+        - str: The thread ID of the new conversation.
         """
 
-        if user_id in cls.threads:
-            del cls.threads[user_id]
+        if thread_id is not None:
+            ContextService.forget(thread_id)
+        return await cls.create_thread(user_id)
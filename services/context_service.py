@@ -0,0 +1,239 @@
+from typing import List
+
+from loguru import logger
+from openai import AsyncOpenAI
+from openai.types.beta.threads import Message, Run
+
+from config import settings
+from monitoring import ASSISTANT_RUN_TOKENS, CONTEXT_ROLLOVERS, instrument
+from repositories import ConversationSummaryRepository
+from utils import LruCache
+
+
+class ContextService:
+    """
+    A class for keeping the context of the conversations bounded, so that the cost and the latency of the runs
+    do not grow with the length of the conversation.
+
+    The size of the context of a thread is known from the usage of its latest run. Once it exceeds the limit,
+    the conversation is rolled over into a new thread seeded with a summary of the old one and its latest messages.
+    The summary of a thread includes the summary the thread was seeded with, so it rolls over as well.
+    Until a thread is rolled over, e.g. if the summarization fails, its runs only see its latest messages.
+    """
+
+    # A dictionary containing configuration options for the service.
+    config = {
+        # The number of tokens of the context of a thread above which it is rolled over.
+        "max_context_tokens": 8000,
+        "summary_model": "gpt-3.5-turbo",
+        "summary_max_tokens": 500,
+        "summary_instructions": (
+            "Summarize the conversation between the user and the assistant below for the assistant to continue it. "
+            "Keep the facts about the user, the life values the user has named or the assistant has identified, "
+            "the questions that are still open and the language of the conversation. "
+            "Be concise and write in the language of the conversation."
+        ),
+        # The number of latest messages of a thread that are summarized.
+        "summarized_messages": 100,
+        # The number of latest messages carried over to the new thread as they are.
+        "kept_messages": 4,
+        # The number of latest messages seen by the runs of a thread that is over the limit.
+        "truncation_last_messages": 10,
+    }
+
+    # An OpenAI client for making requests to the service.
+    async_client = None
+
+    # Maps thread IDs to the number of tokens of their context, as of their latest runs.
+    context_tokens = LruCache(max_size=10000)
+
+    @classmethod
+    def initialize(cls, async_client: AsyncOpenAI):
+        """
+        Initializes the ContextService with an instance of AsyncOpenAI and the settings.
+
+        Parameters:
+        - async_client (AsyncOpenAI): An instance of AsyncOpenAI to use for making requests.
+
+        Returns:
+        - None
+        """
+
+        cls.async_client = async_client
+        cls.config.update(
+            max_context_tokens=settings.CONTEXT_MAX_TOKENS,
+            summary_model=settings.CONTEXT_SUMMARY_MODEL,
+        )
+
+    @classmethod
+    def record_usage(cls, run: Run):
+        """
+        Records the size of the context of the thread of a finished run, and the tokens of the run in the metrics.
+
+        The next run of the thread sees the prompt and the completion of this run, so their tokens approximate
+        the context. For runs with several steps, e.g. tool calls, the context is overestimated.
+
+        Parameters:
+        - run (Run): The finished run.
+
+        Returns:
+        - None
+        """
+
+        if run.usage is None:
+            return
+        ASSISTANT_RUN_TOKENS.labels("prompt").observe(run.usage.prompt_tokens)
+        ASSISTANT_RUN_TOKENS.labels("completion").observe(run.usage.completion_tokens)
+        cls.context_tokens.set(run.thread_id, run.usage.total_tokens)
+
+    @classmethod
+    def needs_rollover(cls, thread_id: str) -> bool:
+        """
+        Returns whether the context of a thread exceeds the limit.
+
+        Parameters:
+        - thread_id (str): The thread ID.
+
+        Returns:
+        - bool: True if the thread is to be rolled over.
+        """
+
+        return cls.context_tokens.get(thread_id, 0) > cls.config["max_context_tokens"]
+
+    @classmethod
+    def run_options(cls, thread_id: str) -> dict:
+        """
+        Returns the options of the next run of a thread that bound its context.
+
+        Parameters:
+        - thread_id (str): The thread ID.
+
+        Returns:
+        - dict: The truncation strategy of the run if the thread is over the limit, otherwise nothing.
+        """
+
+        if not cls.needs_rollover(thread_id):
+            return {}
+        return {
+            "truncation_strategy": {
+                "type": "last_messages",
+                "last_messages": cls.config["truncation_last_messages"],
+            }
+        }
+
+    @classmethod
+    def forget(cls, thread_id: str):
+        """
+        Forgets the size of the context of a thread that is no longer used.
+
+        Parameters:
+        - thread_id (str): The thread ID.
+
+        Returns:
+        - None
+        """
+
+        cls.context_tokens.pop(thread_id)
+
+    @classmethod
+    @instrument("context.rollover")
+    async def rollover(cls, user_id: int, thread_id: str) -> str:
+        """
+        Creates a new thread seeded with a summary of a thread and its latest messages, and saves the summary.
+
+        Parameters:
+        - user_id (int): A unique identifier for the user.
+        - thread_id (str): The ID of the thread to roll over.
+
+        Returns:
+        - str: The ID of the new thread.
+
+        Raises:
+        - ValueError: If the async_client is not initialized before calling this method.
+        """
+
+        if cls.async_client is None:
+            raise ValueError(
+                "async_client must be initialized before calling rollover."
+            )
+
+        messages = await cls.async_client.beta.threads.messages.list(
+            thread_id=thread_id, order="desc", limit=cls.config["summarized_messages"]
+        )
+        transcript = [
+            (message.role, text)
+            for message in reversed(messages.data)
+            if (text := cls.get_text(message))
+        ]
+        summary = await cls.summarize(transcript)
+
+        kept_messages = transcript[-cls.config["kept_messages"] :]
+        thread = await cls.async_client.beta.threads.create(
+            messages=[
+                {
+                    "role": "assistant",
+                    "content": f"Summary of our conversation so far:\n{summary}",
+                },
+                *({"role": role, "content": text} for role, text in kept_messages),
+            ]
+        )
+
+        context_tokens = cls.context_tokens.get(thread_id, 0)
+        cls.forget(thread_id)
+        CONTEXT_ROLLOVERS.inc()
+        logger.info(
+            f"Rolled over thread {thread_id} of user_id[{user_id}] with {context_tokens} tokens "
+            f"into thread {thread.id}"
+        )
+
+        try:
+            await ConversationSummaryRepository().save_summary(
+                user_id=user_id,
+                thread_id=thread_id,
+                new_thread_id=thread.id,
+                summary=summary,
+                context_tokens=context_tokens,
+            )
+        except Exception as e:
+            logger.error(f"Error in ContextService while saving the summary: {e}")
+
+        return thread.id
+
+    @classmethod
+    async def summarize(cls, transcript: List[tuple]) -> str:
+        """
+        Summarizes a conversation.
+
+        Parameters:
+        - transcript (List[tuple]): The messages of the conversation: (role, text), in order.
+
+        Returns:
+        - str: The summary.
+        """
+
+        conversation = "\n\n".join(f"{role}: {text}" for role, text in transcript)
+        completion = await cls.async_client.chat.completions.create(
+            model=cls.config["summary_model"],
+            max_tokens=cls.config["summary_max_tokens"],
+            messages=[
+                {"role": "system", "content": cls.config["summary_instructions"]},
+                {"role": "user", "content": conversation},
+            ],
+        )
+        return completion.choices[0].message.content.strip()
+
+    @staticmethod
+    def get_text(message: Message) -> str:
+        """
+        Returns the text of a message, without its images and other content.
+
+        Parameters:
+        - message (Message): The message.
+
+        Returns:
+        - str: The text.
+        """
+
+        return "\n".join(
+            block.text.value for block in message.content if block.type == "text"
+        ).strip()
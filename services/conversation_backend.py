@@ -0,0 +1,279 @@
+import abc
+import json
+import uuid
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from loguru import logger
+from openai import AsyncOpenAI
+from redis.asyncio import Redis
+
+from utils import LruCache
+
+from .conversation_scheduler import ConversationScheduler, RunCancelledError
+from .openai_scheduler import OpenAIScheduler
+
+
+class ConversationBackend(abc.ABC):
+    """
+    ConversationBackend is the base class of the ways the assistant answers the user, other than the Assistants API
+    used by the AssistantService itself.
+    """
+
+    @abc.abstractmethod
+    async def create_thread(self, user_id: int) -> str:
+        """
+        Creates a new conversation for a user.
+
+        Parameters:
+        - user_id (int): A unique identifier for the user.
+
+        Returns:
+        - str: The ID of the conversation, stored as the thread ID of the user.
+        """
+
+    @abc.abstractmethod
+    def request_stream(
+        self, user_id: int, thread_id: str, prompt: str, instructions: str = ""
+    ) -> AsyncIterator[str]:
+        """
+        Sends a prompt to the assistant and streams the response as it is generated.
+        Implemented as an async generator.
+
+        Parameters:
+        - user_id (int): A unique identifier for the user.
+        - thread_id (str): The ID of the conversation.
+        - prompt (str): The text prompt.
+        - instructions (str): Instructions for this response only, added to the system instructions.
+
+        Returns:
+        - AsyncIterator[str]: The response text accumulated so far; the last value is the final response.
+        """
+
+    async def request(
+        self, user_id: int, thread_id: str, prompt: str, instructions: str = ""
+    ) -> str:
+        """
+        Sends a prompt to the assistant and retrieves the response.
+
+        Parameters:
+        - user_id (int): A unique identifier for the user.
+        - thread_id (str): The ID of the conversation.
+        - prompt (str): The text prompt.
+        - instructions (str): Instructions for this response only, added to the system instructions.
+
+        Returns:
+        - str: The response.
+        """
+
+        response = None
+        async for response in self.request_stream(
+            user_id, thread_id, prompt, instructions
+        ):
+            pass
+        return response
+
+
+class ChatCompletionsBackend(ConversationBackend):
+    """
+    ChatCompletionsBackend answers with streamed chat completions, keeping the history of the conversations itself.
+
+    A reply takes a single request, or one more per round of tool calls, which are handled in the process.
+    The history holds the prompts and the final responses only and is trimmed to its latest messages,
+    which bounds the context. It is kept in Redis, or in memory without Redis.
+    """
+
+    key_prefix = "chat_history"
+
+    def __init__(
+        self,
+        async_client: AsyncOpenAI,
+        model: str,
+        instructions: str,
+        tools: List[dict],
+        call_tool: Callable[[int, str, str], Awaitable[Optional[str]]],
+        redis: Optional[Redis] = None,
+        max_history_messages: int = 40,
+        history_ttl: int = 30 * 24 * 60 * 60,
+        max_tool_rounds: int = 3,
+    ):
+        """
+        Initializes the backend.
+
+        Parameters:
+        - async_client (AsyncOpenAI): An instance of AsyncOpenAI to use for making requests.
+        - model (str): The model answering the user.
+        - instructions (str): The system instructions.
+        - tools (List[dict]): The function tools of the assistant, in the Assistants API format.
+        - call_tool (Callable[[int, str, str], Awaitable[Optional[str]]]): Calls a tool with the user ID,
+          the name of the tool and its JSON arguments, and returns its output, or None if the tool is unknown.
+        - redis (Optional[Redis]): The Redis client keeping the history, or None to keep it in memory.
+        - max_history_messages (int): The maximum number of messages of a conversation that are kept.
+        - history_ttl (int): The number of seconds after the last message that a conversation is kept.
+        - max_tool_rounds (int): The maximum number of rounds of tool calls in a reply.
+        """
+
+        self.async_client = async_client
+        self.model = model
+        self.instructions = instructions
+        # The schema of the function tools is the same in both APIs.
+        self.tools = [
+            {"type": "function", "function": tool["function"]}
+            for tool in tools
+            if tool["type"] == "function"
+        ]
+        self.call_tool = call_tool
+        self.redis = redis
+        self.max_history_messages = max_history_messages
+        self.history_ttl = history_ttl
+        self.max_tool_rounds = max_tool_rounds
+        self.memory = LruCache(max_size=10000, ttl=history_ttl)
+
+    async def create_thread(self, user_id: int) -> str:
+        # The conversation is created with its first message.
+        return f"chat_{uuid.uuid4().hex}"
+
+    async def get_history(self, thread_id: str) -> List[Dict[str, str]]:
+        """
+        Returns the history of a conversation.
+
+        Parameters:
+        - thread_id (str): The ID of the conversation.
+
+        Returns:
+        - List[Dict[str, str]]: The messages, in order.
+        """
+
+        if self.redis is None:
+            return list(self.memory.get(thread_id, []))
+        records = await self.redis.lrange(f"{self.key_prefix}:{thread_id}", 0, -1)
+        return [json.loads(record) for record in records]
+
+    async def append_history(self, thread_id: str, messages: List[Dict[str, str]]):
+        """
+        Appends messages to the history of a conversation, keeping only its latest messages.
+
+        Parameters:
+        - thread_id (str): The ID of the conversation.
+        - messages (List[Dict[str, str]]): The messages.
+
+        Returns:
+        - None
+        """
+
+        if self.redis is None:
+            history = self.memory.get(thread_id, []) + messages
+            self.memory.set(thread_id, history[-self.max_history_messages :])
+            return
+
+        key = f"{self.key_prefix}:{thread_id}"
+        async with self.redis.pipeline(transaction=True) as pipeline:
+            pipeline.rpush(key, *(json.dumps(message) for message in messages))
+            pipeline.ltrim(key, -self.max_history_messages, -1)
+            pipeline.expire(key, self.history_ttl)
+            await pipeline.execute()
+
+    async def request_stream(
+        self, user_id: int, thread_id: str, prompt: str, instructions: str = ""
+    ) -> AsyncIterator[str]:
+        history = await self.get_history(thread_id)
+        messages = [
+            {
+                "role": "system",
+                "content": "\n\n".join(filter(None, [self.instructions, instructions])),
+            },
+            *history,
+            {"role": "user", "content": prompt},
+        ]
+
+        text = ""
+        for tool_round in range(self.max_tool_rounds + 1):
+            options = {}
+            if self.tools and tool_round < self.max_tool_rounds:
+                options["tools"] = self.tools
+
+            with OpenAIScheduler.context("assistant"):
+                stream = await self.async_client.chat.completions.create(
+                    model=self.model, messages=messages, stream=True, **options
+                )
+
+            cancelled = False
+
+            async def cancel():
+                nonlocal cancelled
+                cancelled = True
+                await stream.close()
+
+            ConversationScheduler.bind_cancel(user_id, cancel)
+
+            text = ""
+            # Maps the indexes of the tool calls to their IDs, names and arguments.
+            tool_calls: Dict[int, Dict[str, str]] = {}
+            try:
+                async for chunk in stream:
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta
+                    if delta.content:
+                        text += delta.content
+                        yield text
+                    for tool_call in delta.tool_calls or []:
+                        call = tool_calls.setdefault(
+                            tool_call.index, {"id": "", "name": "", "arguments": ""}
+                        )
+                        call["id"] += tool_call.id or ""
+                        if tool_call.function is not None:
+                            call["name"] += tool_call.function.name or ""
+                            call["arguments"] += tool_call.function.arguments or ""
+            except Exception:
+                if not cancelled:
+                    raise
+            if cancelled:
+                raise RunCancelledError(
+                    f"Completion of conversation {thread_id} was cancelled."
+                )
+
+            if not tool_calls:
+                break
+
+            messages.append(
+                {
+                    "role": "assistant",
+                    "content": text or None,
+                    "tool_calls": [
+                        {
+                            "id": call["id"],
+                            "type": "function",
+                            "function": {
+                                "name": call["name"],
+                                "arguments": call["arguments"],
+                            },
+                        }
+                        for call in tool_calls.values()
+                    ],
+                }
+            )
+            for call in tool_calls.values():
+                try:
+                    output = await self.call_tool(
+                        user_id, call["name"], call["arguments"]
+                    )
+                except Exception as e:
+                    logger.error(f"Error while calling tool {call['name']}: {e}")
+                    output = f"Error: {e}"
+                if output is None:
+                    output = f"Error: unknown function {call['name']}"
+                messages.append(
+                    {"role": "tool", "tool_call_id": call["id"], "content": output}
+                )
+
+        if not text:
+            raise ValueError("No assistant message found")
+
+        await self.append_history(
+            thread_id,
+            [
+                {"role": "user", "content": prompt},
+                {"role": "assistant", "content": text},
+            ],
+        )
+        yield text
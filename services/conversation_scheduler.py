@@ -0,0 +1,223 @@
+import asyncio
+from contextlib import asynccontextmanager, nullcontext
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+from loguru import logger
+from openai import AsyncOpenAI
+from redis.asyncio import Redis
+
+
+class RunCancelledError(Exception):
+    """
+    Raised when an assistant run or a completion is cancelled because the user sent newer messages.
+    """
+
+
+class ConversationScheduler:
+    """
+    A class for scheduling assistant runs per conversation.
+
+    Only one run can be active on a thread, so turns of the same user are executed one after another.
+    Prompts that arrive while a run is in flight are merged into a single follow-up run,
+    and the in-flight run is cancelled once enough newer prompts are waiting.
+    The turns are keyed by user rather than by thread, as the thread of the user may change between turns.
+    With Redis, the turns of a user are also serialized between the replicas of the bot.
+    """
+
+    class Conversation:
+        """
+        A class for holding the scheduling state of the conversation of one user.
+        """
+
+        def __init__(self, user_id: int):
+            """
+            Initializes the state of the conversation.
+
+            Parameters:
+            - user_id (int): A unique identifier for the user of the conversation.
+            """
+
+            self.user_id = user_id
+            self.lock = asyncio.Lock()
+            # Prompts that are not taken by a turn yet, each wrapped in a list to be identified by object.
+            self.pending = []
+            # The number of turns entered and not finished yet, including the one in flight.
+            self.depth = 0
+            # Cancels the run or the completion in flight, if any.
+            self.cancel: Optional[Callable[[], Awaitable[None]]] = None
+
+    # A dictionary containing configuration options for the scheduler.
+    config = {
+        # The number of waiting prompts after which the in-flight run is cancelled.
+        "cancel_after_pending": 2,
+        # The separator between the prompts merged into a single run.
+        "separator": "\n\n",
+        # The time after which the lock of a user held by a crashed replica expires, in seconds.
+        "lock_timeout": 600,
+    }
+
+    # An OpenAI client for cancelling runs.
+    async_client = None
+
+    # A Redis client shared by the replicas, or None if the bot runs as a single process.
+    redis: Optional[Redis] = None
+
+    # Maps user IDs to the state of their conversations.
+    conversations = {}
+
+    @classmethod
+    def initialize(cls, async_client: AsyncOpenAI, redis: Redis = None):
+        """
+        Initializes the ConversationScheduler with an instance of AsyncOpenAI.
+
+        Parameters:
+        - async_client (AsyncOpenAI): An instance of AsyncOpenAI to use for cancelling runs.
+        - redis (Redis): A Redis client shared by the replicas of the bot, to serialize the turns between them.
+
+        Returns:
+        - None
+        """
+
+        cls.async_client = async_client
+        cls.redis = redis
+
+    @classmethod
+    @asynccontextmanager
+    async def turn(cls, user_id: int, prompt: str) -> AsyncIterator[Optional[str]]:
+        """
+        Waits until the conversation is free and takes all the prompts that are waiting in it.
+
+        The context yields the prompt of the run to make, which merges the given prompt with the prompts
+        that arrived before the turn started, or None if the given prompt was already merged into
+        the run of an earlier turn. The thread of the run is to be read within the turn.
+
+        Parameters:
+        - user_id (int): A unique identifier for the user or conversation.
+        - prompt (str): The text prompt sent by the user.
+
+        Returns:
+        - AsyncIterator[Optional[str]]: The prompt of the run, or None if there is nothing to run.
+        """
+
+        conversation = cls.conversations.get(user_id)
+        if conversation is None:
+            conversation = cls.conversations[user_id] = cls.Conversation(user_id)
+
+        entry = [prompt]
+        conversation.pending.append(entry)
+        conversation.depth += 1
+        if conversation.depth > 1:
+            logger.info(
+                f"Conversation queue depth for user_id[{user_id}]: {conversation.depth}"
+            )
+
+        try:
+            if (
+                conversation.cancel is not None
+                and len(conversation.pending) >= cls.config["cancel_after_pending"]
+            ):
+                await cls.cancel_run(conversation)
+
+            async with conversation.lock, cls.lock_user(user_id):
+                if not any(pending is entry for pending in conversation.pending):
+                    yield None
+                    return
+
+                prompts = [pending[0] for pending in conversation.pending]
+                conversation.pending.clear()
+                try:
+                    yield cls.config["separator"].join(prompts)
+                finally:
+                    conversation.cancel = None
+        finally:
+            conversation.depth -= 1
+            if conversation.depth == 0:
+                del cls.conversations[user_id]
+
+    @classmethod
+    def lock_user(cls, user_id: int):
+        """
+        Returns a lock of the user shared by the replicas of the bot, which may receive messages of the same user.
+
+        Parameters:
+        - user_id (int): A unique identifier for the user.
+
+        Returns:
+        - Lock: The Redis lock, or a no-op context manager without Redis.
+        """
+
+        if cls.redis is None:
+            return nullcontext()
+        return cls.redis.lock(
+            f"conversation_lock:{user_id}", timeout=cls.config["lock_timeout"]
+        )
+
+    @classmethod
+    def bind_run(cls, user_id: int, thread_id: str, run_id: str):
+        """
+        Registers the assistant run in flight in the conversation, so that it can be cancelled by newer prompts.
+
+        Parameters:
+        - user_id (int): A unique identifier for the user.
+        - thread_id (str): The thread ID of the run.
+        - run_id (str): The ID of the run.
+
+        Returns:
+        - None
+        """
+
+        async def cancel():
+            await cls.async_client.beta.threads.runs.cancel(run_id, thread_id=thread_id)
+
+        cls.bind_cancel(user_id, cancel)
+
+    @classmethod
+    def bind_cancel(cls, user_id: int, cancel: Callable[[], Awaitable[None]]):
+        """
+        Registers the way to cancel the run or the completion in flight in the conversation,
+        so that it can be cancelled by newer prompts.
+
+        Parameters:
+        - user_id (int): A unique identifier for the user.
+        - cancel (Callable[[], Awaitable[None]]): Cancels the run or the completion.
+
+        Returns:
+        - None
+        """
+
+        if conversation := cls.conversations.get(user_id):
+            conversation.cancel = cancel
+
+    @classmethod
+    async def cancel_run(cls, conversation: "Conversation"):
+        """
+        Cancels the run or the completion in flight in the conversation.
+
+        Parameters:
+        - conversation (Conversation): The state of the conversation.
+
+        Returns:
+        - None
+        """
+
+        cancel, conversation.cancel = conversation.cancel, None
+        try:
+            await cancel()
+            logger.info(f"Cancelled superseded run of user_id[{conversation.user_id}]")
+        except Exception as e:
+            logger.error(f"Error in ConversationScheduler while cancelling a run: {e}")
+
+    @classmethod
+    def get_queue_depth(cls, user_id: int) -> int:
+        """
+        Returns the number of the user's turns that are waiting or in flight.
+
+        Parameters:
+        - user_id (int): A unique identifier for the user.
+
+        Returns:
+        - int: The queue depth of the user.
+        """
+
+        conversation = cls.conversations.get(user_id)
+        return conversation.depth if conversation is not None else 0
@@ -1,10 +1,23 @@
+import asyncio
 import json
-from typing import List
+from typing import BinaryIO, List, Optional
 
 from loguru import logger
 from openai import AsyncOpenAI
 
-from utils import Emotions, encode_image
+from monitoring import instrument
+from utils import (
+    Emotions,
+    LruCache,
+    crop_to_face,
+    detect_face,
+    downscale_image,
+    encode_image,
+    is_face_detection_available,
+    load_image,
+)
+
+from .openai_scheduler import OpenAIScheduler
 
 
 class EmotionService:
@@ -42,11 +55,23 @@ class EmotionService:
             },
         ],
         "max_tokens": 300,
+        # The minimum shorter side of the photo size to download, in pixels.
+        "photo_min_side": 512,
+        # The maximum number of pixels of the image sent to the model, which fits a single low detail tile.
+        "max_pixels": 512 * 512,
+        "detail": "low",
+        # The margin kept around the detected face, relative to its size.
+        "face_margin": 0.5,
+        # The number of identified emotions kept in the cache.
+        "cache_size": 4096,
     }
 
     # An OpenAI client for making requests to the speech service.
     async_client = None
 
+    # Maps the unique IDs of the photos to the emotions identified in them, so that re-sent photos are not analyzed again.
+    cache = LruCache(max_size=config["cache_size"])
+
     @classmethod
     def initialize(cls, async_client: AsyncOpenAI):
         """
@@ -62,15 +87,59 @@ class EmotionService:
         cls.async_client = async_client
 
     @classmethod
-    async def identify_emotions(cls, image_path: str) -> List[str]:
+    def prepare_image(cls, image_file: BinaryIO) -> Optional[BinaryIO]:
+        """
+        Crops the image to the largest face in it and downscales it to the configured pixel budget.
+        If OpenCV is not installed, the whole image is used.
+        This method is CPU-bound and should be run in a thread.
+
+        Parameters:
+        - image_file (BinaryIO): The image file.
+
+        Returns:
+        - Optional[BinaryIO]: The prepared JPEG image, or None if there is no face in the image.
+        """
+
+        image = load_image(image_file)
+        if is_face_detection_available():
+            face = detect_face(image)
+            if face is None:
+                return None
+            image = crop_to_face(image, face, cls.config["face_margin"])
+
+        return downscale_image(image, cls.config["max_pixels"])
+
+    @classmethod
+    def get_cached_emotions(cls, file_unique_id: str) -> Optional[List[str]]:
+        """
+        Returns the emotions already identified in the photo.
+
+        Parameters:
+        - file_unique_id (str): The Telegram unique ID of the photo.
+
+        Returns:
+        - Optional[List[str]]: The identified emotions, or None if the photo was not analyzed yet.
+        """
+
+        return cls.cache.get(file_unique_id)
+
+    @classmethod
+    @instrument("emotion")
+    async def identify_emotions(
+        cls, image_file: BinaryIO, file_unique_id: str = None
+    ) -> List[str]:
         """
         Identifies the emotional state of the face depicted in the image.
 
+        Images without a face are not sent to the model. Otherwise the image is cropped to the face
+        and downscaled to the configured pixel budget before it is sent to the model.
+
         Parameters:
-        - image_path (str): Path to the image file containing the face to analyze.
+        - image_file (BinaryIO): The image file containing the face to analyze.
+        - file_unique_id (str): The Telegram unique ID of the photo, under which the result is cached.
 
         Returns:
-        - List[str]: A list of identified emotions from the image.
+        - List[str]: A list of identified emotions from the image, or Emotions.NO_FACE if there is no face in it.
         """
 
         if cls.async_client is None:
@@ -79,7 +148,13 @@ class EmotionService:
             )
 
         try:
-            base64_image = encode_image(image_path)
+            image = await asyncio.to_thread(cls.prepare_image, image_file)
+            if image is None:
+                if file_unique_id is not None:
+                    cls.cache.set(file_unique_id, Emotions.NO_FACE)
+                return Emotions.NO_FACE
+
+            base64_image = encode_image(image)
 
             messages = [
                 {
@@ -96,25 +171,28 @@ class EmotionService:
                             "type": "image_url",
                             "image_url": {
                                 "url": f"data:image/jpeg;base64,{base64_image}",
-                                "detail": "auto",
+                                "detail": cls.config["detail"],
                             },
                         },
                     ],
                 },
             ]
 
-            response = await cls.async_client.chat.completions.create(
-                model=cls.config["model"],
-                messages=messages,
-                tools=cls.config["tools"],
-                tool_choice={
-                    "type": "function",
-                    "function": {"name": "identify_emotions"},
-                },
-            )
+            with OpenAIScheduler.context("emotion"):
+                response = await cls.async_client.chat.completions.create(
+                    model=cls.config["model"],
+                    messages=messages,
+                    tools=cls.config["tools"],
+                    tool_choice={
+                        "type": "function",
+                        "function": {"name": "identify_emotions"},
+                    },
+                )
 
             output = response.choices[0].message.tool_calls[0]
             arguments_dict = json.loads(output.function.arguments)
+            if file_unique_id is not None:
+                cls.cache.set(file_unique_id, arguments_dict["emotion"])
             return arguments_dict["emotion"]
         except Exception as e:
             logger.info(
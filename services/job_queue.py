@@ -0,0 +1,629 @@
+import asyncio
+import math
+import os
+import random
+import socket
+import time
+import uuid
+import zlib
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from loguru import logger
+from redis.asyncio import Redis
+from redis.asyncio.lock import Lock
+from redis.exceptions import LockError, ResponseError
+
+from config import settings
+from monitoring import JOB_QUEUE_WAIT, JOB_SHARDS_LEASED, JOBS, JOBS_IN_FLIGHT
+
+
+class PermanentJobError(Exception):
+    """
+    Raised by the handler of a job that failed and must not be retried, e.g. because a part of its reply
+    was already delivered to the user.
+    """
+
+
+class JobQueue:
+    """
+    A class for passing the updates from the ingress processes to the worker processes through Redis streams.
+
+    Jobs are keyed by user and sharded into a fixed number of streams by their key. Each shard is leased by one
+    worker at a time, which handles the jobs of each user one after another, in order, and the jobs of different
+    users concurrently. A job is acknowledged only after it is handled, so the jobs of a crashed worker are handled
+    by the worker taking over its shards. Failed jobs are retried, then moved to a dead-letter stream.
+    The ingress waits while the backlog of a shard is full.
+    """
+
+    class Job:
+        """
+        A class for holding a job read from a stream.
+        """
+
+        def __init__(self, entry_id: bytes, fields: Dict[bytes, bytes]):
+            """
+            Initializes the job from a stream entry.
+
+            Parameters:
+            - entry_id (bytes): The ID of the entry.
+            - fields (Dict[bytes, bytes]): The fields of the entry.
+            """
+
+            self.entry_id = entry_id
+            self.user_key = fields[b"user"].decode()
+            self.payload = fields[b"payload"].decode()
+            self.enqueued_at = float(fields[b"enqueued_at"])
+            # The number of times the job was read by workers before, e.g. by a worker that crashed.
+            self.deliveries = 0
+
+    class Shard:
+        """
+        A class for holding the state of a shard leased by the worker.
+        """
+
+        def __init__(self, index: int, lease: Lock):
+            """
+            Initializes the state of the shard.
+
+            Parameters:
+            - index (int): The index of the shard.
+            - lease (Lock): The lease of the shard.
+            """
+
+            self.index = index
+            self.lease = lease
+            self.reader: Optional[asyncio.Task] = None
+            # Maps the users to their jobs that are read and not handled yet, in order.
+            self.queues: Dict[str, Deque["JobQueue.Job"]] = {}
+            self.user_tasks: Dict[str, asyncio.Task] = {}
+
+    # A dictionary containing configuration options for the queue.
+    config = {
+        "key_prefix": "jobs",
+        "group": "workers",
+        "shards": 16,
+        # The maximum number of jobs waiting in all shards, above which the ingress waits.
+        "max_backlog": 1000,
+        "backlog_check_interval": 0.5,
+        # The number of times a job is handled before it is moved to the dead-letter stream.
+        "max_attempts": 3,
+        # The delay before the first retry of a failed job, doubled every attempt.
+        "retry_delay": 1.0,
+        # The time after which the lease of a shard held by a crashed worker expires, in seconds.
+        "lease_timeout": 60,
+        # The number of jobs read and not handled yet above which the worker stops reading.
+        "concurrency": 32,
+        "block_ms": 5000,
+        # The time the jobs being handled are given to finish when the worker stops, in seconds.
+        "drain_timeout": 30.0,
+        "dead_letter_max_length": 10000,
+    }
+
+    # A Redis client shared by the ingress and worker processes.
+    redis: Optional[Redis] = None
+
+    # The name of the worker in the consumer group and the set of live workers.
+    consumer = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+    # The handler of the job payloads, set when the worker starts.
+    handler: Optional[Callable[[str], Awaitable[None]]] = None
+
+    # Maps the indexes of the shards leased by the worker to their state.
+    shards: Dict[int, "JobQueue.Shard"] = {}
+    release_tasks = set()
+
+    # The number of jobs read and not handled yet, and the condition notified when it decreases.
+    in_flight = 0
+    capacity: Optional[asyncio.Condition] = None
+
+    task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def initialize(cls, redis: Redis):
+        """
+        Initializes the JobQueue with a Redis client and the settings.
+
+        Parameters:
+        - redis (Redis): The Redis client.
+
+        Returns:
+        - None
+        """
+
+        cls.redis = redis
+        cls.config.update(
+            shards=settings.JOB_QUEUE_SHARDS,
+            max_backlog=settings.JOB_QUEUE_MAX_BACKLOG,
+            max_attempts=settings.JOB_MAX_ATTEMPTS,
+            lease_timeout=settings.JOB_LEASE_TIMEOUT,
+            concurrency=settings.WORKER_CONCURRENCY,
+        )
+
+    @classmethod
+    def stream_key(cls, shard: int) -> str:
+        return f"{cls.config['key_prefix']}:{shard}"
+
+    @classmethod
+    def shard_of(cls, user_key: str) -> int:
+        """
+        Returns the shard of the jobs of a user, the same in all processes.
+
+        Parameters:
+        - user_key (str): The key of the user.
+
+        Returns:
+        - int: The index of the shard.
+        """
+
+        return zlib.crc32(user_key.encode("utf-8")) % cls.config["shards"]
+
+    @classmethod
+    async def enqueue(cls, user_key: str, payload: str):
+        """
+        Adds a job to the shard of the user, waiting while the backlog of the shard is full.
+
+        Parameters:
+        - user_key (str): The key of the user, which determines the order of the jobs.
+        - payload (str): The payload of the job.
+
+        Returns:
+        - None
+
+        Raises:
+        - ValueError: If the redis client is not initialized before calling this method.
+        """
+
+        if cls.redis is None:
+            raise ValueError("redis must be initialized before calling enqueue.")
+
+        stream = cls.stream_key(cls.shard_of(user_key))
+        max_length = math.ceil(cls.config["max_backlog"] / cls.config["shards"])
+        waiting_since = None
+        while await cls.redis.xlen(stream) >= max_length:
+            if waiting_since is None:
+                waiting_since = time.monotonic()
+                logger.warning(f"Backlog of {stream} is full, waiting for the workers")
+            await asyncio.sleep(cls.config["backlog_check_interval"])
+        if waiting_since is not None:
+            logger.info(
+                f"Backlog of {stream} was full for {time.monotonic() - waiting_since:.1f}s"
+            )
+
+        await cls.redis.xadd(
+            stream,
+            {"user": user_key, "payload": payload, "enqueued_at": str(time.time())},
+        )
+        JOBS.labels("enqueued").inc()
+
+    @classmethod
+    def start(cls, handler: Callable[[str], Awaitable[None]]):
+        """
+        Starts leasing shards and handling their jobs in the background.
+
+        Parameters:
+        - handler (Callable[[str], Awaitable[None]]): The handler of the job payloads. A job is retried if it raises.
+
+        Returns:
+        - None
+
+        Raises:
+        - ValueError: If the redis client is not initialized before calling this method.
+        """
+
+        if cls.redis is None:
+            raise ValueError("redis must be initialized before calling start.")
+
+        cls.handler = handler
+        cls.capacity = asyncio.Condition()
+        cls.task = asyncio.create_task(cls.balance_forever())
+
+    @classmethod
+    async def shutdown(cls):
+        """
+        Stops reading jobs, waits for the jobs being handled and releases the shards.
+        The jobs that are not handled by then are handled by other workers.
+
+        Returns:
+        - None
+        """
+
+        if cls.task is None:
+            return
+
+        cls.task.cancel()
+        try:
+            await cls.task
+        except asyncio.CancelledError:
+            pass
+        cls.task = None
+
+        await asyncio.gather(
+            *(cls.release_shard(index) for index in list(cls.shards)),
+            *cls.release_tasks,
+        )
+        await cls.redis.zrem(f"{cls.config['key_prefix']}:workers", cls.consumer)
+
+    @classmethod
+    async def balance_forever(cls):
+        """
+        Keeps the leases of the shards of the worker, and leases or releases shards so that the shards
+        are spread evenly between the live workers, until the task is cancelled.
+
+        Returns:
+        - None
+        """
+
+        workers_key = f"{cls.config['key_prefix']}:workers"
+        interval = cls.config["lease_timeout"] / 3
+
+        while True:
+            try:
+                now = time.time()
+                await cls.redis.zadd(workers_key, {cls.consumer: now})
+                await cls.redis.zremrangebyscore(
+                    workers_key, "-inf", now - cls.config["lease_timeout"]
+                )
+                fair_share = math.ceil(
+                    cls.config["shards"] / max(1, await cls.redis.zcard(workers_key))
+                )
+
+                for index, shard in list(cls.shards.items()):
+                    try:
+                        await shard.lease.reacquire()
+                    except LockError:
+                        logger.warning(f"Lease of job shard {index} was lost")
+                        cls.schedule_release(index, owned=False)
+
+                free_shards = [
+                    index
+                    for index in range(cls.config["shards"])
+                    if index not in cls.shards
+                ]
+                random.shuffle(free_shards)
+                for index in free_shards:
+                    if len(cls.shards) >= fair_share:
+                        break
+                    await cls.lease_shard(index)
+
+                for index in list(cls.shards)[fair_share:]:
+                    cls.schedule_release(index)
+
+                JOB_SHARDS_LEASED.set(len(cls.shards))
+            except Exception as e:
+                logger.error(f"Error in JobQueue while balancing the shards: {e}")
+
+            await asyncio.sleep(interval)
+
+    @classmethod
+    async def lease_shard(cls, index: int):
+        """
+        Leases a shard if it is free and starts reading its jobs.
+
+        Parameters:
+        - index (int): The index of the shard.
+
+        Returns:
+        - None
+        """
+
+        lease = cls.redis.lock(
+            f"{cls.config['key_prefix']}:lease:{index}",
+            timeout=cls.config["lease_timeout"],
+        )
+        if not await lease.acquire(blocking=False):
+            return
+
+        try:
+            await cls.redis.xgroup_create(
+                cls.stream_key(index), cls.config["group"], id="0", mkstream=True
+            )
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                await lease.release()
+                raise
+
+        shard = cls.shards[index] = cls.Shard(index, lease)
+        shard.reader = asyncio.create_task(cls.read_shard(shard))
+        logger.info(f"Leased job shard {index}")
+
+    @classmethod
+    def schedule_release(cls, index: int, owned: bool = True):
+        task = asyncio.create_task(cls.release_shard(index, owned))
+        cls.release_tasks.add(task)
+        task.add_done_callback(cls.release_tasks.discard)
+
+    @classmethod
+    async def release_shard(cls, index: int, owned: bool = True):
+        """
+        Stops reading the jobs of a shard, waits for the jobs being handled and releases its lease.
+
+        Parameters:
+        - index (int): The index of the shard.
+        - owned (bool): Whether the lease is still held by the worker.
+
+        Returns:
+        - None
+        """
+
+        shard = cls.shards.pop(index, None)
+        if shard is None:
+            return
+
+        # The jobs read and not handled are acknowledged by nobody, so they are claimed by the next owner.
+        shard.reader.cancel()
+        user_tasks = list(shard.user_tasks.values())
+        if user_tasks:
+            _, pending = await asyncio.wait(
+                user_tasks, timeout=cls.config["drain_timeout"]
+            )
+            for task in pending:
+                task.cancel()
+
+        if owned:
+            try:
+                await shard.lease.release()
+            except LockError:
+                pass
+        JOB_SHARDS_LEASED.set(len(cls.shards))
+        logger.info(f"Released job shard {index}")
+
+    @classmethod
+    async def read_shard(cls, shard: "JobQueue.Shard"):
+        """
+        Reads the jobs of a leased shard and dispatches them, until the task is cancelled.
+
+        The jobs read by the previous owner of the shard and not acknowledged are taken over first.
+
+        Parameters:
+        - shard (Shard): The shard.
+
+        Returns:
+        - None
+        """
+
+        stream = cls.stream_key(shard.index)
+        group = cls.config["group"]
+
+        try:
+            jobs = await cls.claim_pending(stream)
+            await cls.add_in_flight(len(jobs))
+            for job in jobs:
+                cls.dispatch(shard, job)
+
+            while True:
+                count = await cls.wait_for_capacity()
+                response = await cls.redis.xreadgroup(
+                    group,
+                    cls.consumer,
+                    {stream: ">"},
+                    count=count,
+                    block=cls.config["block_ms"],
+                )
+
+                entries = response[0][1] if response else []
+                await cls.add_in_flight(len(entries))
+                for entry_id, fields in entries:
+                    cls.dispatch(shard, cls.Job(entry_id, fields))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error in JobQueue while reading {stream}: {e}")
+            cls.schedule_release(shard.index)
+
+    @classmethod
+    async def claim_pending(cls, stream: str) -> List["JobQueue.Job"]:
+        """
+        Takes over the jobs of the stream read by other workers and not acknowledged.
+
+        Parameters:
+        - stream (str): The key of the stream.
+
+        Returns:
+        - List[Job]: The jobs, in order.
+        """
+
+        group = cls.config["group"]
+        jobs = []
+        start_id = "0-0"
+        while True:
+            start_id, entries, *_ = await cls.redis.xautoclaim(
+                stream, group, cls.consumer, min_idle_time=0, start_id=start_id
+            )
+            # The entries deleted in the meantime have no fields.
+            jobs += [
+                cls.Job(entry_id, fields) for entry_id, fields in entries if fields
+            ]
+            if start_id in (b"0-0", "0-0"):
+                break
+
+        for job in jobs:
+            pending = await cls.redis.xpending_range(
+                stream, group, min=job.entry_id, max=job.entry_id, count=1
+            )
+            # The claim counts as a delivery too.
+            job.deliveries = pending[0]["times_delivered"] - 1 if pending else 0
+        if jobs:
+            logger.info(f"Took over {len(jobs)} unacknowledged jobs of {stream}")
+        return jobs
+
+    @classmethod
+    async def wait_for_capacity(cls) -> int:
+        """
+        Waits until the worker can take more jobs.
+
+        The room is not reserved, so that a shard waiting for new jobs does not hold it. As a result,
+        the shards read at the same time may take up to twice as many jobs as the concurrency.
+
+        Returns:
+        - int: The number of jobs a shard may read: its share of the free room.
+        """
+
+        concurrency = cls.config["concurrency"]
+        async with cls.capacity:
+            await cls.capacity.wait_for(lambda: cls.in_flight < concurrency)
+            share = math.ceil(concurrency / max(1, len(cls.shards)))
+            return min(share, concurrency - cls.in_flight)
+
+    @classmethod
+    async def add_in_flight(cls, count: int):
+        if count == 0:
+            return
+        async with cls.capacity:
+            cls.in_flight += count
+            JOBS_IN_FLIGHT.set(cls.in_flight)
+            if count < 0:
+                cls.capacity.notify_all()
+
+    @classmethod
+    def dispatch(cls, shard: "JobQueue.Shard", job: "JobQueue.Job"):
+        """
+        Queues a job after the other jobs of its user, starting to handle them if they are not handled yet.
+
+        Parameters:
+        - shard (Shard): The shard of the job.
+        - job (Job): The job.
+
+        Returns:
+        - None
+        """
+
+        shard.queues.setdefault(job.user_key, deque()).append(job)
+        if job.user_key not in shard.user_tasks:
+            shard.user_tasks[job.user_key] = asyncio.create_task(
+                cls.handle_user_jobs(shard, job.user_key)
+            )
+
+    @classmethod
+    async def handle_user_jobs(cls, shard: "JobQueue.Shard", user_key: str):
+        """
+        Handles the queued jobs of a user one after another.
+
+        Parameters:
+        - shard (Shard): The shard of the jobs.
+        - user_key (str): The key of the user.
+
+        Returns:
+        - None
+        """
+
+        queue = shard.queues[user_key]
+        try:
+            while queue:
+                job = queue.popleft()
+                try:
+                    await cls.handle_job(shard, job)
+                finally:
+                    await cls.add_in_flight(-1)
+        finally:
+            del shard.user_tasks[user_key]
+            del shard.queues[user_key]
+            # The jobs left after a cancellation are handled by the next owner of the shard.
+            await cls.add_in_flight(-len(queue))
+
+    @classmethod
+    async def handle_job(cls, shard: "JobQueue.Shard", job: "JobQueue.Job"):
+        """
+        Handles a job, retrying it on failure, and acknowledges it. A job that fails every attempt,
+        fails with a PermanentJobError, or keeps crashing workers, is moved to the dead-letter stream.
+
+        Parameters:
+        - shard (Shard): The shard of the job.
+        - job (Job): The job.
+
+        Returns:
+        - None
+        """
+
+        JOB_QUEUE_WAIT.observe(max(0.0, time.time() - job.enqueued_at))
+
+        error = None
+        attempts = cls.config["max_attempts"] - job.deliveries
+        for attempt in range(attempts):
+            if attempt:
+                JOBS.labels("retried").inc()
+                await asyncio.sleep(cls.config["retry_delay"] * 2 ** (attempt - 1))
+            try:
+                await cls.handler(job.payload)
+                error = None
+                break
+            except Exception as e:
+                error = e
+                logger.error(
+                    f"Error in JobQueue while handling job {job.entry_id.decode()} "
+                    f"of user {job.user_key} (attempt {attempt + 1}): {e}"
+                )
+                if isinstance(e, PermanentJobError):
+                    break
+
+        if attempts <= 0 or error is not None:
+            await cls.dead_letter(shard, job, error)
+        else:
+            JOBS.labels("done").inc()
+
+        stream = cls.stream_key(shard.index)
+        async with cls.redis.pipeline(transaction=False) as pipeline:
+            pipeline.xack(stream, cls.config["group"], job.entry_id)
+            pipeline.xdel(stream, job.entry_id)
+            await pipeline.execute()
+
+    @classmethod
+    async def dead_letter(
+        cls, shard: "JobQueue.Shard", job: "JobQueue.Job", error: Exception = None
+    ):
+        """
+        Moves a job to the dead-letter stream, where it can be inspected and re-enqueued manually.
+
+        Parameters:
+        - shard (Shard): The shard of the job.
+        - job (Job): The job.
+        - error (Exception): The last error of the job, or None if it crashed the workers handling it.
+
+        Returns:
+        - None
+        """
+
+        reason = str(error) if error is not None else "crashed the workers"
+        logger.error(
+            f"Job {job.entry_id.decode()} of user {job.user_key} is dead: {reason}"
+        )
+        await cls.redis.xadd(
+            f"{cls.config['key_prefix']}:dead",
+            {
+                "user": job.user_key,
+                "payload": job.payload,
+                "enqueued_at": str(job.enqueued_at),
+                "shard": str(shard.index),
+                "error": reason,
+            },
+            maxlen=cls.config["dead_letter_max_length"],
+            approximate=True,
+        )
+        JOBS.labels("dead_lettered").inc()
+
+    @classmethod
+    async def get_backlog(cls) -> Tuple[int, int]:
+        """
+        Returns the number of jobs in all shards and in the dead-letter stream.
+
+        Returns:
+        - Tuple[int, int]: The number of jobs waiting or being handled, and the number of dead jobs.
+        """
+
+        async with cls.redis.pipeline(transaction=False) as pipeline:
+            for shard in range(cls.config["shards"]):
+                pipeline.xlen(cls.stream_key(shard))
+            pipeline.xlen(f"{cls.config['key_prefix']}:dead")
+            *lengths, dead = await pipeline.execute()
+        return sum(lengths), dead
+
+    @classmethod
+    def get_metrics(cls) -> dict:
+        """
+        Returns the statistics of the worker.
+
+        Returns:
+        - dict: The leased shards and the number of jobs read and not handled yet.
+        """
+
+        return {"shards": sorted(cls.shards), "in_flight": cls.in_flight}
@@ -0,0 +1,196 @@
+import asyncio
+import os
+from typing import Awaitable, Callable, List, Optional
+
+from loguru import logger
+
+from config import settings
+from retrieval import SUPPORTED_EXTENSIONS
+
+
+class KnowledgeService:
+    """
+    A class for keeping the knowledge files of the assistant in sync with a directory.
+
+    Each subdirectory of the directory is a vector storage named after it, holding its knowledge files
+    and optionally the instructions of the storage in an '.instructions' file. The directory is scanned
+    periodically, and the changes are applied without a restart, so adding a document needs no redeploy.
+    """
+
+    # A dictionary containing configuration options for the service.
+    config = {
+        "directory": "knowledge",
+        # The number of seconds between the scans of the directory, or 0 to scan it on startup only.
+        "poll_interval": 30.0,
+        "instructions_file": ".instructions",
+        "default_instructions": "If the user asks a question on the topic of {name}, try to look for the answer in the files.",
+    }
+
+    # The paths, sizes and modification times of the files as of the latest applied scan.
+    fingerprint = None
+
+    task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def initialize(cls):
+        """
+        Initializes the KnowledgeService with the settings.
+
+        Returns:
+        - None
+        """
+
+        cls.config.update(
+            directory=settings.KNOWLEDGE_DIR,
+            poll_interval=settings.KNOWLEDGE_POLL_INTERVAL,
+        )
+
+    @classmethod
+    def scan(cls) -> List[dict]:
+        """
+        Lists the vector storages of the knowledge directory and their files.
+
+        Subdirectories without supported files, hidden entries and the files at the top level are ignored.
+
+        Returns:
+        - List[dict]: The 'name', 'file_paths' and 'instructions' of the vector storages, sorted by name.
+        """
+
+        directory = cls.config["directory"]
+        if not os.path.isdir(directory):
+            logger.warning(f"Knowledge directory {directory} does not exist")
+            return []
+
+        sources = []
+        for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+            if not entry.is_dir() or entry.name.startswith("."):
+                continue
+
+            file_paths = sorted(
+                os.path.join(entry.path, file_name)
+                for file_name in os.listdir(entry.path)
+                if not file_name.startswith(".")
+                and os.path.splitext(file_name)[1].lower() in SUPPORTED_EXTENSIONS
+            )
+            if not file_paths:
+                continue
+
+            instructions_path = os.path.join(
+                entry.path, cls.config["instructions_file"]
+            )
+            if os.path.isfile(instructions_path):
+                with open(instructions_path, encoding="utf-8") as file:
+                    instructions = file.read().strip()
+            else:
+                instructions = cls.config["default_instructions"].format(
+                    name=entry.name
+                )
+
+            sources.append(
+                {
+                    "name": entry.name,
+                    "file_paths": file_paths,
+                    "instructions": instructions,
+                }
+            )
+        return sources
+
+    @staticmethod
+    def get_fingerprint(sources: List[dict]) -> tuple:
+        """
+        Returns a value that changes whenever the files of the vector storages or their instructions change.
+
+        Parameters:
+        - sources (List[dict]): The vector storages, as returned by scan.
+
+        Returns:
+        - tuple: The names and the instructions of the vector storages and the paths, sizes and modification times of their files.
+        """
+
+        fingerprint = []
+        for source in sources:
+            files = []
+            for path in source["file_paths"]:
+                try:
+                    stat = os.stat(path)
+                    files.append((path, stat.st_size, stat.st_mtime_ns))
+                except FileNotFoundError:
+                    pass
+            fingerprint.append((source["name"], source["instructions"], tuple(files)))
+        return tuple(fingerprint)
+
+    @classmethod
+    def load(cls) -> List[dict]:
+        """
+        Scans the knowledge directory on startup, so that the watcher only applies the later changes.
+
+        Returns:
+        - List[dict]: The vector storages, as returned by scan.
+        """
+
+        sources = cls.scan()
+        cls.fingerprint = cls.get_fingerprint(sources)
+        logger.info(
+            f"Found {sum(len(source['file_paths']) for source in sources)} knowledge files "
+            f"in {len(sources)} vector storages"
+        )
+        return sources
+
+    @classmethod
+    def start(cls, apply: Callable[[List[dict]], Awaitable[None]]):
+        """
+        Starts watching the knowledge directory, unless the polling is disabled.
+
+        Parameters:
+        - apply (Callable[[List[dict]], Awaitable[None]]): Synchronizes the vector storages with the scanned ones.
+
+        Returns:
+        - None
+        """
+
+        if cls.config["poll_interval"] > 0 and cls.task is None:
+            cls.task = asyncio.create_task(cls.watch_forever(apply))
+
+    @classmethod
+    async def watch_forever(cls, apply: Callable[[List[dict]], Awaitable[None]]):
+        """
+        Applies the changes of the knowledge directory as they are found, until the task is cancelled.
+        A change that fails to be applied is retried on the next scan.
+
+        Parameters:
+        - apply (Callable[[List[dict]], Awaitable[None]]): Synchronizes the vector storages with the scanned ones.
+
+        Returns:
+        - None
+        """
+
+        while True:
+            await asyncio.sleep(cls.config["poll_interval"])
+            try:
+                sources = await asyncio.to_thread(cls.scan)
+                fingerprint = await asyncio.to_thread(cls.get_fingerprint, sources)
+                if fingerprint == cls.fingerprint:
+                    continue
+
+                logger.info("Knowledge files have changed, synchronizing them")
+                await apply(sources)
+                cls.fingerprint = fingerprint
+            except Exception as e:
+                logger.error(f"Error in KnowledgeService while synchronizing: {e}")
+
+    @classmethod
+    async def shutdown(cls):
+        """
+        Stops watching the knowledge directory.
+
+        Returns:
+        - None
+        """
+
+        if cls.task is not None:
+            cls.task.cancel()
+            try:
+                await cls.task
+            except asyncio.CancelledError:
+                pass
+            cls.task = None
@@ -0,0 +1,452 @@
+import asyncio
+import contextvars
+import email.utils
+import heapq
+import itertools
+import json
+import re
+import time
+from contextlib import contextmanager
+from enum import IntEnum
+from typing import Optional, Tuple
+
+import httpx
+from loguru import logger
+from openai import DEFAULT_CONNECTION_LIMITS, DefaultAsyncHttpxClient
+
+from monitoring import OPENAI_QUEUE_WAIT, OPENAI_RETRIES
+
+
+class Priority(IntEnum):
+    """
+    Priority represents the order in which requests waiting for the rate limit budget are sent.
+    Lower values are sent first.
+    """
+
+    CHAT = 0
+    VALIDATION = 1
+    BACKGROUND = 2
+
+
+class OpenAIScheduler:
+    """
+    A class for scheduling all requests made to the OpenAI API by the services.
+
+    It is plugged into the HTTP transport of the shared AsyncOpenAI client. Every request is attributed to a service,
+    a model and a priority. Requests of each service are bounded in concurrency, requests consuming a model are
+    sent within per-model requests/tokens per minute budgets in the order of their priorities, and rate-limited
+    or failed requests are retried after the delay given by the 'retry-after' headers.
+    """
+
+    class ModelBudget:
+        """
+        A class for tracking the requests/tokens per minute budget of one model as two token buckets.
+        """
+
+        def __init__(self, requests_per_minute: int, tokens_per_minute: Optional[int]):
+            """
+            Initializes full buckets.
+
+            Parameters:
+            - requests_per_minute (int): The maximum number of requests per minute.
+            - tokens_per_minute (Optional[int]): The maximum number of tokens per minute, or None if not limited.
+            """
+
+            self.requests_per_minute = requests_per_minute
+            self.tokens_per_minute = tokens_per_minute
+            self.requests = float(requests_per_minute)
+            self.tokens = float(tokens_per_minute or 0)
+            self.updated_at = time.monotonic()
+            self.blocked_until = 0.0
+            # A heap of waiting requests: (priority, sequence number, tokens, future).
+            self.waiters = []
+            self.timer = None
+
+        def take(self, tokens: int) -> float:
+            """
+            Takes a request and the tokens from the buckets if they are available.
+
+            Parameters:
+            - tokens (int): The estimated number of tokens of the request.
+
+            Returns:
+            - float: 0 if the budget was taken, otherwise the number of seconds until it may be available.
+            """
+
+            now = time.monotonic()
+            elapsed = now - self.updated_at
+            self.updated_at = now
+            self.requests = min(
+                self.requests_per_minute,
+                self.requests + elapsed * self.requests_per_minute / 60,
+            )
+            if self.tokens_per_minute:
+                tokens = min(tokens, self.tokens_per_minute)
+                self.tokens = min(
+                    self.tokens_per_minute,
+                    self.tokens + elapsed * self.tokens_per_minute / 60,
+                )
+
+            if now < self.blocked_until:
+                return self.blocked_until - now
+
+            wait = 0.0
+            if self.requests < 1:
+                wait = (1 - self.requests) * 60 / self.requests_per_minute
+            if self.tokens_per_minute and self.tokens < tokens:
+                wait = max(wait, (tokens - self.tokens) * 60 / self.tokens_per_minute)
+            if wait > 0:
+                return wait
+
+            self.requests -= 1
+            if self.tokens_per_minute:
+                self.tokens -= tokens
+            return 0.0
+
+    # A dictionary containing configuration options for the scheduler.
+    config = {
+        # Rate limit budgets of the models.
+        "models": {
+            "gpt-4-turbo": {"requests_per_minute": 500, "tokens_per_minute": 300000},
+            "whisper-1": {"requests_per_minute": 50, "tokens_per_minute": None},
+            "tts-1": {"requests_per_minute": 50, "tokens_per_minute": None},
+        },
+        # The maximum number of requests in flight per service.
+        "concurrency": {
+            "assistant": 32,
+            "chat": 16,
+            "emotion": 8,
+            "validate": 4,
+            "stt": 8,
+            "tts": 8,
+        },
+        # The default priorities of the services.
+        "priorities": {
+            "validate": Priority.VALIDATION,
+        },
+        # The models consumed by requests that do not name a model, e.g. assistant runs.
+        "service_models": {
+            "assistant": "gpt-4-turbo",
+            "stt": "whisper-1",
+        },
+        # The estimated number of tokens of a request whose size cannot be derived from its body.
+        "default_tokens": 2000,
+        "max_retries": 4,
+        # The statuses retried besides the server errors, the same as the ones the OpenAI client retries itself.
+        "retry_statuses": (408, 409, 429),
+        # The delay before the first retry of a failed request without a 'retry-after' header, doubled every attempt.
+        "retry_delay": 1.0,
+    }
+
+    # The service and the priority of the requests made in the current context.
+    context_var = contextvars.ContextVar("openai_scheduler_context", default=None)
+
+    # Matches the paths of requests that start or continue assistant runs.
+    run_path_pattern = re.compile(r"/threads/[^/]+/runs(/[^/]+/submit_tool_outputs)?$")
+
+    budgets = {}
+    semaphores = {}
+    sequence = itertools.count()
+
+    # Statistics of the time requests spent waiting for the budget and of the retries, per service.
+    metrics = {}
+
+    class Transport(httpx.AsyncBaseTransport):
+        """
+        An HTTP transport that sends every request through the OpenAIScheduler.
+        """
+
+        def __init__(self, transport: httpx.AsyncBaseTransport):
+            """
+            Initializes the transport.
+
+            Parameters:
+            - transport (httpx.AsyncBaseTransport): The transport actually sending the requests.
+            """
+
+            self.transport = transport
+
+        async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+            return await OpenAIScheduler.send(request, self.transport)
+
+        async def aclose(self):
+            await self.transport.aclose()
+
+    @classmethod
+    def create_http_client(cls) -> httpx.AsyncClient:
+        """
+        Creates an HTTP client for AsyncOpenAI that sends the requests through the scheduler.
+        The client should be used with max_retries=0, as retries are made by the scheduler.
+
+        Returns:
+        - httpx.AsyncClient: The HTTP client.
+        """
+
+        return DefaultAsyncHttpxClient(
+            transport=cls.Transport(
+                httpx.AsyncHTTPTransport(limits=DEFAULT_CONNECTION_LIMITS)
+            )
+        )
+
+    @classmethod
+    @contextmanager
+    def context(cls, service: str, priority: Priority = None):
+        """
+        Attributes the requests made in the context to the service, with the given priority.
+
+        Parameters:
+        - service (str): The name of the service.
+        - priority (Priority): The priority of the requests. Defaults to the priority of the service.
+
+        Returns:
+        - None
+        """
+
+        if priority is None:
+            priority = cls.config["priorities"].get(service, Priority.CHAT)
+        token = cls.context_var.set((service, priority))
+        try:
+            yield
+        finally:
+            cls.context_var.reset(token)
+
+    @classmethod
+    async def send(
+        cls, request: httpx.Request, transport: httpx.AsyncBaseTransport
+    ) -> httpx.Response:
+        """
+        Sends the request within the budget of its service and model, retrying it if it is rate-limited or fails.
+
+        Parameters:
+        - request (httpx.Request): The request.
+        - transport (httpx.AsyncBaseTransport): The transport sending the request.
+
+        Returns:
+        - httpx.Response: The response.
+        """
+
+        service, model, priority, tokens = cls.classify(request)
+        metrics = cls.metrics.setdefault(
+            service, {"requests": 0, "wait_total": 0.0, "wait_max": 0.0, "retries": 0}
+        )
+        semaphore = cls.semaphores.get(service)
+        if semaphore is None:
+            semaphore = cls.semaphores[service] = asyncio.Semaphore(
+                cls.config["concurrency"].get(service, 8)
+            )
+
+        # The body is read beforehand, so that it can be sent again by a retry.
+        await request.aread()
+
+        for attempt in itertools.count():
+            started_at = time.monotonic()
+            # The budget is reserved before a slot is taken, so that requests waiting for the budget of a model
+            # do not hold the slots of the service, e.g. starving its polling requests that consume no model.
+            if model is not None:
+                await cls.reserve(model, priority, tokens)
+
+            async with semaphore:
+                wait = time.monotonic() - started_at
+                metrics["requests"] += 1
+                metrics["wait_total"] += wait
+                metrics["wait_max"] = max(metrics["wait_max"], wait)
+                OPENAI_QUEUE_WAIT.labels(service).observe(wait)
+                if wait > 1:
+                    logger.info(
+                        f"OpenAI request of {service} waited {wait:.2f}s for the rate limit budget"
+                    )
+
+                try:
+                    response = await transport.handle_async_request(request)
+                    error = None
+                except httpx.TransportError as e:
+                    # Connection errors and timeouts are not retried by the client either, as it has max_retries=0.
+                    response, error = None, e
+
+            if error is not None:
+                if attempt >= cls.config["max_retries"]:
+                    raise error
+                status = type(error).__name__
+                delay = None
+            else:
+                status = response.status_code
+                if status not in cls.config["retry_statuses"] and status < 500:
+                    return response
+                if attempt >= cls.config["max_retries"]:
+                    return response
+                delay = cls.retry_after(response)
+                await response.aclose()
+
+            if delay is None:
+                delay = cls.config["retry_delay"] * 2**attempt
+
+            metrics["retries"] += 1
+            OPENAI_RETRIES.labels(service, str(status)).inc()
+            logger.info(
+                f"OpenAI request of {service} failed with {status}, retrying in {delay:.2f}s"
+            )
+
+            if status == 429 and model in cls.budgets:
+                # Every request of the model waits, instead of each of them hitting the limit again.
+                budget = cls.budgets[model]
+                budget.blocked_until = max(
+                    budget.blocked_until, time.monotonic() + delay
+                )
+            else:
+                await asyncio.sleep(delay)
+
+    @classmethod
+    def classify(
+        cls, request: httpx.Request
+    ) -> Tuple[str, Optional[str], Priority, int]:
+        """
+        Attributes the request to a service and a model, and estimates its tokens.
+
+        Only requests that consume a model (completions, speech, transcriptions and assistant runs) are attributed
+        to a model; other requests, such as polling, only count towards the concurrency of their service.
+
+        Parameters:
+        - request (httpx.Request): The request.
+
+        Returns:
+        - Tuple[str, Optional[str], Priority, int]: The service, the model, the priority and the estimated tokens.
+        """
+
+        path = request.url.path
+        if path.endswith("/audio/transcriptions"):
+            service = "stt"
+        elif path.endswith("/audio/speech"):
+            service = "tts"
+        elif path.endswith("/chat/completions"):
+            service = "chat"
+        else:
+            service = "assistant"
+
+        priority = cls.config["priorities"].get(service, Priority.CHAT)
+        if context := cls.context_var.get():
+            service, priority = context
+
+        model = None
+        tokens = 0
+        if request.method == "POST" and (
+            service in ("stt", "tts", "chat")
+            or path.endswith("/chat/completions")
+            or cls.run_path_pattern.search(path)
+        ):
+            body = {}
+            if request.headers.get("content-type", "").startswith("application/json"):
+                try:
+                    body = json.loads(request.content)
+                except ValueError:
+                    pass
+
+            model = body.get("model") or cls.config["service_models"].get(service)
+            if "messages" in body:
+                # Roughly 4 characters per token, plus the completion.
+                tokens = len(request.content) // 4 + (body.get("max_tokens") or 1000)
+            elif "input" not in body:
+                tokens = cls.config["default_tokens"]
+
+        return service, model, priority, tokens
+
+    @classmethod
+    async def reserve(cls, model: str, priority: Priority, tokens: int):
+        """
+        Waits until the budget of the model allows sending a request, serving waiting requests by priority.
+
+        Parameters:
+        - model (str): The model.
+        - priority (Priority): The priority of the request.
+        - tokens (int): The estimated number of tokens of the request.
+
+        Returns:
+        - None
+        """
+
+        budget = cls.budgets.get(model)
+        if budget is None:
+            if model not in cls.config["models"]:
+                return
+            budget = cls.budgets[model] = cls.ModelBudget(**cls.config["models"][model])
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(budget.waiters, (priority, next(cls.sequence), tokens, future))
+        cls.dispatch(budget)
+        try:
+            await future
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+    @classmethod
+    def dispatch(cls, budget: "OpenAIScheduler.ModelBudget"):
+        """
+        Lets the waiting requests through while the budget allows, and schedules the next attempt otherwise.
+
+        Parameters:
+        - budget (ModelBudget): The budget of the model.
+
+        Returns:
+        - None
+        """
+
+        if budget.timer is not None:
+            budget.timer.cancel()
+            budget.timer = None
+
+        while budget.waiters:
+            _, _, tokens, future = budget.waiters[0]
+            if future.done():
+                heapq.heappop(budget.waiters)
+                continue
+
+            wait = budget.take(tokens)
+            if wait > 0:
+                budget.timer = asyncio.get_running_loop().call_later(
+                    wait, cls.dispatch, budget
+                )
+                return
+
+            heapq.heappop(budget.waiters)
+            future.set_result(None)
+
+    @staticmethod
+    def retry_after(response: httpx.Response) -> Optional[float]:
+        """
+        Returns the delay requested by the 'retry-after-ms' or 'retry-after' header of the response.
+
+        Parameters:
+        - response (httpx.Response): The response.
+
+        Returns:
+        - Optional[float]: The number of seconds to wait, or None if the response does not say.
+        """
+
+        try:
+            return float(response.headers["retry-after-ms"]) / 1000
+        except (KeyError, ValueError):
+            pass
+
+        retry_after = response.headers.get("retry-after")
+        if retry_after is None:
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(retry_after)
+            return max(0.0, retry_at.timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    @classmethod
+    def get_metrics(cls) -> dict:
+        """
+        Returns the statistics of the time requests spent waiting for the budget and of the retries, per service.
+
+        Returns:
+        - dict: Maps services to their number of requests, total and maximum wait time and number of retries.
+        """
+
+        return {service: dict(metrics) for service, metrics in cls.metrics.items()}
@@ -0,0 +1,198 @@
+import asyncio
+import re
+import time
+from typing import Dict, List
+
+from loguru import logger
+
+from config import settings
+from monitoring import RETRIEVAL_SEARCH_DURATION, RETRIEVAL_SEARCHES
+from retrieval import Bm25Index, Passage, hash_sources
+from utils import LruCache
+
+
+class RetrievalService:
+    """
+    A class for finding the passages of the knowledge files relevant to a prompt in local indexes,
+    instead of the file_search tool of the Assistants API.
+
+    Each vector storage is a shard with its own index on disk, built on startup if its files have changed.
+    The passages found are given to the model with the prompt, marked so that the model can cite them,
+    and the citations are formatted as the ones of file_search.
+    """
+
+    # A dictionary containing configuration options for the service.
+    config = {
+        "index_path": ".cache/retrieval",
+        # The maximum number of passages given to the model with a prompt.
+        "top_k": 3,
+        # Passages scoring lower are not worth their tokens.
+        "min_score": 1.0,
+        "max_words": 120,
+        "instructions": (
+            "Below are excerpts from the knowledge files that may be relevant to the user's message. "
+            "If you use an excerpt, cite it by its marker, e.g. 【1】, right after the sentence based on it."
+        ),
+    }
+
+    # Maps the names of the vector storages to their indexes.
+    indexes: Dict[str, Bm25Index] = {}
+
+    # Maps the normalized queries to the passages found, as the same questions are asked often.
+    results = LruCache(max_size=1024)
+
+    # Matches the citation markers of the passages, e.g. '【1】'.
+    citation_pattern = re.compile(r"【(\d+)】")
+
+    @classmethod
+    async def initialize(cls, sources: Dict[str, List[str]]):
+        """
+        Loads the indexes of the vector storages, building the ones that are missing or whose files have changed.
+
+        Parameters:
+        - sources (Dict[str, List[str]]): Maps the names of the vector storages to the paths to their files.
+
+        Returns:
+        - None
+        """
+
+        cls.config.update(
+            index_path=settings.RETRIEVAL_INDEX_PATH, top_k=settings.RETRIEVAL_TOP_K
+        )
+
+        indexes = {}
+        for name, file_paths in sources.items():
+            indexes[name] = await asyncio.to_thread(cls.load_index, name, file_paths)
+        cls.indexes = indexes
+        cls.results.clear()
+
+    @classmethod
+    def load_index(cls, name: str, file_paths: List[str]) -> Bm25Index:
+        """
+        Loads the index of a vector storage, or builds and saves it if it is missing or out of date.
+
+        Parameters:
+        - name (str): The name of the vector storage.
+        - file_paths (List[str]): The paths to its files.
+
+        Returns:
+        - Bm25Index: The index.
+        """
+
+        path = Bm25Index.storage_path(cls.config["index_path"], name)
+        source_hashes = hash_sources(file_paths)
+        try:
+            index = Bm25Index.load(path)
+            if index.source_hashes == source_hashes:
+                return index
+        except (OSError, ValueError) as e:
+            logger.info(f"Index of vector storage {name} is not loaded: {e}")
+
+        started_at = time.perf_counter()
+        index = Bm25Index.from_files(file_paths, max_words=cls.config["max_words"])
+        logger.info(
+            f"Indexed {len(index.passages)} passages of vector storage {name} "
+            f"in {time.perf_counter() - started_at:.2f}s"
+        )
+        try:
+            index.save(path)
+            return Bm25Index.load(path)
+        except (OSError, ValueError) as e:
+            # The index built in memory serves this process, and the next start builds it again.
+            logger.error(
+                f"Error in RetrievalService while saving the index of vector storage {name}: {e}"
+            )
+            return index
+
+    @classmethod
+    def search(cls, query: str) -> List[Passage]:
+        """
+        Returns the passages of all vector storages that match a query best.
+
+        Parameters:
+        - query (str): The query, e.g. the prompt of the user.
+
+        Returns:
+        - List[Passage]: The passages, best first, or none if there are no indexes.
+        """
+
+        if not cls.indexes:
+            return []
+
+        key = " ".join(query.lower().split())
+        passages = cls.results.get(key)
+        if passages is not None:
+            RETRIEVAL_SEARCHES.labels("hit").inc()
+            return passages
+        RETRIEVAL_SEARCHES.labels("miss").inc()
+
+        with RETRIEVAL_SEARCH_DURATION.time():
+            # The scores of the shards are comparable enough, as they are normalized by the lengths of the passages.
+            matches = [
+                match
+                for index in cls.indexes.values()
+                for match in index.search(query, cls.config["top_k"])
+                if match[1] >= cls.config["min_score"]
+            ]
+            matches.sort(key=lambda match: match[1], reverse=True)
+            passages = [passage for passage, _ in matches[: cls.config["top_k"]]]
+
+        cls.results.set(key, passages)
+        return passages
+
+    @classmethod
+    def format_instructions(cls, passages: List[Passage]) -> str:
+        """
+        Formats the passages as instructions for the model, marked with their numbers.
+
+        Parameters:
+        - passages (List[Passage]): The passages.
+
+        Returns:
+        - str: The instructions, or an empty string if there are no passages.
+        """
+
+        if not passages:
+            return ""
+        excerpts = "\n\n".join(
+            f"【{number}】 ({passage.source}) {passage.text}"
+            for number, passage in enumerate(passages, start=1)
+        )
+        return f"{cls.config['instructions']}\n\n{excerpts}"
+
+    @classmethod
+    def run_options(cls, passages: List[Passage]) -> dict:
+        """
+        Returns the options of a run that give the passages to the model.
+
+        Parameters:
+        - passages (List[Passage]): The passages.
+
+        Returns:
+        - dict: The additional instructions of the run if there are passages, otherwise nothing.
+        """
+
+        if not passages:
+            return {}
+        return {"additional_instructions": cls.format_instructions(passages)}
+
+    @classmethod
+    def format_citations(cls, text: str, passages: List[Passage]) -> str:
+        """
+        Replaces the citation markers of the passages in a response with their sources.
+
+        Parameters:
+        - text (str): The response.
+        - passages (List[Passage]): The passages given to the model with the prompt.
+
+        Returns:
+        - str: The response with citations in the form ' [Источник: <file name>]'.
+        """
+
+        def replace(match: re.Match) -> str:
+            number = int(match.group(1))
+            if not 1 <= number <= len(passages):
+                return ""
+            return f" [Источник: {passages[number - 1].source}]"
+
+        return cls.citation_pattern.sub(replace, text)
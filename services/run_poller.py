@@ -0,0 +1,302 @@
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Optional
+
+from loguru import logger
+from openai import AsyncOpenAI
+from openai.types.beta.threads import Run
+
+from monitoring import ASSISTANT_RUN_POLLS
+
+
+class RunPoller:
+    """
+    A class for polling the status of all in-flight assistant runs from a single background task.
+
+    Waiters of the same run share its polls. Each run is polled on its own adaptive schedule: rarely while it is
+    younger than the typical completion time of runs, then more often around it, backing off again for runs that
+    take unusually long.
+    """
+
+    class TrackedRun:
+        """
+        A class for holding the polling state of one run.
+        """
+
+        def __init__(self, thread_id: str, run_id: str):
+            """
+            Initializes the state of the run.
+
+            Parameters:
+            - thread_id (str): The thread ID of the run.
+            - run_id (str): The ID of the run.
+            """
+
+            self.thread_id = thread_id
+            self.run_id = run_id
+            self.started_at = time.monotonic()
+            self.waiters = []
+            # The number of polls made since the run exceeded the typical completion time.
+            self.late_polls = 0
+            self.errors = 0
+
+    # A dictionary containing configuration options for the poller.
+    config = {
+        "min_interval": 0.5,
+        "max_interval": 5.0,
+        # The initial estimate of the time it takes a run to stop being queued or in progress.
+        "typical_duration": 4.0,
+        # The weight of the latest observed duration in the estimate of the typical one.
+        "duration_weight": 0.2,
+        # The maximum number of runs retrieved at once.
+        "concurrency": 16,
+        # The number of consecutive failed polls after which the waiters of a run receive the error.
+        "max_errors": 5,
+    }
+
+    # Run statuses in which the run needs to be polled further.
+    pending_statuses = ("queued", "in_progress", "cancelling")
+
+    # An OpenAI client for retrieving runs.
+    async_client = None
+
+    # Maps (thread ID, run ID) to the tracked runs.
+    runs = {}
+
+    # A heap of the scheduled polls: (time of the poll, sequence number, tracked run).
+    schedule = []
+    sequence = itertools.count()
+
+    typical_duration = config["typical_duration"]
+    polls = 0
+
+    task: Optional[asyncio.Task] = None
+    poll_tasks = set()
+    wakeup: Optional[asyncio.Event] = None
+
+    @classmethod
+    def initialize(cls, async_client: AsyncOpenAI):
+        """
+        Initializes the RunPoller with an instance of AsyncOpenAI.
+
+        Parameters:
+        - async_client (AsyncOpenAI): An instance of AsyncOpenAI to use for retrieving runs.
+
+        Returns:
+        - None
+        """
+
+        cls.async_client = async_client
+
+    @classmethod
+    async def wait(cls, thread_id: str, run_id: str) -> Run:
+        """
+        Waits until the run is no longer queued or in progress.
+
+        Parameters:
+        - thread_id (str): The thread ID of the run.
+        - run_id (str): The ID of the run.
+
+        Returns:
+        - Run: The run in its latest status, e.g. 'completed' or 'requires_action'.
+
+        Raises:
+        - ValueError: If the async_client is not initialized before calling this method.
+        """
+
+        if cls.async_client is None:
+            raise ValueError("async_client must be initialized before calling wait.")
+
+        if cls.task is None or cls.task.done():
+            cls.wakeup = asyncio.Event()
+            cls.task = asyncio.create_task(cls.poll_forever())
+
+        tracked_run = cls.runs.get((thread_id, run_id))
+        if tracked_run is None:
+            tracked_run = cls.runs[(thread_id, run_id)] = cls.TrackedRun(
+                thread_id, run_id
+            )
+            cls.reschedule(tracked_run)
+
+        future = asyncio.get_running_loop().create_future()
+        tracked_run.waiters.append(future)
+        try:
+            return await future
+        finally:
+            if future in tracked_run.waiters:
+                tracked_run.waiters.remove(future)
+            if not tracked_run.waiters:
+                cls.runs.pop((thread_id, run_id), None)
+
+    @classmethod
+    def reschedule(cls, tracked_run: "RunPoller.TrackedRun"):
+        """
+        Schedules the next poll of the run according to its age.
+
+        Parameters:
+        - tracked_run (TrackedRun): The run.
+
+        Returns:
+        - None
+        """
+
+        now = time.monotonic()
+        remaining = cls.typical_duration - (now - tracked_run.started_at)
+        if tracked_run.errors:
+            interval = cls.config["max_interval"]
+        elif remaining > cls.config["min_interval"]:
+            # The run is not likely to finish before the typical duration, so it is polled about then.
+            interval = remaining * 0.8
+        else:
+            interval = cls.config["min_interval"] * 2**tracked_run.late_polls
+            tracked_run.late_polls += 1
+        interval = min(
+            max(interval, cls.config["min_interval"]), cls.config["max_interval"]
+        )
+
+        heapq.heappush(cls.schedule, (now + interval, next(cls.sequence), tracked_run))
+        cls.wakeup.set()
+
+    @classmethod
+    async def poll_forever(cls):
+        """
+        Polls the runs as they become due, until the task is cancelled.
+
+        Returns:
+        - None
+        """
+
+        semaphore = asyncio.Semaphore(cls.config["concurrency"])
+
+        async def poll(tracked_run: "RunPoller.TrackedRun"):
+            async with semaphore:
+                await cls.poll(tracked_run)
+
+        while True:
+            cls.wakeup.clear()
+            now = time.monotonic()
+
+            due = []
+            while cls.schedule and cls.schedule[0][0] <= now:
+                _, _, tracked_run = heapq.heappop(cls.schedule)
+                # Runs without waiters are dropped.
+                if (
+                    cls.runs.get((tracked_run.thread_id, tracked_run.run_id))
+                    is tracked_run
+                ):
+                    due.append(tracked_run)
+
+            # Polls run in their own tasks, so that a slow response does not delay the polls of other runs.
+            for tracked_run in due:
+                task = asyncio.create_task(poll(tracked_run))
+                cls.poll_tasks.add(task)
+                task.add_done_callback(cls.poll_tasks.discard)
+
+            timeout = cls.schedule[0][0] - now if cls.schedule else None
+            try:
+                await asyncio.wait_for(cls.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    @classmethod
+    async def poll(cls, tracked_run: "RunPoller.TrackedRun"):
+        """
+        Retrieves the run once and resolves its waiters if it is no longer pending.
+
+        Parameters:
+        - tracked_run (TrackedRun): The run.
+
+        Returns:
+        - None
+        """
+
+        cls.polls += 1
+        ASSISTANT_RUN_POLLS.inc()
+        try:
+            run = await cls.async_client.beta.threads.runs.retrieve(
+                tracked_run.run_id, thread_id=tracked_run.thread_id
+            )
+        except Exception as e:
+            tracked_run.errors += 1
+            logger.error(
+                f"Error in RunPoller while retrieving {tracked_run.run_id}: {e}"
+            )
+            if tracked_run.errors >= cls.config["max_errors"]:
+                cls.resolve(tracked_run, exception=e)
+            else:
+                cls.reschedule(tracked_run)
+            return
+
+        tracked_run.errors = 0
+        if run.status in cls.pending_statuses:
+            cls.reschedule(tracked_run)
+            return
+
+        duration = time.monotonic() - tracked_run.started_at
+        weight = cls.config["duration_weight"]
+        cls.typical_duration = (1 - weight) * cls.typical_duration + weight * duration
+        cls.resolve(tracked_run, run=run)
+
+    @classmethod
+    def resolve(
+        cls,
+        tracked_run: "RunPoller.TrackedRun",
+        run: Run = None,
+        exception: Exception = None,
+    ):
+        """
+        Stops tracking the run and passes the result to its waiters.
+
+        Parameters:
+        - tracked_run (TrackedRun): The run.
+        - run (Run): The retrieved run.
+        - exception (Exception): The error to raise in the waiters instead.
+
+        Returns:
+        - None
+        """
+
+        if cls.runs.get((tracked_run.thread_id, tracked_run.run_id)) is tracked_run:
+            del cls.runs[(tracked_run.thread_id, tracked_run.run_id)]
+
+        for future in tracked_run.waiters:
+            if future.done():
+                continue
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(run)
+
+    @classmethod
+    def get_metrics(cls) -> dict:
+        """
+        Returns the statistics of the poller.
+
+        Returns:
+        - dict: The number of tracked runs, the number of polls made and the typical run duration.
+        """
+
+        return {
+            "runs": len(cls.runs),
+            "polls": cls.polls,
+            "typical_duration": cls.typical_duration,
+        }
+
+    @classmethod
+    async def shutdown(cls):
+        """
+        Stops the background task.
+
+        Returns:
+        - None
+        """
+
+        if cls.task is not None:
+            cls.task.cancel()
+            try:
+                await cls.task
+            except asyncio.CancelledError:
+                pass
+            cls.task = None
@@ -1,5 +1,19 @@
+import asyncio
+from typing import BinaryIO, List, Tuple
+
+from loguru import logger
 from openai import AsyncOpenAI
 
+from monitoring import instrument
+from utils import (
+    decode_audio,
+    detect_speech,
+    encode_audio,
+    is_audio_processing_available,
+    join_overlapping_transcripts,
+    split_at_silence,
+)
+
 
 class SttService:
     """
@@ -9,6 +23,21 @@ class SttService:
     # A dictionary containing configuration options for the speech service, such as the model to use.
     config = {
         "model": "whisper-1",
+        # Whether clips without speech are dropped and silence around the speech is trimmed before the upload.
+        "trim_silence": True,
+        # Whether the audio is downmixed, resampled and re-encoded into the smallest format Whisper accepts.
+        # Trimming silence always re-encodes the audio.
+        "reencode": True,
+        "sample_rate": 16000,
+        "bit_rate": 24000,
+        "min_speech_ms": 250,
+        "padding_ms": 200,
+        # Speech longer than this is split at pauses into segments transcribed concurrently.
+        "max_segment_seconds": 60,
+        # The length of the audio shared by neighbouring segments.
+        "segment_overlap_seconds": 1.0,
+        # The maximum number of segments of one voice message transcribed at once.
+        "segment_concurrency": 6,
     }
 
     # An OpenAI client for making requests to the speech service.
@@ -29,15 +58,102 @@ class SttService:
         cls.async_client = async_client
 
     @classmethod
-    async def speech_to_text(cls, path_to_file: str) -> str:
+    def prepare_audio(
+        cls, audio_file: BinaryIO, file_name: str
+    ) -> List[Tuple[BinaryIO, str]]:
+        """
+        Prepares the audio for the upload.
+
+        Audio without speech is dropped. Otherwise the silence around the speech is trimmed,
+        and long speech is split at pauses into overlapping segments, each re-encoded on its own.
+        If PyAV is not installed, or the audio cannot be decoded, the audio is uploaded as it is.
+        This method is CPU-bound and should be run in a thread.
+
+        Parameters:
+        - audio_file (BinaryIO): The audio file.
+        - file_name (str): The file name of the audio.
+
+        Returns:
+        - List[Tuple[BinaryIO, str]]: The audio files to upload and their file names, in order.
+          The list is empty if there is no speech.
+        """
+
+        if not is_audio_processing_available() or not (
+            cls.config["trim_silence"] or cls.config["reencode"]
+        ):
+            return [(audio_file, file_name)]
+
+        sample_rate = cls.config["sample_rate"]
+        try:
+            samples = decode_audio(audio_file, sample_rate)
+        except Exception as e:
+            logger.error(f"Error in SttService while decoding {file_name}: {e}")
+            return [(audio_file, file_name)]
+
+        if cls.config["trim_silence"]:
+            speech = detect_speech(
+                samples,
+                sample_rate,
+                min_speech_ms=cls.config["min_speech_ms"],
+                padding_ms=cls.config["padding_ms"],
+            )
+            if speech is None:
+                return []
+            samples = samples[speech[0] : speech[1]]
+
+        segments = split_at_silence(
+            samples,
+            sample_rate,
+            max_segment_s=cls.config["max_segment_seconds"],
+            overlap_s=cls.config["segment_overlap_seconds"],
+        )
+        return [
+            (
+                encode_audio(samples[start:end], sample_rate, cls.config["bit_rate"]),
+                f"voice-{index}.ogg",
+            )
+            for index, (start, end) in enumerate(segments)
+        ]
+
+    @classmethod
+    @instrument("stt.segment")
+    async def transcribe(cls, audio_file: BinaryIO, file_name: str) -> str:
+        """
+        Transcribes the audio file with a single request.
+
+        Parameters:
+        - audio_file (BinaryIO): The audio file.
+        - file_name (str): The file name sent with the upload, whose extension tells the API the audio format.
+
+        Returns:
+        - str: The transcription of the audio as text.
+        """
+
+        audio_file.seek(0)
+        return await cls.async_client.audio.transcriptions.create(
+            model=cls.config["model"],
+            file=(file_name, audio_file),
+            response_format="text",
+        )
+
+    @classmethod
+    @instrument("stt")
+    async def speech_to_text(
+        cls, audio_file: BinaryIO, file_name: str = "voice.ogg"
+    ) -> str:
         """
         Converts the speech in the given audio file to text.
 
+        The file is uploaded straight from the given file object, so it does not have to be saved on disk.
+        Clips without speech are not uploaded at all. Long speech is transcribed in segments concurrently,
+        so it takes about as long as its longest segment.
+
         Parameters:
-        - path_to_file (str): The path to the audio file containing the speech to be converted.
+        - audio_file (BinaryIO): The audio file containing the speech to be converted.
+        - file_name (str): The file name sent with the upload, whose extension tells the API the audio format.
 
         Returns:
-        - str: The transcription of the speech as text.
+        - str: The transcription of the speech as text, or an empty string if there is no speech.
 
         Raises:
         - ValueError: If the async_client is not initialized before calling this method.
@@ -48,9 +164,22 @@ class SttService:
                 "async_client must be initialized before calling speech_to_text."
             )
 
-        with open(path_to_file, "rb") as audio_file:
-            transcription = await cls.async_client.audio.transcriptions.create(
-                model=cls.config["model"], file=audio_file, response_format="text"
-            )
+        segments = await asyncio.to_thread(cls.prepare_audio, audio_file, file_name)
+        if not segments:
+            logger.info("Voice message without speech was not transcribed")
+            return ""
+        if len(segments) == 1:
+            return await cls.transcribe(*segments[0])
+
+        semaphore = asyncio.Semaphore(cls.config["segment_concurrency"])
+
+        async def transcribe_segment(segment_file: BinaryIO, segment_name: str) -> str:
+            async with semaphore:
+                return await cls.transcribe(segment_file, segment_name)
+
+        transcripts = await asyncio.gather(
+            *(transcribe_segment(*segment) for segment in segments)
+        )
+        logger.info(f"Voice message was transcribed in {len(segments)} segments")
 
-        return transcription
+        return join_overlapping_transcripts(transcripts)
@@ -1,22 +1,249 @@
-import uuid
+import asyncio
+import re
+from typing import AsyncIterator, Iterable, List
 
+from loguru import logger
 from openai import AsyncOpenAI
 
+from config import settings
+from monitoring import instrument
+from utils import AudioCache, Strings, split_complete_sentences
+
+from .openai_scheduler import OpenAIScheduler, Priority
+
 
 class TtsService:
     """
     A class for converting text to speech using an OpenAI client and a configuration.
     """
 
+    class SpeechStream:
+        """
+        A class for the audio of one chunk of a reply, which can be consumed while it is being synthesized.
+        The synthesis starts right away, and the received audio is buffered until it is consumed. The buffer is
+        bounded, so the synthesis waits for a slow consumer instead of holding the whole audio in memory.
+        """
+
+        def __init__(self, text: str, semaphore: asyncio.Semaphore):
+            """
+            Starts the synthesis of the text.
+
+            Parameters:
+            - text (str): The text to synthesize.
+            - semaphore (asyncio.Semaphore): The semaphore bounding the number of concurrent syntheses.
+            """
+
+            self.chunks = asyncio.Queue(
+                maxsize=TtsService.config["stream_buffer_chunks"]
+            )
+            self.task = asyncio.create_task(self._synthesize(text, semaphore))
+
+        async def __aiter__(self) -> AsyncIterator[bytes]:
+            """
+            Returns the audio as it is received. Can be iterated only once.
+
+            Returns:
+            - AsyncIterator[bytes]: The consecutive parts of the generated Opus audio.
+
+            Raises:
+            - Exception: If the synthesis fails.
+            """
+
+            while (data := await self.chunks.get()) is not None:
+                yield data
+            # Raises the error of the synthesis, if any.
+            await self.task
+
+        async def read(self) -> bytes:
+            """
+            Waits for the whole audio, for the replies that are not streamed to Telegram.
+
+            Returns:
+            - bytes: The generated Opus audio.
+            """
+
+            return b"".join([data async for data in self])
+
+        def cancel(self):
+            """
+            Cancels the synthesis.
+
+            Returns:
+            - None
+            """
+
+            self.task.cancel()
+
+        async def _synthesize(self, text: str, semaphore: asyncio.Semaphore):
+            """
+            Synthesizes the text once a slot of the bounded fan-out is free, buffering the received audio.
+            """
+
+            try:
+                async with semaphore:
+                    async for data in TtsService.stream_speech(text):
+                        await self.chunks.put(data)
+            except BaseException:
+                # The audio is incomplete, so it is dropped to mark the end without waiting for the consumer,
+                # which may be gone after a cancellation.
+                while not self.chunks.empty():
+                    self.chunks.get_nowait()
+                self.chunks.put_nowait(None)
+                raise
+            await self.chunks.put(None)
+
+    class SpeechPipeline:
+        """
+        A class for synthesizing a reply sentence by sentence.
+        Text is fed while it is being generated, completed sentences are grouped into chunks and synthesized
+        concurrently, and the audio streams of the chunks are returned in order as soon as each of them starts.
+        """
+
+        # Matches citations, both raw streamed markers and formatted ones, which are not spoken.
+        citation_pattern = re.compile(r"\s?\[Источник: [^\]]*\]|【[^】]*】")
+
+        def __init__(self, concurrency: int, chunk_chars: int):
+            """
+            Initializes the pipeline.
+
+            Parameters:
+            - concurrency (int): The maximum number of chunks synthesized at the same time.
+            - chunk_chars (int): The minimum length of a chunk, except for the first one,
+              which is a single sentence so that the first audio is ready as soon as possible.
+            """
+
+            self.chunk_chars = chunk_chars
+            self.semaphore = asyncio.Semaphore(concurrency)
+            self.tasks = asyncio.Queue()
+            self.text = ""
+            self.offset = 0
+            self.pending = []
+            self.is_first_chunk = True
+            self.is_closed = False
+
+        def feed(self, text: str):
+            """
+            Updates the text of the reply and schedules the synthesis of its completed chunks.
+
+            Parameters:
+            - text (str): The whole text of the reply generated so far.
+
+            Returns:
+            - None
+            """
+
+            if self.is_closed:
+                return
+
+            self.text = self.citation_pattern.sub("", text)
+            sentences, offset = split_complete_sentences(self.text[self.offset :])
+            self.offset += offset
+            self.pending.extend(sentences)
+
+            if self.is_first_chunk and self.pending:
+                self._schedule(self.pending[:1])
+                self.pending = self.pending[1:]
+                self.is_first_chunk = False
+
+            while sum(len(sentence) for sentence in self.pending) >= self.chunk_chars:
+                length = 0
+                for count, sentence in enumerate(self.pending, start=1):
+                    length += len(sentence)
+                    if length >= self.chunk_chars:
+                        break
+                self._schedule(self.pending[:count])
+                self.pending = self.pending[count:]
+
+        def close(self, text: str = None):
+            """
+            Marks the reply as complete and schedules the synthesis of the remaining text.
+
+            Parameters:
+            - text (str): The final text of the reply. Defaults to the last text passed to `feed`.
+
+            Returns:
+            - None
+            """
+
+            if self.is_closed:
+                return
+            if text is not None:
+                self.feed(text)
+
+            rest = self.text[self.offset :].strip()
+            self.offset = len(self.text)
+            if rest:
+                self.pending.append(rest)
+            if self.pending:
+                self._schedule(self.pending)
+                self.pending = []
+
+            self.is_closed = True
+            self.tasks.put_nowait(None)
+
+        async def __aiter__(self) -> AsyncIterator["TtsService.SpeechStream"]:
+            """
+            Returns the audio of the chunks in the order of the text.
+
+            Returns:
+            - AsyncIterator[TtsService.SpeechStream]: The audio stream of every chunk.
+            """
+
+            while (stream := await self.tasks.get()) is not None:
+                yield stream
+
+        async def aclose(self):
+            """
+            Cancels the synthesis of the chunks that were not returned yet.
+
+            Returns:
+            - None
+            """
+
+            tasks = []
+            while not self.tasks.empty():
+                if (stream := self.tasks.get_nowait()) is not None:
+                    stream.cancel()
+                    tasks.append(stream.task)
+
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        def _schedule(self, sentences: List[str]):
+            """
+            Starts the synthesis of a chunk made of the given sentences.
+            """
+
+            self.tasks.put_nowait(
+                TtsService.SpeechStream(" ".join(sentences), self.semaphore)
+            )
+
     # A dictionary containing configuration options for the speech service, such as the model and voice to use.
     config = {
         "model": "tts-1",
         "voice": "nova",
+        # Opus in an OGG container, which Telegram shows as a voice message.
+        "response_format": "opus",
+        # The size of the parts in which streamed audio is forwarded.
+        "stream_chunk_size": 16 * 1024,
+        # The maximum number of parts of streamed audio buffered ahead of its consumer, e.g. the upload to Telegram.
+        "stream_buffer_chunks": 8,
+        # Streamed audio larger than this is not cached, so that large replies are never held in memory whole.
+        "stream_cache_max_bytes": 1024 * 1024,
+        # The maximum number of chunks of one reply synthesized at the same time.
+        "pipeline_concurrency": 3,
+        # The minimum length of every chunk of a reply after the first one.
+        "pipeline_chunk_chars": 200,
     }
 
     # An OpenAI client for making requests to the speech service.
     async_client = None
 
+    # A cache of the synthesized speech, so that the same text is never synthesized twice.
+    cache = None
+
+    # The constant phrases replied with as voice messages, prewarmed in the cache on startup.
+    canned_texts = [Strings.NO_SPEECH_MSG, Strings.NO_FACE_MSG]
+
     @classmethod
     def initialize(cls, async_client: AsyncOpenAI):
         """
@@ -30,17 +257,24 @@ class TtsService:
         """
 
         cls.async_client = async_client
+        cls.cache = AudioCache(
+            directory=settings.TTS_CACHE_DIR,
+            memory_size=settings.TTS_CACHE_MEMORY_SIZE,
+            disk_size=settings.TTS_CACHE_DISK_SIZE,
+        )
 
     @classmethod
-    async def text_to_speech(cls, text: str) -> str:
+    @instrument("tts")
+    async def text_to_speech(cls, text: str) -> bytes:
         """
-        Converts the provided text to speech and saves it as an MP3 file.
+        Converts the provided text to speech in the Opus format.
+        Speech already synthesized for the same text is taken from the cache.
 
         Parameters:
         - text (str): The text to convert to speech.
 
         Returns:
-        - str: The path to the generated MP3 file.
+        - bytes: The generated Opus audio.
 
         Raises:
         - ValueError: If the async_client is not initialized before calling this method.
@@ -51,9 +285,124 @@ class TtsService:
                 "async_client must be initialized before calling speech_to_text."
             )
 
-        path_to_file = str(uuid.uuid4()) + ".mp3"
+        key = AudioCache.make_key(
+            cls.config["model"],
+            cls.config["voice"],
+            cls.config["response_format"],
+            text,
+        )
+        if (audio := await cls.cache.get(key)) is not None:
+            return audio
+
+        response = await cls.async_client.audio.speech.create(
+            model=cls.config["model"],
+            voice=cls.config["voice"],
+            response_format=cls.config["response_format"],
+            input=text,
+        )
+        audio = response.content
+        await cls.cache.set(key, audio)
+        return audio
+
+    @classmethod
+    @instrument("tts.stream")
+    async def stream_speech(cls, text: str) -> AsyncIterator[bytes]:
+        """
+        Converts the provided text to speech in the Opus format, returning the audio as it is received.
+        Speech already synthesized for the same text is taken from the cache, and small enough speech is cached.
+
+        Parameters:
+        - text (str): The text to convert to speech.
+
+        Returns:
+        - AsyncIterator[bytes]: The consecutive parts of the generated Opus audio.
+
+        Raises:
+        - ValueError: If the async_client is not initialized before calling this method.
+        """
+
+        if cls.async_client is None:
+            raise ValueError(
+                "async_client must be initialized before calling stream_speech."
+            )
+
+        key = AudioCache.make_key(
+            cls.config["model"],
+            cls.config["voice"],
+            cls.config["response_format"],
+            text,
+        )
+        if (audio := await cls.cache.get(key)) is not None:
+            yield audio
+            return
+
+        # The received parts are kept for the cache only until the audio turns out to be too large.
+        parts = []
+        size = 0
         async with cls.async_client.audio.speech.with_streaming_response.create(
-            model=cls.config["model"], voice=cls.config["voice"], input=text
-        ) as model:
-            await model.stream_to_file(path_to_file)
-        return path_to_file
+            model=cls.config["model"],
+            voice=cls.config["voice"],
+            response_format=cls.config["response_format"],
+            input=text,
+        ) as response:
+            async for data in response.iter_bytes(cls.config["stream_chunk_size"]):
+                size += len(data)
+                if parts is not None:
+                    parts.append(data)
+                    if size > cls.config["stream_cache_max_bytes"]:
+                        parts = None
+                yield data
+
+        if parts is not None:
+            await cls.cache.set(key, b"".join(parts))
+
+    @classmethod
+    async def prewarm(cls, texts: Iterable[str] = None):
+        """
+        Synthesizes texts ahead of time, so that replying with them is served from the cache.
+
+        Parameters:
+        - texts (Iterable[str]): The texts to synthesize. Defaults to the canned texts.
+
+        Returns:
+        - None
+        """
+
+        if texts is None:
+            texts = cls.canned_texts
+
+        semaphore = asyncio.Semaphore(cls.config["pipeline_concurrency"])
+
+        async def synthesize(text: str):
+            async with semaphore:
+                try:
+                    # Prewarming must not delay the synthesis of replies.
+                    with OpenAIScheduler.context("tts", Priority.BACKGROUND):
+                        await cls.text_to_speech(text)
+                except Exception as e:
+                    logger.error(f"Error in TtsService while prewarming the cache: {e}")
+
+        await asyncio.gather(*(synthesize(text) for text in texts))
+        logger.info(f"TTS cache prewarmed: {cls.cache.stats()}")
+
+    @classmethod
+    def create_pipeline(cls) -> "TtsService.SpeechPipeline":
+        """
+        Creates a pipeline that synthesizes a reply sentence by sentence.
+
+        Returns:
+        - TtsService.SpeechPipeline: A new pipeline configured with the service's options.
+
+        Raises:
+        - ValueError: If the async_client is not initialized before calling this method.
+        """
+
+        if cls.async_client is None:
+            raise ValueError(
+                "async_client must be initialized before calling create_pipeline."
+            )
+
+        return cls.SpeechPipeline(
+            concurrency=cls.config["pipeline_concurrency"],
+            chunk_chars=cls.config["pipeline_chunk_chars"],
+        )
@@ -3,6 +3,10 @@ import json
 from loguru import logger
 from openai import AsyncOpenAI
 
+from monitoring import instrument
+
+from .openai_scheduler import OpenAIScheduler
+
 
 class ValidateService:
     """
@@ -66,6 +70,7 @@ class ValidateService:
         cls.async_client = async_client
 
     @classmethod
+    @instrument("validate")
     async def validate_key_values(cls, key_values: str) -> bool:
         """
         Validates the key values identified by the user.
@@ -103,15 +108,16 @@ class ValidateService:
                 },
             ]
 
-            response = await cls.async_client.chat.completions.create(
-                model=cls.config["model"],
-                messages=messages,
-                tools=cls.config["tools"],
-                tool_choice={
-                    "type": "function",
-                    "function": {"name": "validate_value"},
-                },
-            )
+            with OpenAIScheduler.context("validate"):
+                response = await cls.async_client.chat.completions.create(
+                    model=cls.config["model"],
+                    messages=messages,
+                    tools=cls.config["tools"],
+                    tool_choice={
+                        "type": "function",
+                        "function": {"name": "validate_value"},
+                    },
+                )
 
             output = response.choices[0].message.tool_calls[0]
             arguments_dict = json.loads(output.function.arguments)
@@ -0,0 +1,61 @@
+import numpy as np
+
+from utils.audio_tools import detect_speech
+
+SAMPLE_RATE = 16000
+
+
+def tone(level_db: float, seconds: float) -> np.ndarray:
+    """
+    Returns a 200 Hz sine wave of the given RMS level, standing in for speech.
+    """
+
+    time = np.arange(int(SAMPLE_RATE * seconds)) / SAMPLE_RATE
+    amplitude = 10 ** (level_db / 20) * np.sqrt(2) * 32767
+    return (amplitude * np.sin(2 * np.pi * 200 * time)).astype(np.int16)
+
+
+def noise(level_db: float, seconds: float, seed: int = 0) -> np.ndarray:
+    """
+    Returns white noise of the given RMS level.
+    """
+
+    rng = np.random.default_rng(seed)
+    return (
+        rng.normal(0, 10 ** (level_db / 20) * 32767, int(SAMPLE_RATE * seconds))
+        .clip(-32768, 32767)
+        .astype(np.int16)
+    )
+
+
+def test_detect_speech_trims_leading_and_trailing_silence():
+    samples = np.concatenate(
+        [np.zeros(SAMPLE_RATE, np.int16), tone(-20, 3), np.zeros(SAMPLE_RATE, np.int16)]
+    )
+
+    start, end = detect_speech(samples, SAMPLE_RATE, padding_ms=200)
+
+    padding = SAMPLE_RATE * 200 // 1000
+    frame_length = SAMPLE_RATE * 30 // 1000
+    assert abs(start - (SAMPLE_RATE - padding)) <= frame_length
+    assert abs(end - (4 * SAMPLE_RATE + padding)) <= frame_length
+
+
+def test_detect_speech_keeps_continuous_speech():
+    samples = tone(-20, 3)
+
+    assert detect_speech(samples, SAMPLE_RATE) == (0, len(samples))
+
+
+def test_detect_speech_keeps_speech_over_loud_noise():
+    samples = noise(-35, 3)
+    samples[SAMPLE_RATE : 2 * SAMPLE_RATE] += tone(-25, 1)
+
+    assert detect_speech(samples, SAMPLE_RATE) is not None
+
+
+def test_detect_speech_drops_silence_and_short_clicks():
+    samples = noise(-70, 2)
+    samples[SAMPLE_RATE : SAMPLE_RATE + 1600] = tone(-20, 0.1)
+
+    assert detect_speech(samples, SAMPLE_RATE) is None
@@ -0,0 +1,32 @@
+from utils.sentences import join_overlapping_transcripts, split_complete_sentences
+
+
+def test_split_complete_sentences_keeps_the_growing_tail():
+    sentences, offset = split_complete_sentences("Привет! Как дела? Я ду")
+
+    assert sentences == ["Привет!", "Как дела?"]
+    assert offset == len("Привет! Как дела? ")
+
+
+def test_join_overlapping_transcripts_removes_the_words_transcribed_twice():
+    transcripts = ["Сегодня я ходил в парк и", "в парк и видел там уток."]
+
+    assert join_overlapping_transcripts(transcripts) == (
+        "Сегодня я ходил в парк и видел там уток."
+    )
+
+
+def test_join_overlapping_transcripts_tolerates_a_cut_word_at_the_seam():
+    transcripts = ["We walked to the old bri", "the old bridge and back."]
+
+    assert join_overlapping_transcripts(transcripts) == (
+        "We walked to the old bridge and back."
+    )
+
+
+def test_join_overlapping_transcripts_keeps_a_single_common_word():
+    transcripts = ["Мне нравится читать и", "и гулять по вечерам."]
+
+    assert join_overlapping_transcripts(transcripts) == (
+        "Мне нравится читать и и гулять по вечерам."
+    )
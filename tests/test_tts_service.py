@@ -0,0 +1,45 @@
+import asyncio
+
+from services.tts_service import TtsService
+
+
+def test_speech_stream_waits_for_a_slow_consumer(monkeypatch):
+    produced = []
+
+    async def stream_speech(text):
+        for index in range(50):
+            produced.append(index)
+            yield bytes([index])
+
+    monkeypatch.setattr(TtsService, "stream_speech", stream_speech)
+
+    async def consume():
+        stream = TtsService.SpeechStream("text", asyncio.Semaphore(1))
+        received = []
+        async for data in stream:
+            # The synthesis is ahead of the consumer by at most the size of the buffer.
+            assert len(produced) - len(received) <= stream.chunks.maxsize + 1
+            received.append(data)
+            await asyncio.sleep(0)
+        return received
+
+    received = asyncio.run(consume())
+
+    assert received == [bytes([index]) for index in range(50)]
+
+
+def test_speech_stream_cancellation_does_not_wait_for_a_consumer(monkeypatch):
+    async def stream_speech(text):
+        while True:
+            yield b"audio"
+
+    monkeypatch.setattr(TtsService, "stream_speech", stream_speech)
+
+    async def cancel():
+        stream = TtsService.SpeechStream("text", asyncio.Semaphore(1))
+        await asyncio.sleep(0.01)
+        stream.cancel()
+        await asyncio.wait_for(asyncio.gather(stream.task, return_exceptions=True), 1)
+        return stream.chunks.get_nowait()
+
+    assert asyncio.run(cancel()) is None
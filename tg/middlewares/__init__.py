@@ -0,0 +1,2 @@
+from .metrics_middleware import MetricsMiddleware
+from .job_queue_middleware import JobQueueMiddleware
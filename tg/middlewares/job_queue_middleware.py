@@ -0,0 +1,30 @@
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import Update
+
+from services import JobQueue
+
+
+class JobQueueMiddleware(BaseMiddleware):
+    """
+    An outer middleware of the updates that enqueues them for the worker processes instead of handling them.
+    The updates of a user are keyed by the user, so the workers handle them in order.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, Dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: Dict[str, Any],
+    ) -> Any:
+        user = data.get("event_from_user")
+        chat = data.get("event_chat")
+        if user is not None:
+            user_key = str(user.id)
+        elif chat is not None:
+            user_key = f"chat:{chat.id}"
+        else:
+            user_key = f"update:{event.update_id}"
+
+        await JobQueue.enqueue(user_key, event.model_dump_json(exclude_unset=True))
@@ -0,0 +1,33 @@
+import time
+from typing import Any, Awaitable, Callable, Dict
+
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject
+
+from monitoring import UPDATE_DURATION, UPDATE_ERRORS, UPDATES_IN_FLIGHT
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """
+    A middleware recording the duration, the failures and the concurrency of the handlers.
+    """
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any],
+    ) -> Any:
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+
+        UPDATES_IN_FLIGHT.inc()
+        started_at = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            UPDATE_ERRORS.labels(name).inc()
+            raise
+        finally:
+            UPDATE_DURATION.labels(name).observe(time.perf_counter() - started_at)
+            UPDATES_IN_FLIGHT.dec()
@@ -1,18 +1,23 @@
 from aiogram import Router
 from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
 from aiogram.types import Message
 
 from analytics.types import EventType
+from config import settings
 from services import AnalyticsService, AssistantService
+from tg.states import ThreadIdState
 from utils import Strings
 
 router = Router()
+bot = settings.bot
 
 
 @router.message(Command("clear"))
-async def cmd_clear(message: Message):
+async def cmd_clear(message: Message, state: FSMContext):
     """
-    Handles the "/clear" command by clearing the context.
+    Handles the "/clear" command by clearing the context: the conversation continues in a new thread.
 
     Parameters:
     - message (Message): The message object received from the user.
@@ -25,4 +30,14 @@ async def cmd_clear(message: Message):
         user_id=message.from_user.id, event_type=EventType.ClearCommand
     )
 
+    key = StorageKey(
+        bot_id=bot.id, user_id=message.from_user.id, chat_id=message.chat.id
+    )
+    data = await state.storage.get_data(key)
+    thread_id = await AssistantService.clear_context(
+        message.from_user.id, data.get("thread_id")
+    )
+    await state.set_state(ThreadIdState.thread_id)
+    await state.storage.set_data(key=key, data={**data, "thread_id": thread_id})
+
     await message.reply(Strings.CLEAR_MSG)
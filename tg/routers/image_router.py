@@ -1,21 +1,15 @@
-import os
-import pathlib
-
 from aiogram import F
 from aiogram.dispatcher.router import Router
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.base import StorageKey
-from aiogram.types import FSInputFile, Message
-from loguru import logger
+from aiogram.types import Message
 
 from analytics.types import EventType
-from config import settings
-from services import AnalyticsService, AssistantService, EmotionService, TtsService
+from services import AnalyticsService, EmotionService
 from tg.states import ThreadIdState
-from utils import Strings
+from tg.utils import ReplyDelivery
+from utils import Emotions, Strings, choose_photo_size
 
 router = Router()
-bot = settings.bot
 
 
 @router.message(ThreadIdState.thread_id, F.photo)
@@ -35,42 +29,21 @@ async def image(message: Message, state: FSMContext):
         user_id=message.from_user.id, event_type=EventType.ImageSent
     )
 
-    await message.answer(Strings.WAIT_MSG)
-
-    file = await bot.get_file(message.photo[-1].file_id)
-    file_on_disk = pathlib.Path("", f"{message.photo[-1].file_id}.jpg")
-    await bot.download_file(file.file_path, destination=file_on_disk)
-
-    try:
-        emotion_state = await EmotionService.identify_emotions(file_on_disk)
-
-        data = await state.storage.get_data(
-            StorageKey(
-                bot_id=bot.id,
-                user_id=message.from_user.id,
-                chat_id=message.chat.id,
-            )
+    async with ReplyDelivery(message, state, image.__name__) as delivery:
+        photo = choose_photo_size(
+            message.photo, EmotionService.config["photo_min_side"]
         )
 
-        response = await AssistantService.request(
-            message.from_user.id,
-            data["thread_id"],
-            Strings.EMOTION_STATE_USER_ANS + emotion_state,
-        )
+        emotion_state = EmotionService.get_cached_emotions(photo.file_unique_id)
+        if emotion_state is None:
+            image_file = await delivery.download(photo.file_id)
+            with delivery.stage("emotion"):
+                emotion_state = await EmotionService.identify_emotions(
+                    image_file, file_unique_id=photo.file_unique_id
+                )
 
-        await message.answer(response)
+        if emotion_state == Emotions.NO_FACE:
+            await delivery.answer_canned(Strings.NO_FACE_MSG)
+            return
 
-        try:
-            response_audio_file_path = await TtsService.text_to_speech(response)
-            response = FSInputFile(response_audio_file_path)
-            await message.answer_voice(response)
-        except Exception as e:
-            logger.error(
-                f"Error in voice_message_router while converting answer to audio: {e}"
-            )
-        finally:
-            os.remove(response_audio_file_path)
-    except Exception as e:
-        logger.error(f"Error in image_router: {e}")
-    finally:
-        os.remove(file_on_disk)
+        await delivery.answer(Strings.EMOTION_STATE_USER_ANS + emotion_state)
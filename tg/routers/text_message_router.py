@@ -1,20 +1,14 @@
-import os
-
 from aiogram import F
 from aiogram.dispatcher.router import Router
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.base import StorageKey
-from aiogram.types import FSInputFile, Message
-from loguru import logger
+from aiogram.types import Message
 
 from analytics.types import EventType
-from config import settings
-from services import AnalyticsService, AssistantService, TtsService
+from services import AnalyticsService
 from tg.states import ThreadIdState
-from utils import Strings
+from tg.utils import ReplyDelivery
 
 router = Router()
-bot = settings.bot
 
 
 @router.message(ThreadIdState.thread_id, F.text)
@@ -34,32 +28,5 @@ async def text_message(message: Message, state: FSMContext):
         user_id=message.from_user.id, event_type=EventType.TextMessageSent
     )
 
-    await message.answer(Strings.WAIT_MSG)
-
-    try:
-        data = await state.storage.get_data(
-            StorageKey(
-                bot_id=bot.id,
-                user_id=message.from_user.id,
-                chat_id=message.chat.id,
-            )
-        )
-
-        response = await AssistantService.request(
-            message.from_user.id, data["thread_id"], message.text
-        )
-
-        await message.answer(response)
-
-        try:
-            response_audio_file_path = await TtsService.text_to_speech(response)
-            response = FSInputFile(response_audio_file_path)
-            await message.answer_voice(response)
-        except Exception as e:
-            logger.error(
-                f"Error in voice_message_router while converting answer to audio: {e}"
-            )
-        finally:
-            os.remove(response_audio_file_path)
-    except Exception as e:
-        logger.error(f"Error in text_message_router: {e}")
+    async with ReplyDelivery(message, state, text_message.__name__) as delivery:
+        await delivery.answer(message.text)
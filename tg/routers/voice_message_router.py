@@ -1,21 +1,15 @@
-import os
-import pathlib
-
 from aiogram import F
 from aiogram.dispatcher.router import Router
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.base import StorageKey
-from aiogram.types import FSInputFile, Message
-from loguru import logger
+from aiogram.types import Message
 
 from analytics.types import EventType
-from config import settings
-from services import AnalyticsService, AssistantService, SttService, TtsService
+from services import AnalyticsService, SttService
 from tg.states import ThreadIdState
+from tg.utils import ReplyDelivery
 from utils import Strings
 
 router = Router()
-bot = settings.bot
 
 
 @router.message(ThreadIdState.thread_id, F.voice)
@@ -36,40 +30,14 @@ async def voice_message(message: Message, state: FSMContext):
         user_id=message.from_user.id, event_type=EventType.VoiceMessageSent
     )
 
-    await message.answer(Strings.WAIT_MSG)
-
-    file = await bot.get_file(message.voice.file_id)
-    file_on_disk = pathlib.Path("", f"{message.voice.file_id}.ogg")
-    await bot.download_file(file.file_path, destination=file_on_disk)
-
-    try:
-        text = await SttService.speech_to_text(file_on_disk)
-
-        data = await state.storage.get_data(
-            StorageKey(
-                bot_id=bot.id,
-                user_id=message.from_user.id,
-                chat_id=message.chat.id,
-            )
-        )
+    async with ReplyDelivery(message, state, voice_message.__name__) as delivery:
+        voice_file = await delivery.download(message.voice.file_id)
 
-        response = await AssistantService.request(
-            message.from_user.id, data["thread_id"], text
-        )
+        with delivery.stage("transcription"):
+            text = await SttService.speech_to_text(voice_file, "voice.ogg")
 
-        await message.answer(response)
+        if not text.strip():
+            await delivery.answer_canned(Strings.NO_SPEECH_MSG)
+            return
 
-        try:
-            response_audio_file_path = await TtsService.text_to_speech(response)
-            response = FSInputFile(response_audio_file_path)
-            await message.answer_voice(response)
-        except Exception as e:
-            logger.error(
-                f"Error in voice_message_router while converting answer to audio: {e}"
-            )
-        finally:
-            os.remove(response_audio_file_path)
-    except Exception as e:
-        logger.error(f"Error in voice_message_router: {e}")
-    finally:
-        os.remove(file_on_disk)
+        await delivery.answer(text)
@@ -0,0 +1 @@
+from .cached_redis_storage import CachedRedisStorage
@@ -0,0 +1,178 @@
+import asyncio
+import copy
+import json
+import uuid
+from typing import Any, Awaitable, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import StateType, StorageKey
+from aiogram.fsm.storage.redis import RedisStorage
+from loguru import logger
+from redis.asyncio import Redis
+
+from utils import LruCache
+
+
+class CachedRedisStorage(RedisStorage):
+    """
+    A Redis storage of the FSM states and data that keeps the recently read records in memory.
+
+    The records are read from Redis once and then served from the cache until they expire or are evicted.
+    Writes go to Redis and update the cache, and the other replicas drop their copies of the written records
+    as they are notified through Redis pub/sub. If the notifications are interrupted, the whole cache is dropped,
+    and the TTL bounds how long a missed notification can leave a record stale.
+    """
+
+    # Returned by the cache for the records it does not hold, as a cached state may be None.
+    missing = object()
+
+    def __init__(
+        self,
+        redis: Redis,
+        cache_size: int = 10000,
+        cache_ttl: Optional[float] = 300.0,
+        channel: str = "fsm:invalidate",
+        **kwargs: Any,
+    ):
+        """
+        Initializes the storage.
+
+        Parameters:
+        - redis (Redis): The Redis client.
+        - cache_size (int): The maximum number of cached records.
+        - cache_ttl (Optional[float]): The number of seconds after which a cached record is read from Redis again,
+          or None if records never expire.
+        - channel (str): The pub/sub channel the writes are announced on.
+        - kwargs (Any): The other arguments of RedisStorage.
+        """
+
+        super().__init__(redis=redis, **kwargs)
+        self.cache = LruCache(max_size=cache_size, ttl=cache_ttl)
+        self.channel = channel
+        # The ID of the process in the notifications, so that it ignores its own writes.
+        self.origin = uuid.uuid4().hex
+        # Incremented on every write and invalidation, so that a read racing with them is not cached.
+        self.version = 0
+        self.listener: Optional[asyncio.Task] = None
+
+    async def close(self):
+        if self.listener is not None:
+            self.listener.cancel()
+            self.listener = None
+        await super().close()
+
+    async def set_state(self, key: StorageKey, state: StateType = None):
+        await super().set_state(key, state)
+        value = state.state if isinstance(state, State) else state
+        await self.store(self.key_builder.build(key, "state"), value)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        redis_key = self.key_builder.build(key, "state")
+        state = self.cache.get(redis_key, self.missing)
+        if state is self.missing:
+            state = await self.load(redis_key, super().get_state(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]):
+        await super().set_data(key, data)
+        await self.store(self.key_builder.build(key, "data"), copy.deepcopy(data))
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        redis_key = self.key_builder.build(key, "data")
+        data = self.cache.get(redis_key, self.missing)
+        if data is self.missing:
+            data = await self.load(redis_key, super().get_data(key))
+        # The callers may modify the data, so they get a copy.
+        return copy.deepcopy(data)
+
+    async def load(self, redis_key: str, read: Awaitable[Any]) -> Any:
+        """
+        Reads a record from Redis and caches it, unless it was written in the meantime.
+
+        Parameters:
+        - redis_key (str): The key of the record.
+        - read (Awaitable[Any]): The read of the record from Redis.
+
+        Returns:
+        - Any: The record.
+        """
+
+        self.ensure_listening()
+        version = self.version
+        value = await read
+        if version == self.version:
+            self.cache.set(redis_key, value)
+        return value
+
+    async def store(self, redis_key: str, value: Any):
+        """
+        Caches a record written to Redis and notifies the other replicas.
+
+        Parameters:
+        - redis_key (str): The key of the record.
+        - value (Any): The record.
+
+        Returns:
+        - None
+        """
+
+        self.ensure_listening()
+        self.version += 1
+        self.cache.set(redis_key, value)
+        try:
+            await self.redis.publish(
+                self.channel, json.dumps({"origin": self.origin, "key": redis_key})
+            )
+        except Exception as e:
+            logger.error(
+                f"Error in CachedRedisStorage while notifying the replicas: {e}"
+            )
+
+    def ensure_listening(self):
+        if self.listener is None:
+            self.listener = asyncio.create_task(self.listen_forever())
+
+    async def listen_forever(self):
+        """
+        Drops the cached records written by the other replicas, until the task is cancelled.
+
+        Returns:
+        - None
+        """
+
+        while True:
+            try:
+                async with self.redis.pubsub(ignore_subscribe_messages=True) as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    # The notifications sent before the subscription are lost.
+                    self.invalidate()
+                    while True:
+                        message = await pubsub.get_message(timeout=1.0)
+                        if message is None:
+                            continue
+                        notification = json.loads(message["data"])
+                        if notification["origin"] != self.origin:
+                            self.invalidate(notification["key"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in CachedRedisStorage while listening: {e}")
+                self.invalidate()
+                await asyncio.sleep(1.0)
+
+    def invalidate(self, redis_key: Optional[str] = None):
+        """
+        Drops a cached record, or all of them.
+
+        Parameters:
+        - redis_key (Optional[str]): The key of the record, or None for all records.
+
+        Returns:
+        - None
+        """
+
+        self.version += 1
+        if redis_key is None:
+            self.cache.clear()
+        else:
+            self.cache.pop(redis_key)
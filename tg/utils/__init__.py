@@ -0,0 +1,3 @@
+from .reply_delivery import ReplyDelivery
+from .streamed_input_file import StreamedInputFile
+from .streaming_message import StreamingMessage, answer_with_assistant
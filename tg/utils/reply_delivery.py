@@ -0,0 +1,313 @@
+import asyncio
+import time
+from contextlib import contextmanager
+from typing import BinaryIO, Dict, Optional
+
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+from aiogram.types import BufferedInputFile, Message
+from loguru import logger
+
+from config import settings
+from monitoring import UPDATE_ERRORS, track_stage
+from services import (
+    ContextService,
+    ConversationScheduler,
+    PermanentJobError,
+    RunCancelledError,
+    TtsService,
+)
+from utils import Strings, download_media
+
+from .streamed_input_file import StreamedInputFile
+from .streaming_message import answer_with_assistant
+
+
+class ReplyDelivery:
+    """
+    A class for delivering the reply to one message of the user.
+
+    It is used as an async context manager by the message handlers. It sends the wait message,
+    owns the media downloaded for the reply and closes it, replies with both the text and the speech
+    of the assistant's response, and records how long every stage of the reply took.
+    Errors of the handler are logged and not propagated, so the bot keeps serving other messages,
+    unless propagate_errors is set, e.g. by the workers, whose job queue retries the failed updates.
+    """
+
+    # Whether the errors of the handlers are raised instead of logged. An error raised after a part of the reply
+    # was shown to the user is raised as a PermanentJobError, as handling the message again would repeat it.
+    propagate_errors = False
+
+    def __init__(self, message: Message, state: FSMContext, handler: str):
+        """
+        Initializes the delivery.
+
+        Parameters:
+        - message (Message): The message object received from the user.
+        - state (FSMContext): The FSM context of the user.
+        - handler (str): The name of the handler callback, used in the logs and labelling the metrics as in MetricsMiddleware.
+        """
+
+        self.message = message
+        self.state = state
+        self.handler = handler
+        self.placeholder: Optional[Message] = None
+        self.media = []
+        # Maps the stages of the reply to the number of seconds they took.
+        self.timings: Dict[str, float] = {}
+        self._started_at = time.monotonic()
+
+    async def __aenter__(self) -> "ReplyDelivery":
+        with self.stage("placeholder"):
+            self.placeholder = await self.message.answer(Strings.WAIT_MSG)
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback) -> bool:
+        for media in self.media:
+            media.close()
+
+        self.timings["total"] = time.monotonic() - self._started_at
+        timings = ", ".join(
+            f"{stage}={seconds:.2f}s" for stage, seconds in self.timings.items()
+        )
+        logger.info(
+            f"Reply timings of {self.handler} for user_id[{self.message.from_user.id}]: {timings}"
+        )
+
+        if exc is None or isinstance(exc, asyncio.CancelledError):
+            return False
+
+        if not self.propagate_errors:
+            logger.error(f"Error in {self.handler}: {exc}")
+            UPDATE_ERRORS.labels(self.handler).inc()
+            return True
+
+        # The error is logged by the job queue and counted by MetricsMiddleware.
+        if self.is_partly_delivered:
+            raise PermanentJobError(
+                f"{self.handler} failed after a part of the reply was delivered: {exc}"
+            ) from exc
+        # The retry sends a new wait message.
+        try:
+            await self.placeholder.delete()
+        except Exception as e:
+            logger.error(
+                f"Error in {self.handler} while deleting the wait message: {e}"
+            )
+        return False
+
+    @property
+    def is_partly_delivered(self) -> bool:
+        """
+        Returns whether a part of the reply, text or speech, was shown to the user.
+
+        Returns:
+        - bool: True if the reply was at least partly delivered.
+        """
+
+        return any(
+            milestone in self.timings
+            for milestone in ("first_text_shown", "text_sent", "first_voice_sent")
+        )
+
+    @contextmanager
+    def stage(self, name: str):
+        """
+        Records the time taken by the code in the context as a stage of the reply, also in the metrics.
+
+        Parameters:
+        - name (str): The name of the stage.
+
+        Returns:
+        - None
+        """
+
+        started_at = time.monotonic()
+        try:
+            with track_stage(f"reply.{name}"):
+                yield
+        finally:
+            self.timings[name] = time.monotonic() - started_at
+
+    def mark(self, name: str):
+        """
+        Records the time since the message was received as a milestone of the reply.
+
+        Parameters:
+        - name (str): The name of the milestone.
+
+        Returns:
+        - None
+        """
+
+        self.timings.setdefault(name, time.monotonic() - self._started_at)
+
+    async def download(self, file_id: str) -> BinaryIO:
+        """
+        Downloads a file sent by the user. The file is closed when the delivery ends.
+
+        Parameters:
+        - file_id (str): The Telegram file ID of the file.
+
+        Returns:
+        - BinaryIO: The buffer with the file content.
+        """
+
+        with self.stage("download"):
+            media = await download_media(file_id)
+        self.media.append(media)
+        return media
+
+    async def get_thread_id(self) -> str:
+        """
+        Returns the thread ID of the user's conversation.
+
+        Returns:
+        - str: The thread ID.
+        """
+
+        with self.stage("state"):
+            data = await self.state.storage.get_data(self.storage_key)
+        return data["thread_id"]
+
+    @property
+    def storage_key(self) -> StorageKey:
+        return StorageKey(
+            bot_id=settings.bot.id,
+            user_id=self.message.from_user.id,
+            chat_id=self.message.chat.id,
+        )
+
+    async def answer_canned(self, text: str):
+        """
+        Replies with a constant text and its speech, without asking the assistant.
+        The speech of the constant texts is prewarmed, so it is served from the TTS cache.
+
+        Parameters:
+        - text (str): The text of the reply.
+
+        Returns:
+        - None
+        """
+
+        speech = asyncio.create_task(TtsService.text_to_speech(text))
+        try:
+            await self.placeholder.edit_text(text)
+            self.mark("text_sent")
+            response_audio = await speech
+        finally:
+            speech.cancel()
+        await self.message.answer_voice(
+            BufferedInputFile(response_audio, filename="answer.ogg")
+        )
+        self.mark("first_voice_sent")
+
+    async def answer(self, prompt: str) -> Optional[str]:
+        """
+        Sends the prompt to the AssistantService and replies with both the text and the speech of the response.
+
+        The response is synthesized sentence by sentence while it is generated, so the first voice message
+        is sent as soon as the first sentence is ready, concurrently with the text. Prompts of the same
+        conversation are scheduled by the ConversationScheduler, so a prompt may be answered together
+        with the prompts sent before it. Once the context of the conversation grows too large,
+        it is rolled over into a new thread after the reply.
+
+        Parameters:
+        - prompt (str): The text prompt to send to the assistant.
+
+        Returns:
+        - Optional[str]: The assistant's response as text, or None if the prompt was answered in another reply
+          or its run was cancelled.
+        """
+
+        user_id = self.message.from_user.id
+        async with ConversationScheduler.turn(user_id, prompt) as run_prompt:
+            if run_prompt is None:
+                # The prompt was merged into the run of the previous message.
+                await self.placeholder.delete()
+                return None
+
+            # Read within the turn, as the previous turn may have rolled the conversation over.
+            thread_id = await self.get_thread_id()
+
+            speech = TtsService.create_pipeline()
+            voice_replies = asyncio.create_task(self.send_voice_replies(speech))
+
+            try:
+                with self.stage("assistant"):
+                    response = await answer_with_assistant(
+                        self.message,
+                        self.placeholder,
+                        thread_id,
+                        run_prompt,
+                        speech,
+                        on_first_text=lambda: self.mark("first_text_shown"),
+                    )
+                self.mark("text_sent")
+                speech.close()
+
+                try:
+                    with self.stage("voice_after_text"):
+                        await voice_replies
+                except Exception as e:
+                    logger.error(f"Error while converting answer to audio: {e}")
+
+                if ContextService.needs_rollover(thread_id):
+                    await self.rollover(thread_id)
+
+                return response
+            except RunCancelledError as e:
+                logger.info(f"{e} The user sent newer messages.")
+                return None
+            finally:
+                voice_replies.cancel()
+                await speech.aclose()
+
+    async def rollover(self, thread_id: str):
+        """
+        Rolls the conversation over into a new thread, unless the user has started a new one in the meantime.
+        A failed rollover is retried after the next reply.
+
+        Parameters:
+        - thread_id (str): The thread ID of the conversation.
+
+        Returns:
+        - None
+        """
+
+        try:
+            with self.stage("rollover"):
+                new_thread_id = await ContextService.rollover(
+                    self.message.from_user.id, thread_id
+                )
+                data = await self.state.storage.get_data(self.storage_key)
+                if data.get("thread_id") == thread_id:
+                    await self.state.storage.set_data(
+                        self.storage_key, {**data, "thread_id": new_thread_id}
+                    )
+        except Exception as e:
+            logger.error(f"Error while rolling over thread {thread_id}: {e}")
+
+    async def send_voice_replies(self, speech: TtsService.SpeechPipeline):
+        """
+        Sends the audio produced by the speech pipeline as consecutive voice messages, in the order of the text.
+
+        With STREAM_VOICE enabled, the upload of each voice message starts as soon as its synthesis starts,
+        and the audio is forwarded to Telegram as it is received.
+
+        Parameters:
+        - speech (TtsService.SpeechPipeline): The pipeline synthesizing the response.
+
+        Returns:
+        - None
+        """
+
+        async for response_audio in speech:
+            if settings.STREAM_VOICE:
+                voice = StreamedInputFile(response_audio, filename="answer.ogg")
+            else:
+                voice = BufferedInputFile(
+                    await response_audio.read(), filename="answer.ogg"
+                )
+            await self.message.answer_voice(voice)
+            self.mark("first_voice_sent")
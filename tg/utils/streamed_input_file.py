@@ -0,0 +1,27 @@
+from typing import AsyncGenerator, AsyncIterable
+
+from aiogram import Bot
+from aiogram.types import InputFile
+
+
+class StreamedInputFile(InputFile):
+    """
+    A file uploaded to Telegram while its content is still being produced, e.g. speech being synthesized.
+    The content is never stored as a whole, so the file can be uploaded only once.
+    """
+
+    def __init__(self, stream: AsyncIterable[bytes], filename: str):
+        """
+        Initializes the file.
+
+        Parameters:
+        - stream (AsyncIterable[bytes]): The consecutive parts of the content.
+        - filename (str): The name of the file.
+        """
+
+        super().__init__(filename=filename)
+        self.stream = stream
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        async for data in self.stream:
+            yield data
@@ -0,0 +1,165 @@
+import asyncio
+import time
+from typing import Callable
+
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.types import Message
+from loguru import logger
+
+from config import settings
+from services import AssistantService, TtsService
+
+
+class StreamingMessage:
+    """
+    A placeholder message that is edited in place while the reply is being generated.
+    Edits are throttled so that a single reply stays within Telegram's edit limits.
+    """
+
+    # The maximum length of the text of a single Telegram message.
+    MAX_LENGTH = 4096
+
+    def __init__(self, message: Message, min_interval: float = None):
+        """
+        Initializes the streaming message.
+
+        Parameters:
+        - message (Message): The placeholder message sent by the bot, which will be edited.
+        - min_interval (float): The minimum number of seconds between two edits.
+        """
+
+        self.message = message
+        self.min_interval = (
+            settings.STREAM_EDIT_INTERVAL if min_interval is None else min_interval
+        )
+        self.text = ""
+        self._shown_text = message.text
+        self._next_edit_at = 0.0
+
+    async def update(self, text: str):
+        """
+        Updates the text of the reply, editing the placeholder if the last edit was long enough ago.
+
+        Parameters:
+        - text (str): The whole text of the reply generated so far.
+
+        Returns:
+        - None
+        """
+
+        self.text = text
+        if time.monotonic() >= self._next_edit_at:
+            await self._edit(self._truncate(text))
+
+    async def finish(self, text: str = None) -> str:
+        """
+        Shows the final text of the reply. Text that does not fit into one message is sent as extra messages.
+
+        Parameters:
+        - text (str): The final text of the reply. Defaults to the last text passed to `update`.
+
+        Returns:
+        - str: The final text of the reply.
+        """
+
+        if text is not None:
+            self.text = text
+
+        chunks = [
+            self.text[i : i + self.MAX_LENGTH]
+            for i in range(0, len(self.text), self.MAX_LENGTH)
+        ] or [self.text]
+
+        await self._edit(chunks[0], force=True)
+        for chunk in chunks[1:]:
+            await self.message.answer(chunk)
+
+        return self.text
+
+    def _truncate(self, text: str) -> str:
+        """
+        Cuts an intermediate text so that it fits into one message.
+        """
+
+        if len(text) <= self.MAX_LENGTH:
+            return text
+        return text[: self.MAX_LENGTH - 1] + "…"
+
+    async def _edit(self, text: str, force: bool = False):
+        """
+        Edits the placeholder message, skipping empty and unchanged texts.
+        Intermediate edits that hit the flood control are dropped, the final one is retried.
+        """
+
+        if not text.strip() or text == self._shown_text:
+            return
+
+        while True:
+            try:
+                await self.message.edit_text(text)
+                self._shown_text = text
+                self._next_edit_at = time.monotonic() + self.min_interval
+                return
+            except TelegramRetryAfter as e:
+                self._next_edit_at = time.monotonic() + e.retry_after
+                if not force:
+                    return
+                await asyncio.sleep(e.retry_after)
+            except TelegramBadRequest as e:
+                if "message is not modified" not in str(e):
+                    logger.error(
+                        f"Error in StreamingMessage while editing message: {e}"
+                    )
+                return
+
+
+async def answer_with_assistant(
+    message: Message,
+    placeholder: Message,
+    thread_id: str,
+    prompt: str,
+    speech: TtsService.SpeechPipeline = None,
+    on_first_text: Callable[[], None] = None,
+) -> str:
+    """
+    Sends the prompt to the AssistantService and shows the response to the user.
+
+    With streaming enabled, the placeholder message is edited in place as the response is generated.
+    Otherwise, the whole response is sent as a new message once it is ready.
+
+    Parameters:
+    - message (Message): The message object received from the user.
+    - placeholder (Message): The wait message sent to the user.
+    - thread_id (str): The thread ID of the user's conversation.
+    - prompt (str): The text prompt to send to the assistant.
+    - speech (TtsService.SpeechPipeline): A pipeline to feed with the response, so that its synthesis
+      starts before the whole response is generated.
+    - on_first_text (Callable[[], None]): Called before the first text of the response is shown to the user.
+
+    Returns:
+    - str: The assistant's response as text.
+    """
+
+    if not settings.STREAM_RESPONSES:
+        response = await AssistantService.request(
+            message.from_user.id, thread_id, prompt
+        )
+        if speech is not None:
+            # The whole response is known, so all of it is synthesized while the text is being sent.
+            speech.close(response)
+        if on_first_text is not None:
+            on_first_text()
+        await message.answer(response)
+        return response
+
+    streaming_message = StreamingMessage(placeholder)
+    async for text in AssistantService.request_stream(
+        message.from_user.id, thread_id, prompt
+    ):
+        if speech is not None:
+            speech.feed(text)
+        if on_first_text is not None:
+            on_first_text()
+            on_first_text = None
+        await streaming_message.update(text)
+    return await streaming_message.finish()
@@ -0,0 +1 @@
+from .webhook_server import WebhookServer
@@ -0,0 +1,213 @@
+import asyncio
+import hashlib
+import json
+from typing import Optional
+
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+from loguru import logger
+from redis.asyncio import Redis
+
+
+class WebhookServer:
+    """
+    A class for receiving the updates from Telegram through a webhook served by aiohttp.
+
+    Several replicas of the bot can serve the same webhook behind a load balancer. By default, each replica
+    answers Telegram as soon as an update is received and handles it in the background. The webhook is registered
+    by one replica at a time and only when its configuration changes, so restarting replicas do not interfere
+    with each other.
+    The server also exposes the liveness (/healthz) and readiness (/readyz) probes for the load balancer.
+    """
+
+    class RequestHandler(SimpleRequestHandler):
+        """
+        A request handler that lets the updates being handled in the background finish on shutdown.
+        """
+
+        def __init__(self, *args, drain_timeout: float, **kwargs):
+            super().__init__(*args, **kwargs)
+            self.drain_timeout = drain_timeout
+
+        async def close(self):
+            tasks = set(self._background_feed_update_tasks)
+            if tasks:
+                logger.info(f"Waiting for {len(tasks)} updates to be handled")
+                _, pending = await asyncio.wait(tasks, timeout=self.drain_timeout)
+                for task in pending:
+                    task.cancel()
+            await super().close()
+
+    key_prefix = "webhook"
+
+    def __init__(
+        self,
+        dp: Dispatcher,
+        bot: Bot,
+        redis: Redis,
+        url: str,
+        path: str,
+        secret_token: str,
+        max_connections: int = 40,
+        drain_timeout: float = 30.0,
+        handle_in_background: bool = True,
+    ):
+        """
+        Initializes the server.
+
+        Parameters:
+        - dp (Dispatcher): The dispatcher handling the updates.
+        - bot (Bot): The bot the webhook is registered for.
+        - redis (Redis): The Redis client shared by the replicas.
+        - url (str): The public URL of the webhook.
+        - path (str): The path the updates are received on.
+        - secret_token (str): The token Telegram sends with every update, the same for all replicas.
+        - max_connections (int): The maximum number of concurrent connections Telegram makes to the webhook.
+        - drain_timeout (float): The time the updates being handled are given to finish on shutdown, in seconds.
+        - handle_in_background (bool): Whether Telegram is answered before the update is handled.
+          Otherwise Telegram redelivers the updates that were not handled, e.g. because of a crash.
+        """
+
+        self.dp = dp
+        self.bot = bot
+        self.redis = redis
+        self.url = url
+        self.path = path
+        self.secret_token = secret_token
+        self.max_connections = max_connections
+        self.drain_timeout = drain_timeout
+        self.handle_in_background = handle_in_background
+        self.ready = False
+        self.runner: Optional[web.AppRunner] = None
+
+    def create_app(self) -> web.Application:
+        """
+        Creates the application receiving the updates and serving the probes.
+
+        Returns:
+        - web.Application: The application.
+        """
+
+        app = web.Application()
+        app.router.add_get("/healthz", self.handle_health)
+        app.router.add_get("/readyz", self.handle_ready)
+
+        self.RequestHandler(
+            dispatcher=self.dp,
+            bot=self.bot,
+            secret_token=self.secret_token,
+            drain_timeout=self.drain_timeout,
+            handle_in_background=self.handle_in_background,
+        ).register(app, path=self.path)
+        setup_application(app, self.dp, bot=self.bot)
+        return app
+
+    async def start(self, host: str, port: int):
+        """
+        Starts receiving the updates and registers the webhook if needed.
+
+        Parameters:
+        - host (str): The host to listen on.
+        - port (int): The port to listen on.
+
+        Returns:
+        - None
+        """
+
+        self.runner = web.AppRunner(self.create_app())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logger.info(f"Webhook is served on http://{host}:{port}{self.path}")
+
+        await self.register_webhook()
+        self.ready = True
+
+    async def stop(self):
+        """
+        Stops receiving the updates and waits for the ones being handled.
+
+        The webhook stays registered, as the other replicas keep serving it.
+
+        Returns:
+        - None
+        """
+
+        self.ready = False
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def register_webhook(self):
+        """
+        Registers the webhook with Telegram, unless it is already registered with the same configuration.
+
+        The pending updates are kept, so the updates sent while no replica was running are handled.
+
+        Returns:
+        - None
+        """
+
+        allowed_updates = self.dp.resolve_used_update_types()
+        config = {
+            "url": self.url,
+            "allowed_updates": allowed_updates,
+            "max_connections": self.max_connections,
+            # The token itself is not stored.
+            "secret_token": hashlib.sha256(self.secret_token.encode()).hexdigest(),
+        }
+        config_hash = hashlib.sha256(
+            json.dumps(config, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+
+        async with self.redis.lock(
+            f"{self.key_prefix}:lock", timeout=60, blocking_timeout=60
+        ):
+            registered_hash = await self.redis.get(f"{self.key_prefix}:config_hash")
+            if registered_hash is not None and registered_hash.decode() == config_hash:
+                webhook_info = await self.bot.get_webhook_info()
+                if webhook_info.url == self.url:
+                    logger.info("Webhook is already registered")
+                    return
+
+            await self.bot.set_webhook(
+                url=self.url,
+                secret_token=self.secret_token,
+                allowed_updates=allowed_updates,
+                max_connections=self.max_connections,
+                drop_pending_updates=False,
+            )
+            await self.redis.set(f"{self.key_prefix}:config_hash", config_hash)
+            logger.info(f"Webhook is registered on {self.url}")
+
+    async def handle_health(self, request: web.Request) -> web.Response:
+        """
+        Reports that the process is alive.
+
+        Parameters:
+        - request (web.Request): The HTTP request.
+
+        Returns:
+        - web.Response: 200 OK.
+        """
+
+        return web.Response(text="ok")
+
+    async def handle_ready(self, request: web.Request) -> web.Response:
+        """
+        Reports whether the replica can handle updates: it has started, is not shutting down and reaches Redis.
+
+        Parameters:
+        - request (web.Request): The HTTP request.
+
+        Returns:
+        - web.Response: 200 OK if the replica is ready, 503 otherwise.
+        """
+
+        if not self.ready:
+            return web.Response(text="not ready", status=503)
+        try:
+            await self.redis.ping()
+        except Exception as e:
+            logger.error(f"Error in WebhookServer while checking Redis: {e}")
+            return web.Response(text="redis unavailable", status=503)
+        return web.Response(text="ready")
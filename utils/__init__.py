@@ -1,4 +1,9 @@
+from .audio_cache import AudioCache
+from .audio_tools import *
 from .emotions import Emotions
 from .image_tools import *
+from .lru_cache import LruCache
+from .media import create_media_buffer, download_media
 from .repository import Base
+from .sentences import join_overlapping_transcripts, split_complete_sentences
 from .strings import Strings
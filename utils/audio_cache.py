@@ -0,0 +1,187 @@
+import asyncio
+import hashlib
+import os
+import re
+import tempfile
+import unicodedata
+from collections import OrderedDict
+from contextlib import suppress
+from typing import Optional
+
+import aiofiles
+import aiofiles.os
+from loguru import logger
+
+from .lru_cache import LruCache
+
+
+class AudioCache:
+    """
+    A content-addressed cache of synthesized speech.
+
+    Audio is keyed by the model, the voice, the format and the hash of the normalized text.
+    The cache has two tiers: a size-bounded in-memory LRU and a size-bounded directory on disk,
+    which is evicted in least recently used order and survives restarts.
+    """
+
+    def __init__(self, directory: str, memory_size: int, disk_size: int):
+        """
+        Initializes the cache and indexes the audio already stored on disk.
+
+        Parameters:
+        - directory (str): The directory of the disk tier.
+        - memory_size (int): The maximum number of bytes kept in memory.
+        - disk_size (int): The maximum number of bytes kept on disk.
+        """
+
+        self.directory = directory
+        self.disk_size = disk_size
+        self.memory = LruCache(max_size=memory_size, size_of=len)
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        # Maps keys of the disk tier to the sizes of their files, in least recently used order.
+        self._disk_index = OrderedDict()
+        self._disk_usage = 0
+
+        os.makedirs(self.directory, exist_ok=True)
+        entries = sorted(os.scandir(self.directory), key=lambda e: e.stat().st_mtime)
+        for entry in entries:
+            if not entry.is_file():
+                continue
+            if entry.name.endswith(".tmp"):
+                # A leftover of a write interrupted by a crash.
+                os.remove(entry.path)
+                continue
+            self._disk_index[entry.name] = entry.stat().st_size
+            self._disk_usage += entry.stat().st_size
+
+    @staticmethod
+    def make_key(model: str, voice: str, response_format: str, text: str) -> str:
+        """
+        Builds the key of the audio of a text.
+
+        The text is normalized (Unicode NFC, collapsed whitespace) so that trivially different texts share the audio.
+
+        Parameters:
+        - model (str): The speech model.
+        - voice (str): The voice of the speech.
+        - response_format (str): The audio format.
+        - text (str): The synthesized text.
+
+        Returns:
+        - str: The cache key.
+        """
+
+        normalized_text = re.sub(
+            r"\s+", " ", unicodedata.normalize("NFC", text)
+        ).strip()
+        text_hash = hashlib.sha256(normalized_text.encode("utf-8")).hexdigest()
+        return f"{model}-{voice}-{text_hash}.{response_format}"
+
+    async def get(self, key: str) -> Optional[bytes]:
+        """
+        Returns the cached audio, promoting audio found on disk to memory.
+
+        Parameters:
+        - key (str): The cache key.
+
+        Returns:
+        - Optional[bytes]: The audio, or None on a miss.
+        """
+
+        if (audio := self.memory.get(key)) is not None:
+            self.memory_hits += 1
+            return audio
+
+        if key in self._disk_index:
+            path = os.path.join(self.directory, key)
+            try:
+                async with aiofiles.open(path, "rb") as audio_file:
+                    audio = await audio_file.read()
+                await asyncio.to_thread(os.utime, path)
+                self._disk_index.move_to_end(key)
+                self.memory.set(key, audio)
+                self.disk_hits += 1
+                return audio
+            except OSError as e:
+                logger.error(f"Error in AudioCache while reading {key}: {e}")
+                self._forget(key)
+
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, audio: bytes):
+        """
+        Stores the audio in both tiers, evicting the least recently used audio from disk if needed.
+
+        Parameters:
+        - key (str): The cache key.
+        - audio (bytes): The audio.
+
+        Returns:
+        - None
+        """
+
+        self.memory.set(key, audio)
+
+        if key in self._disk_index or len(audio) > self.disk_size:
+            return
+
+        path = os.path.join(self.directory, key)
+        temp_path = None
+        try:
+            # The file is written under a unique name and renamed into place, so that a crash never leaves
+            # truncated audio in the cache and concurrent writes of the same key do not clobber each other.
+            descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            os.close(descriptor)
+            async with aiofiles.open(temp_path, "wb") as audio_file:
+                await audio_file.write(audio)
+            await aiofiles.os.replace(temp_path, path)
+        except OSError as e:
+            logger.error(f"Error in AudioCache while writing {key}: {e}")
+            if temp_path is not None:
+                with suppress(OSError):
+                    await aiofiles.os.remove(temp_path)
+            return
+
+        # Another write of the same key may have finished while this one was awaiting.
+        if key in self._disk_index:
+            self._disk_index.move_to_end(key)
+            return
+        self._disk_index[key] = len(audio)
+        self._disk_usage += len(audio)
+
+        while self._disk_usage > self.disk_size:
+            evicted_key = next(iter(self._disk_index))
+            self._forget(evicted_key)
+            try:
+                await aiofiles.os.remove(os.path.join(self.directory, evicted_key))
+            except OSError as e:
+                logger.error(f"Error in AudioCache while evicting {evicted_key}: {e}")
+
+    def stats(self) -> dict:
+        """
+        Returns the hit and miss counters and the usage of both tiers.
+
+        Returns:
+        - dict: The statistics of the cache.
+        """
+
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "memory_bytes": self.memory.size,
+            "disk_bytes": self._disk_usage,
+            "disk_entries": len(self._disk_index),
+        }
+
+    def _forget(self, key: str):
+        """
+        Removes the key from the index of the disk tier.
+        """
+
+        self._disk_usage -= self._disk_index.pop(key, 0)
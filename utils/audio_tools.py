@@ -0,0 +1,199 @@
+import io
+from typing import BinaryIO, List, Optional, Tuple
+
+from loguru import logger
+
+try:
+    import av
+    import numpy as np
+except ImportError:
+    av = None
+    logger.warning(
+        "PyAV is not installed, voice messages are transcribed without trimming silence."
+    )
+
+__all__ = [
+    "decode_audio",
+    "detect_speech",
+    "encode_audio",
+    "is_audio_processing_available",
+    "split_at_silence",
+]
+
+
+def is_audio_processing_available() -> bool:
+    """
+    Returns whether the optional PyAV dependency required by the audio tools is installed.
+
+    Returns:
+    - bool: True if audio can be decoded and encoded.
+    """
+
+    return av is not None
+
+
+def decode_audio(audio_file: BinaryIO, sample_rate: int = 16000) -> "np.ndarray":
+    """
+    Decodes an audio file into mono samples.
+    This function is CPU-bound and should be run in a thread.
+
+    Parameters:
+    - audio_file (BinaryIO): The binary file object of the audio, in any format supported by FFmpeg.
+    - sample_rate (int): The sample rate of the result.
+
+    Returns:
+    - np.ndarray: The samples as 16-bit integers.
+    """
+
+    audio_file.seek(0)
+    resampler = av.AudioResampler(format="s16", layout="mono", rate=sample_rate)
+    chunks = []
+    with av.open(audio_file, "r") as container:
+        for frame in container.decode(audio=0):
+            for resampled_frame in resampler.resample(frame):
+                chunks.append(resampled_frame.to_ndarray().reshape(-1))
+    for resampled_frame in resampler.resample(None):
+        chunks.append(resampled_frame.to_ndarray().reshape(-1))
+
+    return np.concatenate(chunks) if chunks else np.zeros(0, dtype=np.int16)
+
+
+def detect_speech(
+    samples: "np.ndarray",
+    sample_rate: int = 16000,
+    frame_ms: int = 30,
+    min_level_db: float = -45.0,
+    noise_margin_db: float = 10.0,
+    min_speech_ms: int = 250,
+    padding_ms: int = 200,
+) -> Optional[Tuple[int, int]]:
+    """
+    Finds the part of the audio that contains speech with an energy-based voice activity detector.
+
+    A frame is voiced if its level is above an absolute floor and, if the clip has quiet frames, above
+    the noise floor of the clip (the level of its quietest frames) by a margin. A clip without quiet frames
+    is continuous speech or speech over loud noise, which cannot be told apart by level, so only the floor
+    applies to it.
+
+    Parameters:
+    - samples (np.ndarray): The mono samples as 16-bit integers.
+    - sample_rate (int): The sample rate of the samples.
+    - frame_ms (int): The length of the analyzed frames, in milliseconds.
+    - min_level_db (float): The minimum level of a voiced frame, in dBFS.
+    - noise_margin_db (float): The minimum difference between a voiced frame and the noise floor, in dB.
+    - min_speech_ms (int): The minimum total length of the voiced frames, in milliseconds.
+    - padding_ms (int): The audio kept before the first and after the last voiced frame, in milliseconds.
+
+    Returns:
+    - Optional[Tuple[int, int]]: The first and the last (exclusive) samples of the speech, or None if there is none.
+    """
+
+    frame_length = sample_rate * frame_ms // 1000
+    frame_count = len(samples) // frame_length
+    if frame_count == 0:
+        return None
+
+    frames = samples[: frame_count * frame_length].reshape(frame_count, frame_length)
+    rms = np.sqrt(np.mean((frames.astype(np.float32) / 32768) ** 2, axis=1))
+    levels = 20 * np.log10(np.maximum(rms, 1e-10))
+
+    noise_floor = np.percentile(levels, 10)
+    if noise_floor > min_level_db:
+        threshold = min_level_db
+    else:
+        threshold = max(min_level_db, noise_floor + noise_margin_db)
+    voiced = np.flatnonzero(levels > threshold)
+    if len(voiced) * frame_ms < min_speech_ms:
+        return None
+
+    padding = sample_rate * padding_ms // 1000
+    start = max(0, voiced[0] * frame_length - padding)
+    end = min(len(samples), (voiced[-1] + 1) * frame_length + padding)
+    return int(start), int(end)
+
+
+def split_at_silence(
+    samples: "np.ndarray",
+    sample_rate: int = 16000,
+    max_segment_s: float = 60.0,
+    overlap_s: float = 1.0,
+    search_s: float = 10.0,
+    frame_ms: int = 30,
+) -> List[Tuple[int, int]]:
+    """
+    Splits the audio into overlapping segments of at most max_segment_s seconds, cutting at the quietest moments.
+
+    Each cut is placed at the quietest frame within the last search_s seconds of a segment, so that it
+    falls into a pause between words where possible. Neighbouring segments share overlap_s seconds of audio
+    around the cut, so a word that is cut anyway appears in full in one of them.
+
+    Parameters:
+    - samples (np.ndarray): The mono samples as 16-bit integers.
+    - sample_rate (int): The sample rate of the samples.
+    - max_segment_s (float): The maximum length of a segment, in seconds.
+    - overlap_s (float): The length of the audio shared by neighbouring segments, in seconds.
+    - search_s (float): The length of the window searched for the quietest moment, in seconds.
+    - frame_ms (int): The length of the frames compared by loudness, in milliseconds.
+
+    Returns:
+    - List[Tuple[int, int]]: The first and the last (exclusive) samples of the segments.
+    """
+
+    max_length = int(max_segment_s * sample_rate)
+    half_overlap = int(overlap_s * sample_rate) // 2
+    search_length = int(min(search_s, max_segment_s / 2) * sample_rate)
+    frame_length = sample_rate * frame_ms // 1000
+
+    segments = []
+    start = 0
+    while len(samples) - start > max_length:
+        window_end = start + max_length - half_overlap
+        window_start = window_end - search_length
+        frame_count = (window_end - window_start) // frame_length
+        frames = samples[window_start : window_start + frame_count * frame_length]
+        energy = np.sum(
+            frames.astype(np.float32).reshape(frame_count, frame_length) ** 2, axis=1
+        )
+        cut = window_start + int(np.argmin(energy)) * frame_length + frame_length // 2
+
+        segments.append((start, cut + half_overlap))
+        start = cut - half_overlap
+    segments.append((start, len(samples)))
+
+    return segments
+
+
+def encode_audio(
+    samples: "np.ndarray", sample_rate: int = 16000, bit_rate: int = 24000
+) -> BinaryIO:
+    """
+    Encodes mono samples as Opus in an OGG container, the most compact format accepted by Whisper.
+    This function is CPU-bound and should be run in a thread.
+
+    Parameters:
+    - samples (np.ndarray): The mono samples as 16-bit integers.
+    - sample_rate (int): The sample rate of the samples, one of those supported by Opus.
+    - bit_rate (int): The bit rate of the result.
+
+    Returns:
+    - BinaryIO: The in-memory OGG file.
+    """
+
+    result = io.BytesIO()
+    with av.open(result, "w", format="ogg") as container:
+        stream = container.add_stream("libopus", rate=sample_rate, layout="mono")
+        stream.bit_rate = bit_rate
+
+        frame = av.AudioFrame.from_ndarray(
+            samples.reshape(1, -1), format="s16", layout="mono"
+        )
+        frame.sample_rate = sample_rate
+        frame.pts = 0
+
+        for packet in stream.encode(frame):
+            container.mux(packet)
+        for packet in stream.encode(None):
+            container.mux(packet)
+
+    result.seek(0)
+    return result
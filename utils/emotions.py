@@ -13,3 +13,6 @@ class Emotions:
         "surprise",
         "calm",
     ]
+
+    # The result of the identification for images without a face.
+    NO_FACE = "no_face"
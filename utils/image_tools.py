@@ -1,19 +1,197 @@
 import base64
+import io
+import threading
+from typing import BinaryIO, List, Optional, Tuple
 
+from aiogram.types import PhotoSize
+from loguru import logger
+from PIL import Image, ImageOps
 
-def encode_image(image_path: str) -> str:
+try:
+    import cv2
+    import numpy as np
+except ImportError:
+    cv2 = None
+    logger.warning("OpenCV is not installed, photos are not checked for faces.")
+
+__all__ = [
+    "choose_photo_size",
+    "crop_to_face",
+    "detect_face",
+    "downscale_image",
+    "encode_image",
+    "is_face_detection_available",
+    "load_image",
+]
+
+# Cascade classifiers are not safe to share between threads, so each thread loads its own.
+_face_detectors = threading.local()
+
+
+def encode_image(image_file: BinaryIO) -> str:
     """
-    Encodes an image file into a base64 string.
+    Encodes an image into a base64 string.
 
-    This function reads an image file from the given path, encodes it into a base64 string,
+    This function reads the image from the given binary file object, encodes it into a base64 string,
     and returns the encoded string.
 
     Parameters:
-    - image_path (str): The file path of the image to be encoded.
+    - image_file (BinaryIO): The binary file object of the image to be encoded.
 
     Returns:
     - str: A base64 encoded string representing the image.
     """
 
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+    image_file.seek(0)
+    return base64.b64encode(image_file.read()).decode("utf-8")
+
+
+def choose_photo_size(photo_sizes: List[PhotoSize], min_side: int) -> PhotoSize:
+    """
+    Chooses the smallest size of a Telegram photo whose shorter side is at least min_side pixels.
+
+    Parameters:
+    - photo_sizes (List[PhotoSize]): The available sizes of the photo.
+    - min_side (int): The minimum length of the shorter side, in pixels.
+
+    Returns:
+    - PhotoSize: The chosen size, or the largest one if none is large enough.
+    """
+
+    photo_sizes = sorted(photo_sizes, key=lambda size: size.width * size.height)
+    for photo_size in photo_sizes:
+        if min(photo_size.width, photo_size.height) >= min_side:
+            return photo_size
+    return photo_sizes[-1]
+
+
+def load_image(image_file: BinaryIO) -> Image.Image:
+    """
+    Loads an image as RGB, rotated according to its EXIF orientation, so that faces are upright.
+
+    Parameters:
+    - image_file (BinaryIO): The binary file object of the image.
+
+    Returns:
+    - Image.Image: The loaded image.
+    """
+
+    image_file.seek(0)
+    with Image.open(image_file) as image:
+        return ImageOps.exif_transpose(image).convert("RGB")
+
+
+def is_face_detection_available() -> bool:
+    """
+    Returns whether the optional OpenCV dependency required by detect_face is installed.
+
+    Returns:
+    - bool: True if faces can be detected.
+    """
+
+    return cv2 is not None
+
+
+def detect_face(
+    image: Image.Image, max_side: int = 640, min_face_ratio: float = 0.08
+) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Detects the largest frontal face in the image with the Haar cascade bundled with OpenCV.
+    This function is CPU-bound and should be run in a thread.
+
+    Parameters:
+    - image (Image.Image): The image.
+    - max_side (int): The longer side of the copy of the image the detection runs on, in pixels.
+    - min_face_ratio (float): The minimum size of a face relative to the shorter side of the image.
+
+    Returns:
+    - Optional[Tuple[int, int, int, int]]: The left, top, width and height of the face in the image, or None.
+
+    Raises:
+    - RuntimeError: If OpenCV is not installed.
+    """
+
+    if cv2 is None:
+        raise RuntimeError("OpenCV must be installed to detect faces.")
+
+    detector = getattr(_face_detectors, "detector", None)
+    if detector is None:
+        detector = _face_detectors.detector = cv2.CascadeClassifier(
+            cv2.data.haarcascades + "haarcascade_frontalface_default.xml"
+        )
+
+    scale = min(1.0, max_side / max(image.width, image.height))
+    grayscale = image.convert("L")
+    if scale < 1:
+        grayscale = grayscale.resize(
+            (int(image.width * scale), int(image.height * scale))
+        )
+
+    pixels = cv2.equalizeHist(np.asarray(grayscale))
+    min_face = max(24, int(min(pixels.shape) * min_face_ratio))
+    faces = detector.detectMultiScale(
+        pixels, scaleFactor=1.1, minNeighbors=5, minSize=(min_face, min_face)
+    )
+    if len(faces) == 0:
+        return None
+
+    left, top, width, height = max(faces, key=lambda face: face[2] * face[3])
+    return (
+        int(left / scale),
+        int(top / scale),
+        int(width / scale),
+        int(height / scale),
+    )
+
+
+def crop_to_face(
+    image: Image.Image, face: Tuple[int, int, int, int], margin: float = 0.5
+) -> Image.Image:
+    """
+    Crops the image to the face, keeping a margin around it so that the whole expression is visible.
+
+    Parameters:
+    - image (Image.Image): The image.
+    - face (Tuple[int, int, int, int]): The left, top, width and height of the face.
+    - margin (float): The margin on each side, relative to the size of the face.
+
+    Returns:
+    - Image.Image: The cropped image.
+    """
+
+    left, top, width, height = face
+    return image.crop(
+        (
+            max(0, int(left - width * margin)),
+            max(0, int(top - height * margin)),
+            min(image.width, int(left + width * (1 + margin))),
+            min(image.height, int(top + height * (1 + margin))),
+        )
+    )
+
+
+def downscale_image(image: Image.Image, max_pixels: int, quality: int = 85) -> BinaryIO:
+    """
+    Downscales an image to at most max_pixels pixels, keeping its aspect ratio, and encodes it as JPEG.
+    This function is CPU-bound and should be run in a thread.
+
+    Parameters:
+    - image (Image.Image): The image.
+    - max_pixels (int): The maximum number of pixels of the result.
+    - quality (int): The JPEG quality of the result.
+
+    Returns:
+    - BinaryIO: The in-memory JPEG image.
+    """
+
+    scale = (max_pixels / (image.width * image.height)) ** 0.5
+    if scale < 1:
+        image = image.resize(
+            (max(1, int(image.width * scale)), max(1, int(image.height * scale))),
+            Image.Resampling.LANCZOS,
+        )
+
+    result = io.BytesIO()
+    image.save(result, format="JPEG", quality=quality)
+    result.seek(0)
+    return result
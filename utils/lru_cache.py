@@ -0,0 +1,120 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LruCache:
+    """
+    An in-memory cache that evicts the least recently used entries once its size limit is exceeded.
+    Entries can optionally expire after a time to live.
+    """
+
+    def __init__(
+        self,
+        max_size: int,
+        ttl: Optional[float] = None,
+        size_of: Optional[Callable[[Any], int]] = None,
+    ):
+        """
+        Initializes the cache.
+
+        Parameters:
+        - max_size (int): The maximum total size of the entries.
+        - ttl (Optional[float]): The number of seconds after which an entry expires, or None if entries never expire.
+        - size_of (Optional[Callable[[Any], int]]): A function returning the size of a value.
+          By default every entry has the size of 1, so max_size is the maximum number of entries.
+        """
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.size_of = size_of or (lambda value: 1)
+        self.size = 0
+        self._entries = OrderedDict()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Returns the value stored under the key and marks it as recently used.
+
+        Parameters:
+        - key (Hashable): The key of the entry.
+        - default (Any): The value returned if there is no such entry or it has expired.
+
+        Returns:
+        - Any: The stored value or the default value.
+        """
+
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+
+        value, size, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            self.pop(key)
+            return default
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        """
+        Stores the value under the key, evicting the least recently used entries if needed.
+        A value larger than the whole cache is not stored.
+
+        Parameters:
+        - key (Hashable): The key of the entry.
+        - value (Any): The value to store.
+
+        Returns:
+        - None
+        """
+
+        self.pop(key)
+
+        size = self.size_of(value)
+        if size > self.max_size:
+            return
+
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        self._entries[key] = (value, size, expires_at)
+        self.size += size
+
+        while self.size > self.max_size:
+            _, (_, evicted_size, _) = self._entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """
+        Removes the entry stored under the key.
+
+        Parameters:
+        - key (Hashable): The key of the entry.
+        - default (Any): The value returned if there is no such entry.
+
+        Returns:
+        - Any: The removed value or the default value.
+        """
+
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return default
+
+        value, size, _ = entry
+        self.size -= size
+        return value
+
+    def clear(self):
+        """
+        Removes all entries.
+
+        Returns:
+        - None
+        """
+
+        self._entries.clear()
+        self.size = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, self) is not self
+
+    def __len__(self) -> int:
+        return len(self._entries)
@@ -0,0 +1,42 @@
+import os
+import tempfile
+from typing import BinaryIO
+
+from config import settings
+
+
+def create_media_buffer() -> BinaryIO:
+    """
+    Creates a buffer for media payloads.
+
+    The buffer is kept in memory, and only a payload larger than MEDIA_SPOOL_THRESHOLD bytes
+    is spilled to an anonymous file in the MEDIA_SPOOL_DIR directory, which is removed when the buffer is closed.
+
+    Returns:
+    - BinaryIO: A new empty buffer.
+    """
+
+    os.makedirs(settings.MEDIA_SPOOL_DIR, exist_ok=True)
+    return tempfile.SpooledTemporaryFile(
+        max_size=settings.MEDIA_SPOOL_THRESHOLD, dir=settings.MEDIA_SPOOL_DIR
+    )
+
+
+async def download_media(file_id: str) -> BinaryIO:
+    """
+    Downloads a file sent to the bot into a media buffer.
+
+    Parameters:
+    - file_id (str): The Telegram file ID of the file to download.
+
+    Returns:
+    - BinaryIO: The buffer with the file content, positioned at its beginning. The caller must close it.
+    """
+
+    buffer = create_media_buffer()
+    try:
+        await settings.bot.download(file_id, destination=buffer)
+    except Exception:
+        buffer.close()
+        raise
+    return buffer
@@ -0,0 +1,96 @@
+import re
+from typing import List, Tuple
+
+# A word of a transcript, compared without case and punctuation.
+WORD = re.compile(r"\w+")
+
+# A sentence ends with terminal punctuation followed by whitespace, or with a line break.
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?…])\s+|\n+")
+
+
+def split_complete_sentences(text: str) -> Tuple[List[str], int]:
+    """
+    Splits the text into sentences that are known to be complete.
+
+    The text after the last sentence boundary may still be growing (e.g. while a reply is streamed),
+    so it is not returned.
+
+    Parameters:
+    - text (str): The text to split.
+
+    Returns:
+    - Tuple[List[str], int]: The complete sentences and the offset in the text right after the last of them.
+    """
+
+    sentences = []
+    start = 0
+    for boundary in SENTENCE_BOUNDARY.finditer(text):
+        sentence = text[start : boundary.start()].strip()
+        if sentence:
+            sentences.append(sentence)
+        start = boundary.end()
+    return sentences, start
+
+
+def join_overlapping_transcripts(
+    transcripts: List[str], max_overlap_words: int = 12, min_overlap_words: int = 2
+) -> str:
+    """
+    Joins the transcripts of consecutive overlapping audio segments, removing the words transcribed twice.
+
+    The longest run of words that ends one transcript and starts the next one (ignoring case and punctuation)
+    is kept only once. Up to two words at the edges of the run may differ, as a word cut by a segment boundary
+    is often transcribed incorrectly. A run must have at least min_overlap_words words, as a single shared word,
+    e.g. a conjunction, is too likely to be a coincidence.
+
+    Parameters:
+    - transcripts (List[str]): The transcripts of the segments, in order.
+    - max_overlap_words (int): The maximum number of words the transcripts of two segments may share.
+    - min_overlap_words (int): The minimum number of words of a run removed as transcribed twice.
+
+    Returns:
+    - str: The joined transcript.
+    """
+
+    result = []
+    for transcript in transcripts:
+        words = transcript.split()
+        if not words:
+            continue
+
+        previous = [
+            "".join(WORD.findall(word)).lower()
+            for word in result[-max_overlap_words - 2 :]
+        ]
+        current = [
+            "".join(WORD.findall(word)).lower()
+            for word in words[: max_overlap_words + 2]
+        ]
+
+        skip = 0
+        for length in range(
+            min(max_overlap_words, len(previous), len(current)),
+            min_overlap_words - 1,
+            -1,
+        ):
+            matches = [
+                (tail_skip, head_skip)
+                for tail_skip in range(3)
+                for head_skip in range(3)
+                if length + tail_skip <= len(previous)
+                and length + head_skip <= len(current)
+                and previous[
+                    len(previous) - tail_skip - length : len(previous) - tail_skip
+                ]
+                == current[head_skip : head_skip + length]
+            ]
+            if matches:
+                tail_skip, head_skip = matches[0]
+                # The words after the shared run in the previous transcript are duplicates of words in this one.
+                del result[len(result) - tail_skip : len(result)]
+                skip = head_skip + length
+                break
+
+        result.extend(words[skip:])
+
+    return " ".join(result)
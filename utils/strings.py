@@ -17,4 +17,8 @@ class Strings:
 
     EMOTION_STATE_USER_ANS = "Сейчас я себя чувствую вот так: "
 
+    NO_SPEECH_MSG = "Кажется, в этом голосовом сообщении ничего не слышно 🙉 Попробуйте, пожалуйста, записать его еще раз."
+
+    NO_FACE_MSG = "Я не вижу лица на этой фотографии 🙈 Пришлите, пожалуйста, фото, на котором хорошо видно ваше лицо."
+
     KEY_VALUES_ARE_NOT_DEFINED = "К сожалению, мне не удалось точно определить ваши ценности. Давайте попробуем обсудить это еще раз!"